@@ -4,8 +4,10 @@ from flask_login import LoginManager
 from flask_bcrypt import Bcrypt
 from flask_socketio import SocketIO
 from .config import Config
+from .database import RoutingSession
 
-db = SQLAlchemy()
+# Sessions route replica-safe reads (see app/database.py)
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 login_manager = LoginManager()
 bcrypt = Bcrypt()
 socketio = SocketIO()
@@ -14,11 +16,63 @@ def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
     
+    # Engine profile and read replicas
+    from app import database
+    database.configure(app)
+    
     # Initialize extensions
     db.init_app(app)
+    database.init_app(app, db)
     login_manager.init_app(app)
     bcrypt.init_app(app)
-    socketio.init_app(app, cors_allowed_origins="*")
+    
+    # Socket event handlers; imported before init_app so each app's server gets them
+    from app import socket_events
+    
+    # Message bus and presence shared by every Socket.IO worker
+    from app import bus
+    from app.presence import presence
+    socketio.init_app(app, cors_allowed_origins="*",
+                      client_manager=bus.create_manager(app.config['SOCKETIO_MESSAGE_QUEUE']))
+    presence.init_app(app)
+    
+    from app.typing_indicators import tracker as typing_tracker
+    typing_tracker.init_app(app)
+    
+    from app.chat_writer import writer as chat_writer
+    chat_writer.init_app(app)
+    
+    # Fragment cache for the browse pages
+    from app.cache import cache
+    cache.init_app(app)
+    
+    # Cached user loading for requests and socket events
+    from app.identity import identity
+    identity.init_app(app)
+    
+    # Background removal of soft-deleted rows
+    from app.purge import purger
+    purger.init_app(app)
+    
+    # Background upkeep of the related-listing index
+    from app.recommend import recommender
+    recommender.init_app(app)
+    
+    # Background archival of old chat history
+    from app.archive import archiver
+    archiver.init_app(app)
+    
+    # Cacheable upload serving at /uploads/
+    from app import uploads
+    uploads.init_app(app)
+    
+    # Latency, SQL and socket metrics at /metrics
+    from app import metrics
+    metrics.init_app(app)
+    
+    # Per-request SQL statement budgets (development/testing)
+    from app import query_budget
+    query_budget.init_app(app)
     
     # Login manager settings
     login_manager.login_view = 'auth.login'
@@ -27,10 +81,17 @@ def create_app(config_class=Config):
     
     # Register blueprints
     from app.routes import main, auth
+    from app.api import api
     app.register_blueprint(main)
     app.register_blueprint(auth)
+    app.register_blueprint(api)
     
-    # Register socket events
-    from app import socket_events
+    # Image rendition helpers for templates
+    from app import images
+    app.jinja_env.globals.update(image_url=images.image_url, image_is_processed=images.is_processed)
+    
+    # Register CLI commands
+    from app.commands import register_commands
+    register_commands(app)
     
     return app
\ No newline at end of file
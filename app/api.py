@@ -0,0 +1,308 @@
+"""Read-only JSON API under ``/api/v1``.
+
+Endpoints:
+
+* ``GET /items`` - listings newest first; ``category``, ``rarity``, ``seller``
+  (username) and ``search`` filter as on the marketplace
+* ``GET /items/<id>``
+* ``GET /users/<username>`` and ``GET /users/<username>/items``
+* ``GET /threads`` and ``GET /threads/<other_user_id>/messages`` - the
+  logged-in user's conversations, newest activity first, and one thread's
+  messages newest first (older ones come from the archive as in chat)
+
+Item, user and thread rows are built from selected columns, not ORM objects,
+and written as compact JSON. Message pages reuse chat history, which may read
+the archive. ``?fields=id,name`` keeps only the listed keys of each row.
+List bodies are ``{"data": [...], "next": cursor}``; pass ``?cursor=`` to
+get the next page and ``?limit=`` (at most ``API_MAX_PAGE_SIZE``) for its
+size.
+
+Every item row carries its ``updated_at`` row version. The ETag is a digest
+of the body, so it is a strong validator, and changes whenever a row version
+does. Item and user bodies are public. They are cached under the fragment
+cache's ``items`` version stamp, so a poll with a current ``If-None-Match``
+gets a ``304`` without touching the database. Thread bodies are private and
+built on every request; a 304 there saves serialization and transfer.
+Bodies over ``API_COMPRESS_MIN_SIZE`` bytes are sent with brotli when the
+optional ``brotli`` package is installed and the client accepts it, else
+with gzip.
+"""
+import functools
+import gzip
+import hashlib
+import json
+
+from flask import Blueprint, Response, abort, current_app, jsonify, request
+from flask_login import current_user
+from sqlalchemy import func, select
+from app import conversations, db
+from app.cache import cache
+from app.images import image_url
+from app.models import Conversation, ConversationMember, Item, Message, User
+from app.pagination import keyset_paginate, offset_paginate
+from app.query_budget import query_budget
+from app.search import search_items
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+ITEM_COLUMNS = (
+    Item.id, Item.name, Item.description, Item.category, Item.rarity, Item.image,
+    Item.seller_id, User.username.label('seller'), Item.created_at, Item.updated_at,
+)
+ITEM_FIELDS = ('id', 'name', 'description', 'category', 'rarity', 'image', 'seller_id', 'seller',
+               'created_at', 'updated_at')
+USER_FIELDS = ('id', 'username', 'avatar', 'created_at', 'item_count')
+THREAD_FIELDS = ('id', 'other_user_id', 'other_user', 'item_id', 'unread_count', 'last_activity',
+                 'last_message')
+MESSAGE_FIELDS = ('id', 'uid', 'sender_id', 'recipient_id', 'item_id', 'subject', 'content', 'read',
+                  'timestamp')
+
+
+def _timestamp(value):
+    return value.isoformat() + 'Z' if value else None
+
+
+def _fields(allowed):
+    """The ``?fields=`` selection, or every allowed field"""
+    requested = request.args.get('fields')
+    if not requested:
+        return allowed
+    fields = tuple(field for field in requested.split(',') if field)
+    unknown = [field for field in fields if field not in allowed]
+    if unknown:
+        abort(400, description=f"Unknown fields: {', '.join(unknown)}")
+    return fields
+
+
+def _limit():
+    config = current_app.config
+    limit = request.args.get('limit', config['API_PAGE_SIZE'], type=int)
+    return min(max(limit, 1), config['API_MAX_PAGE_SIZE'])
+
+
+def _select(row, fields):
+    return {field: row[field] for field in fields}
+
+
+def _item_row(row, rendition='card'):
+    return {
+        'id': row.id,
+        'name': row.name,
+        'description': row.description,
+        'category': row.category,
+        'rarity': row.rarity,
+        'image': image_url('items', row.image, rendition),
+        'seller_id': row.seller_id,
+        'seller': row.seller,
+        'created_at': _timestamp(row.created_at),
+        'updated_at': _timestamp(row.updated_at or row.created_at),
+    }
+
+
+def _items_query():
+    return db.session.query(*ITEM_COLUMNS).select_from(Item).join(User, User.id == Item.seller_id)
+
+
+def _message_row(message):
+    return {
+        'id': message.id,
+        'uid': message.uid,
+        'sender_id': message.sender_id,
+        'recipient_id': message.recipient_id,
+        'item_id': message.item_id,
+        'subject': message.subject,
+        'content': message.content,
+        'read': message.read,
+        'timestamp': _timestamp(message.timestamp),
+    }
+
+
+def _dumps(payload):
+    return json.dumps(payload, separators=(',', ':'), ensure_ascii=False).encode()
+
+
+def _compress(body):
+    """``(body, encoding)`` in the best encoding the client accepts"""
+    if len(body) < current_app.config['API_COMPRESS_MIN_SIZE']:
+        return body, None
+    if brotli is not None and 'br' in request.accept_encodings:
+        return brotli.compress(body, quality=5), 'br'
+    if 'gzip' in request.accept_encodings:
+        return gzip.compress(body, compresslevel=6), 'gzip'
+    return body, None
+
+
+def _respond(body, etag, private=False):
+    """A conditional JSON response for ``body``, compressed if it pays off"""
+    body, encoding = _compress(body)
+    response = Response(body, mimetype='application/json')
+    # Each encoding is a different representation, so it needs its own validator
+    response.set_etag(etag + (f'-{encoding}' if encoding else ''))
+    if encoding:
+        response.content_encoding = encoding
+    response.vary.add('Accept-Encoding')
+    if private:
+        response.vary.add('Cookie')
+    response.cache_control.private = private or None
+    response.cache_control.public = not private or None
+    # Clients may keep the body but must revalidate it; that is what the ETag is for
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def _digest(body):
+    return hashlib.sha256(body).hexdigest()[:32]
+
+
+def cached_json(view):
+    """Serve a public view's body from the cache under the items version stamp"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = cache.key('api', request.path, sorted(request.args.items(multi=True)))
+        hit = cache.backend.get(key)
+        if hit is None:
+            body = _dumps(view(*args, **kwargs))
+            hit = (body, _digest(body))
+            cache.backend.set(key, hit, cache.ttl)
+        return _respond(*hit)
+    return wrapper
+
+
+def private_json(view):
+    """Serve a view's body to its logged-in user only, without caching it"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not current_user.is_authenticated:
+            return jsonify(error='Authentication required'), 401
+        body = _dumps(view(*args, **kwargs))
+        return _respond(body, _digest(body), private=True)
+    return wrapper
+
+
+def _page(items, fields, row=_item_row):
+    return {'data': [_select(row(item), fields) for item in items.items], 'next': items.next_cursor}
+
+
+@api.route('/items')
+@query_budget(6)
+@cached_json
+def items():
+    fields = _fields(ITEM_FIELDS)
+    query = _items_query()
+    for name in ('category', 'rarity'):
+        if request.args.get(name):
+            query = query.filter(getattr(Item, name) == request.args[name])
+    if request.args.get('seller'):
+        query = query.filter(User.username == request.args['seller'], User.deleted_at.is_(None))
+
+    cursor = request.args.get('cursor')
+    if request.args.get('search'):
+        page = offset_paginate(search_items(query, request.args['search']), _limit(), cursor)
+    else:
+        page = keyset_paginate(query, (Item.created_at, Item.id), _limit(), cursor)
+    return _page(page, fields)
+
+
+@api.route('/items/<int:item_id>')
+@query_budget(1)
+@cached_json
+def item(item_id):
+    fields = _fields(ITEM_FIELDS)
+    row = _items_query().filter(Item.id == item_id).first()
+    if row is None:
+        abort(404)
+    return {'data': _select(_item_row(row, 'detail'), fields)}
+
+
+def _user_or_404(username):
+    user = db.session.execute(
+        select(User.id, User.username, User.avatar, User.created_at)
+        .where(User.username == username, User.deleted_at.is_(None))
+    ).first()
+    if user is None:
+        abort(404)
+    return user
+
+
+@api.route('/users/<username>')
+@query_budget(2)
+@cached_json
+def user(username):
+    fields = _fields(USER_FIELDS)
+    user = _user_or_404(username)
+    # Counted directly: the body is cached under the items version, which cached_count would outlive
+    item_count = Item.query.filter_by(seller_id=user.id).count()
+    return {'data': _select({
+        'id': user.id,
+        'username': user.username,
+        'avatar': image_url('avatars', user.avatar, 'avatar'),
+        'created_at': _timestamp(user.created_at),
+        'item_count': item_count,
+    }, fields)}
+
+
+@api.route('/users/<username>/items')
+@query_budget(2)
+@cached_json
+def user_items(username):
+    fields = _fields(ITEM_FIELDS)
+    user = _user_or_404(username)
+    query = _items_query().filter(Item.seller_id == user.id)
+    return _page(keyset_paginate(query, (Item.created_at, Item.id), _limit(), request.args.get('cursor')), fields)
+
+
+@api.route('/threads')
+@query_budget(2)
+@private_json
+def threads():
+    fields = _fields(THREAD_FIELDS)
+    other_id = func.coalesce(
+        func.nullif(Conversation.user_low_id, current_user.id), Conversation.user_high_id
+    ).label('other_user_id')
+    query = db.session.query(
+        ConversationMember.conversation_id, ConversationMember.unread_count, ConversationMember.last_activity,
+        Conversation.item_id, other_id, User.username.label('other_user'),
+        Message.content.label('last_message'),
+    ).select_from(ConversationMember).join(Conversation, Conversation.id == ConversationMember.conversation_id) \
+        .join(User, User.id == other_id) \
+        .outerjoin(Message, Message.id == Conversation.last_message_id) \
+        .filter(ConversationMember.user_id == current_user.id)
+    page = keyset_paginate(query, (ConversationMember.last_activity, ConversationMember.conversation_id),
+                           _limit(), request.args.get('cursor'))
+
+    def thread_row(row):
+        return {
+            'id': row.conversation_id,
+            'other_user_id': row.other_user_id,
+            'other_user': row.other_user,
+            'item_id': row.item_id,
+            'unread_count': row.unread_count,
+            'last_activity': _timestamp(row.last_activity),
+            'last_message': row.last_message,
+        }
+    return _page(page, fields, thread_row)
+
+
+@api.route('/threads/<int:other_user_id>/messages')
+@query_budget(3)
+@private_json
+def thread_messages(other_user_id):
+    fields = _fields(MESSAGE_FIELDS)
+    conversation = conversations.find(current_user.id, other_user_id)
+    if conversation is None:
+        abort(404)
+    messages, older = conversations.history(
+        conversation.id, _limit(), request.args.get('cursor'), archived_through=conversation.archived_through
+    )
+    return {'data': [_select(_message_row(message), fields) for message in reversed(messages)], 'next': older}
+
+
+@api.errorhandler(400)
+@api.errorhandler(404)
+def error(e):
+    return jsonify(error=e.description), e.code
@@ -0,0 +1,187 @@
+"""Hot and cold message storage.
+
+Inbox, sent, chat and the unread counters all query the ``message`` table, so
+it should hold recent conversation only. ``archive`` moves a message into
+``message_archive`` once it is older than ``MESSAGE_ARCHIVE_AFTER_DAYS`` or
+no longer among the newest ``MESSAGE_HOT_PER_CONVERSATION`` of its thread. The
+hot table and its indexes then stay small however much history accumulates.
+
+Two kinds of message always stay hot. Unread messages stay so
+``mark_read`` and the counters never look at the archive. A conversation's
+latest message stays so the inbox summary can join it. Every archived
+message is therefore read, and older than a hot message of the same thread.
+
+The move is ``INSERT ... SELECT`` plus ``DELETE`` for at most
+``MESSAGE_ARCHIVE_BATCH_SIZE`` rows per transaction, with a pause between
+batches. ``Conversation.archived_through`` records the newest archived
+timestamp, so ``conversations.history`` reads the archive only for pages
+that reach back that far. ``view_message`` and message deletion fall back to
+the archive by id. The sent page lists hot messages only; archived ones
+remain in their chat.
+
+After a message is written, the archiver starts in the background and runs
+every ``MESSAGE_ARCHIVE_INTERVAL`` seconds. ``flask messages-archive`` runs
+it by hand or from cron.
+"""
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import DateTime, delete, event, func, insert, literal, select, tuple_, update
+from sqlalchemy.orm import joinedload
+from app import db, socketio
+from app.models import ArchivedMessage, Conversation, Message
+
+# Columns copied from message to message_archive, in this order
+COLUMNS = ('id', 'sender_id', 'recipient_id', 'item_id', 'subject', 'content', 'timestamp', 'read',
+           'conversation_id', 'uid')
+
+
+def _movable():
+    """Messages that may leave the hot table"""
+    latest = select(Conversation.last_message_id).where(Conversation.last_message_id.isnot(None))
+    return select(Message.id, Message.conversation_id, Message.timestamp).where(
+        Message.conversation_id.isnot(None),
+        Message.read == True,
+        Message.id.notin_(latest),
+    )
+
+
+def _move(ids):
+    db.session.execute(insert(ArchivedMessage).from_select(
+        COLUMNS + ('archived_at',),
+        select(*[getattr(Message, name) for name in COLUMNS], literal(datetime.utcnow(), DateTime))
+        .where(Message.id.in_(ids))
+    ))
+    db.session.execute(delete(Message).where(Message.id.in_(ids)).execution_options(synchronize_session=False))
+
+
+def _advance_watermarks(rows):
+    newest = defaultdict(lambda: datetime.min)
+    for row in rows:
+        newest[row.conversation_id] = max(newest[row.conversation_id], row.timestamp)
+    for conversation_id, timestamp in newest.items():
+        db.session.execute(
+            update(Conversation)
+            .where(Conversation.id == conversation_id)
+            .where(Conversation.archived_through.is_(None) | (Conversation.archived_through < timestamp))
+            .values(archived_through=timestamp)
+            .execution_options(synchronize_session=False)
+        )
+
+
+def _drain(condition, batch_size, pause):
+    """Move every movable message matching ``condition``, one batch per transaction"""
+    moved = 0
+    while True:
+        rows = db.session.execute(_movable().where(condition).limit(batch_size)).all()
+        if not rows:
+            break
+        _move([row.id for row in rows])
+        _advance_watermarks(rows)
+        db.session.commit()
+        moved += len(rows)
+        # Unlike time.sleep, lets eventlet serve other clients during the pause
+        socketio.sleep(pause)
+    return moved
+
+
+def _crowded(keep):
+    """Ids of conversations with more than ``keep`` hot messages"""
+    return db.session.execute(
+        select(Message.conversation_id).where(Message.conversation_id.isnot(None))
+        .group_by(Message.conversation_id).having(func.count(Message.id) > keep)
+    ).scalars().all()
+
+
+def _boundary(conversation_id, keep):
+    """``(timestamp, id)`` of the oldest message among the newest ``keep``"""
+    return db.session.execute(
+        select(Message.timestamp, Message.id).where(Message.conversation_id == conversation_id)
+        .order_by(Message.timestamp.desc(), Message.id.desc()).offset(keep - 1).limit(1)
+    ).one()
+
+
+def archive(batch_size=None, pause=None):
+    """Move cold messages to the archive; returns how many were moved"""
+    config = current_app.config
+    batch_size = batch_size or config['MESSAGE_ARCHIVE_BATCH_SIZE']
+    pause = config['MESSAGE_ARCHIVE_PAUSE'] if pause is None else pause
+
+    moved = 0
+    if config['MESSAGE_ARCHIVE_AFTER_DAYS']:
+        cutoff = datetime.utcnow() - timedelta(days=config['MESSAGE_ARCHIVE_AFTER_DAYS'])
+        moved += _drain(Message.timestamp < cutoff, batch_size, pause)
+
+    keep = config['MESSAGE_HOT_PER_CONVERSATION']
+    if keep:
+        for conversation_id in _crowded(keep):
+            boundary = _boundary(conversation_id, keep)
+            moved += _drain(
+                (Message.conversation_id == conversation_id)
+                & (tuple_(Message.timestamp, Message.id) < tuple_(*boundary)),
+                batch_size, pause
+            )
+    return moved
+
+
+def find(message_id):
+    """An archived message with its sender, recipient and item, or None"""
+    return ArchivedMessage.query.options(
+        joinedload(ArchivedMessage.sender), joinedload(ArchivedMessage.recipient),
+        joinedload(ArchivedMessage.item)
+    ).filter_by(id=message_id).first()
+
+
+def history(conversation_id, limit, before=None):
+    """Up to ``limit`` archived messages of a conversation, newest first, older than ``before``"""
+    query = ArchivedMessage.query.filter_by(conversation_id=conversation_id)
+    if before is not None:
+        query = query.filter(tuple_(ArchivedMessage.timestamp, ArchivedMessage.id) < tuple_(*before))
+    return query.order_by(ArchivedMessage.timestamp.desc(), ArchivedMessage.id.desc()).limit(limit).all()
+
+
+class Archiver:
+    """Runs ``archive`` every ``MESSAGE_ARCHIVE_INTERVAL`` seconds once messages are written"""
+
+    def __init__(self):
+        self.app = None
+        self.lock = threading.Lock()
+        self.started = False
+
+    def init_app(self, app):
+        self.app = app
+
+    def start(self):
+        if self.app is None or not self.app.config['MESSAGE_ARCHIVE_INTERVAL']:
+            return
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        socketio.start_background_task(self._run)
+
+    def _run(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    archive()
+            except Exception:
+                # Messages simply stay hot until the next run
+                self.app.logger.exception('Message archival failed')
+            socketio.sleep(self.app.config['MESSAGE_ARCHIVE_INTERVAL'])
+
+
+archiver = Archiver()
+
+
+@event.listens_for(db.session, 'after_commit')
+def _start_after_commit(session):
+    if session.info.pop('messages_written', None):
+        archiver.start()
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_after_rollback(session):
+    session.info.pop('messages_written', None)
@@ -0,0 +1,173 @@
+"""Bulk import and streaming export of listings.
+
+Imports read CSV or NDJSON one row at a time. Each row is checked with the
+same ``ItemForm`` validators as ``create_item``, and rows are inserted in
+transactions of ``batch_size``. A failing row is reported with its line
+number and never blocks the rest of the file. A row's ``image`` column names
+a file inside the optional zip archive. Those files go through the regular
+upload pipeline, so renditions are built in the background after each batch
+commits.
+
+Exports page through the table with ``yield_per``, so memory use stays flat
+however many listings there are.
+"""
+import csv
+import io
+import json
+import os
+import zipfile
+
+from werkzeug.datastructures import FileStorage, MultiDict
+from app import db, images
+from app.forms import ItemForm
+from app.models import User, Item
+from app.pagination import invalidate_count
+
+FIELDS = ('name', 'description', 'category', 'rarity', 'image')
+EXPORT_FIELDS = ('id', 'name', 'description', 'category', 'rarity', 'image', 'seller', 'created_at')
+MAX_IMAGE_BYTES = 5 * 1024 * 1024
+
+
+class ImportReport:
+    def __init__(self):
+        self.created = 0
+        self.errors = []
+
+    def error(self, line, message):
+        self.errors.append((line, message))
+
+
+def detect_format(filename):
+    ext = os.path.splitext(filename or '')[1].lower()
+    return 'ndjson' if ext in ('.ndjson', '.jsonl', '.json') else 'csv'
+
+
+def iter_rows(stream, fmt):
+    """Yield ``(line number, dict or error message)`` from a binary stream"""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if fmt == 'csv':
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line_num, line in enumerate(text, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield line_num, f'Invalid JSON: {e}'
+            continue
+        yield line_num, row if isinstance(row, dict) else 'Expected a JSON object'
+
+
+def _allowed_image(name):
+    # Same extensions as ItemForm.image
+    allowed = ItemForm.image.kwargs['validators'][0].upload_set
+    return os.path.splitext(name)[1].lower().lstrip('.') in allowed
+
+
+def validate_row(row):
+    """Field errors for a row under ItemForm's rules, or an empty dict"""
+    data = MultiDict({key: str(row.get(key) or '').strip() for key in FIELDS if key != 'image'})
+    form = ItemForm(formdata=data, meta={'csrf': False})
+    form.validate()
+    return {name: errors for name, errors in form.errors.items() if name != 'image'}
+
+
+def _image_for(row, archive):
+    """Stored filename for the row's image, or raises ValueError"""
+    name = str(row.get('image') or '').strip()
+    if not name:
+        return 'default_item.png'
+    if archive is None:
+        raise ValueError(f'image "{name}" given but no image archive was uploaded')
+    if not _allowed_image(name):
+        raise ValueError(f'image "{name}" must be a jpg or png')
+    try:
+        info = archive.getinfo(name)
+    except KeyError:
+        raise ValueError(f'image "{name}" not found in the archive')
+    if info.file_size > MAX_IMAGE_BYTES:
+        raise ValueError(f'image "{name}" is larger than 5MB')
+    with archive.open(info) as f:
+        return images.save_upload(FileStorage(stream=io.BytesIO(f.read()), filename=name), 'items')
+
+
+def import_items(seller, rows, archive=None, batch_size=200):
+    """Create listings for ``seller`` from ``iter_rows`` output"""
+    report = ImportReport()
+    batch = []
+
+    def commit_batch():
+        try:
+            db.session.commit()
+            report.created += len(batch)
+        except Exception as e:
+            db.session.rollback()
+            for line_num in batch:
+                report.error(line_num, f'Not saved: {e.__class__.__name__}')
+        batch.clear()
+
+    for line_num, row in rows:
+        if isinstance(row, str):
+            report.error(line_num, row)
+            continue
+        errors = validate_row(row)
+        if errors:
+            report.error(line_num, '; '.join(f'{field}: {" ".join(msgs)}' for field, msgs in errors.items()))
+            continue
+        try:
+            image = _image_for(row, archive)
+        except (ValueError, zipfile.BadZipFile, OSError) as e:
+            report.error(line_num, str(e))
+            continue
+
+        db.session.add(Item(
+            name=row['name'].strip(),
+            description=row['description'].strip(),
+            category=row['category'].strip(),
+            rarity=row['rarity'].strip(),
+            image=image,
+            seller_id=seller.id
+        ))
+        batch.append(line_num)
+        if len(batch) >= batch_size:
+            commit_batch()
+    if batch:
+        commit_batch()
+
+    invalidate_count(('profile_items', seller.id))
+    return report
+
+
+def open_archive(file):
+    return zipfile.ZipFile(file) if file else None
+
+
+def export_items(fmt='csv', seller=None, chunk_size=500):
+    """Yield the export line by line; CSV starts with a header row"""
+    # Plain columns: no eager loads, and nothing piles up in the identity map
+    query = db.session.query(
+        Item.id, Item.name, Item.description, Item.category, Item.rarity,
+        Item.image, User.username, Item.created_at
+    ).join(User, Item.seller_id == User.id)
+    if seller is not None:
+        query = query.filter(Item.seller_id == seller.id)
+    query = query.order_by(Item.id).execution_options(yield_per=chunk_size)
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == 'csv':
+        writer.writerow(EXPORT_FIELDS)
+        yield buffer.getvalue()
+
+    for row in query:
+        values = tuple(row[:-1]) + (row.created_at.isoformat() if row.created_at else None,)
+        if fmt == 'csv':
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerow(values)
+            yield buffer.getvalue()
+        else:
+            yield json.dumps(dict(zip(EXPORT_FIELDS, values))) + '\n'
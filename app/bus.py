@@ -0,0 +1,103 @@
+"""Socket.IO message bus backends.
+
+``SOCKETIO_MESSAGE_QUEUE`` selects how emits reach clients that are
+connected to other workers:
+
+* unset              - in-process only (a single worker)
+* ``sqlite:///path`` - a SQLite file shared by every worker on one host
+* ``redis://...``    - any Redis-protocol server, for several hosts; needs the
+  optional ``redis`` package (``pip install -r requirements-redis.txt``)
+
+The SQLite bus is a python-socketio ``PubSubManager``: published packets are
+appended to a table that every worker tails by id.
+"""
+import json
+import sqlite3
+import time
+
+import socketio
+
+SQLITE_PREFIX = 'sqlite:///'
+REDIS_PREFIXES = ('redis://', 'rediss://', 'unix://')
+
+
+def sqlite_path(url):
+    return url[len(SQLITE_PREFIX):]
+
+
+def require_redis(setting):
+    """The ``redis`` module, or a clear error naming the setting that asked for it"""
+    try:
+        import redis
+    except ImportError:
+        raise RuntimeError(f'{setting} is a Redis URL, but the optional "redis" package is not installed; '
+                           'run: pip install -r requirements-redis.txt') from None
+    return redis
+
+
+def connect_sqlite(path):
+    """Autocommit connection tuned for several writer processes"""
+    conn = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+class SqliteManager(socketio.PubSubManager):
+    """Pub/sub over a shared SQLite file for workers on the same host"""
+    name = 'sqlite'
+
+    def __init__(self, url, channel='flask-socketio', write_only=False, logger=None,
+                 poll_interval=0.02, retention=60):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.path = sqlite_path(url)
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._publisher = None
+        self._published = 0
+        conn = connect_sqlite(self.path)
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS socketio_bus ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, channel TEXT NOT NULL, '
+            'payload TEXT NOT NULL, created REAL NOT NULL)'
+        )
+        conn.close()
+
+    def _publish(self, data):
+        if self._publisher is None:
+            self._publisher = connect_sqlite(self.path)
+        self._publisher.execute(
+            'INSERT INTO socketio_bus (channel, payload, created) VALUES (?, ?, ?)',
+            (self.channel, json.dumps(data), time.time())
+        )
+        self._published += 1
+        if self._published % 500 == 0:
+            self._publisher.execute(
+                'DELETE FROM socketio_bus WHERE created < ?', (time.time() - self.retention,)
+            )
+
+    def _listen(self):
+        conn = connect_sqlite(self.path)
+        last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM socketio_bus').fetchone()[0]
+        while True:
+            rows = conn.execute(
+                'SELECT id, payload FROM socketio_bus WHERE id > ? AND channel = ? ORDER BY id',
+                (last_id, self.channel)
+            ).fetchall()
+            for row_id, payload in rows:
+                last_id = row_id
+                yield payload
+            if not rows:
+                self.server.sleep(self.poll_interval)
+
+
+def create_manager(url, channel='flask-socketio'):
+    """Client manager for ``SOCKETIO_MESSAGE_QUEUE``; None keeps the in-process default"""
+    if not url:
+        return None
+    if url.startswith(SQLITE_PREFIX):
+        return SqliteManager(url, channel=channel)
+    if url.startswith(REDIS_PREFIXES):
+        require_redis('SOCKETIO_MESSAGE_QUEUE')
+        return socketio.RedisManager(url, channel=channel)
+    raise ValueError(f'Unsupported SOCKETIO_MESSAGE_QUEUE: {url}')
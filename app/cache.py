@@ -0,0 +1,258 @@
+"""Rendered-fragment cache for the browse pages.
+
+The item grids of ``index`` and ``marketplace`` are cached as HTML, keyed on
+the route and its filters. The rest of the page (``base.html``, with the
+current user's navigation and flashed messages) is still rendered on every
+request. Every key includes the ``items`` version stamp. Any commit that
+writes an Item, or changes a seller's name or avatar, bumps the stamp, so
+stale fragments are never read again and simply age out.
+
+``CACHE_URL`` selects the backend:
+
+* unset / ``memory`` - an in-process LRU with TTL
+* ``sqlite:///path`` - a SQLite file shared by workers on one host
+* ``redis://...``    - any Redis-protocol server (optional ``redis`` package)
+
+The memory backend keeps its version stamps in the process too, so a bump
+reaches only the worker that made it. With several workers, the others keep
+serving their stale grids until the TTL ends. Use a shared backend there.
+
+The shared backends store values as JSON, never pickle: anyone who can write
+to the store must not be able to run code in the app. ``dumps`` tags the few
+other types that cached values use (tuples, bytes, datetimes and dicts with
+non-string keys).
+"""
+import base64
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from markupsafe import Markup
+from sqlalchemy import event, inspect
+from app import db
+from app.models import User, Item
+from app.bus import REDIS_PREFIXES, SQLITE_PREFIX, connect_sqlite, require_redis, sqlite_path
+
+
+def _pack(value):
+    if isinstance(value, (str, int, float, bool, type(None))):
+        return value
+    if isinstance(value, list):
+        return [_pack(item) for item in value]
+    if isinstance(value, tuple):
+        return {'tuple': [_pack(item) for item in value]}
+    if isinstance(value, dict):
+        return {'dict': [[_pack(key), _pack(item)] for key, item in value.items()]}
+    if isinstance(value, bytes):
+        return {'bytes': base64.b64encode(value).decode('ascii')}
+    if isinstance(value, datetime):
+        return {'datetime': value.isoformat()}
+    raise TypeError(f'Cannot cache a {type(value).__name__}')
+
+
+def _unpack(data):
+    if isinstance(data, list):
+        return [_unpack(item) for item in data]
+    if not isinstance(data, dict):
+        return data
+    (tag, value), = data.items()
+    if tag == 'tuple':
+        return tuple(_unpack(item) for item in value)
+    if tag == 'dict':
+        return {_unpack(key): _unpack(item) for key, item in value}
+    if tag == 'bytes':
+        return base64.b64decode(value)
+    if tag == 'datetime':
+        return datetime.fromisoformat(value)
+    raise ValueError(f'Unknown cache value tag {tag!r}')
+
+
+def dumps(value):
+    """JSON text for a cached value"""
+    return json.dumps(_pack(value), separators=(',', ':'))
+
+
+def loads(text):
+    """A value stored by ``dumps``, or None (a miss) if it cannot be decoded"""
+    try:
+        return _unpack(json.loads(text))
+    except (ValueError, TypeError, KeyError):
+        return None
+
+
+class LRUCache:
+    """Bounded in-process cache; least recently used entries go first"""
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            hit = self.entries.get(key)
+            if hit is None:
+                return None
+            if hit[0] <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return hit[1]
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def version(self, name):
+        return self.versions.get(name, 0)
+
+    def bump(self, name):
+        with self.lock:
+            self.versions[name] = self.versions.get(name, 0) + 1
+            return self.versions[name]
+
+
+class SqliteCache:
+    def __init__(self, url):
+        self.lock = threading.Lock()
+        self.conn = connect_sqlite(sqlite_path(url))
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS fragment_cache ('
+            'key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL NOT NULL)'
+        )
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS cache_version (name TEXT PRIMARY KEY, version INTEGER NOT NULL)'
+        )
+        self.writes = 0
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT value FROM fragment_cache WHERE key = ? AND expires > ?', (key, time.time())
+            ).fetchone()
+        return loads(row[0]) if row else None
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO fragment_cache (key, value, expires) VALUES (?, ?, ?)',
+                (key, dumps(value), now + ttl)
+            )
+            self.writes += 1
+            if self.writes % 200 == 0:
+                self.conn.execute('DELETE FROM fragment_cache WHERE expires <= ?', (now,))
+
+    def delete(self, key):
+        with self.lock:
+            self.conn.execute('DELETE FROM fragment_cache WHERE key = ?', (key,))
+
+    def version(self, name):
+        with self.lock:
+            row = self.conn.execute('SELECT version FROM cache_version WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else 0
+
+    def bump(self, name):
+        with self.lock:
+            return self.conn.execute(
+                'INSERT INTO cache_version (name, version) VALUES (?, 1) '
+                'ON CONFLICT (name) DO UPDATE SET version = version + 1 RETURNING version',
+                (name,)
+            ).fetchone()[0]
+
+
+class RedisCache:
+    def __init__(self, url, client=None):
+        self.redis = client or require_redis('CACHE_URL').Redis.from_url(url)
+
+    def get(self, key):
+        value = self.redis.get(f'cache:{key}')
+        return loads(value) if value is not None else None
+
+    def set(self, key, value, ttl):
+        self.redis.set(f'cache:{key}', dumps(value), ex=int(ttl) or 1)
+
+    def delete(self, key):
+        self.redis.delete(f'cache:{key}')
+
+    def version(self, name):
+        return int(self.redis.get(f'cache_version:{name}') or 0)
+
+    def bump(self, name):
+        return self.redis.incr(f'cache_version:{name}')
+
+
+def create_backend(url, max_entries=1024):
+    if not url or url == 'memory':
+        return LRUCache(max_entries)
+    if url.startswith(SQLITE_PREFIX):
+        return SqliteCache(url)
+    if url.startswith(REDIS_PREFIXES):
+        return RedisCache(url)
+    raise ValueError(f'Unsupported CACHE_URL: {url}')
+
+
+class FragmentCache:
+    def __init__(self):
+        self.backend = LRUCache()
+        self.ttl = 300
+
+    def init_app(self, app):
+        self.backend = create_backend(app.config['CACHE_URL'], app.config['CACHE_MAX_ENTRIES'])
+        self.ttl = app.config['CACHE_DEFAULT_TTL']
+
+    def key(self, name, *parts):
+        digest = hashlib.sha1(repr(parts).encode()).hexdigest()
+        return f'{name}:{self.backend.version("items")}:{digest}'
+
+    def fragment(self, name, parts, render, ttl=None):
+        """Cached HTML for ``name`` and ``parts``, produced by ``render()`` on a miss"""
+        key = self.key(name, *parts)
+        html = self.backend.get(key)
+        if html is None:
+            html = render()
+            self.backend.set(key, html, ttl or self.ttl)
+        return Markup(html)
+
+    def bump(self, name='items'):
+        return self.backend.bump(name)
+
+    def bump_after_commit(self):
+        """Bump the items version once the current transaction commits (for bulk SQL)"""
+        db.session.info['cache_bump'] = True
+
+
+cache = FragmentCache()
+
+
+@event.listens_for(db.session, 'after_flush')
+def _track_item_writes(session, flush_context):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Item) or (
+            isinstance(obj, User) and (inspect(obj).attrs.username.history.has_changes()
+                                       or inspect(obj).attrs.avatar.history.has_changes())
+        ):
+            session.info['cache_bump'] = True
+            return
+
+
+@event.listens_for(db.session, 'after_commit')
+def _bump_after_commit(session):
+    if session.info.pop('cache_bump', None):
+        cache.bump()
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_after_rollback(session):
+    session.info.pop('cache_bump', None)
@@ -0,0 +1,284 @@
+"""Write-behind persistence for real-time chat messages.
+
+With ``CHAT_WRITE_BEHIND`` enabled, ``handle_send_message`` gives each message
+a ``uid`` and emits it straight away; a background task then stores queued
+messages in batches, one transaction (and one fsync) per batch. Rows wait in
+memory for at most about ``CHAT_WRITE_FLUSH_INTERVAL``; a crash in that window
+loses them.
+
+When a batch fails on a transient database error (a lock, a lost
+connection), the whole batch is appended to ``CHAT_WRITE_SPOOL`` at once and
+fsynced. When it fails for any other reason, it is split and each row is
+written on its own, so one bad row never holds up the rest. Rows that still
+fail are logged and appended to ``CHAT_WRITE_DEAD_LETTER`` with their error,
+for someone to look at, as are spool lines that cannot be decoded. The spool is replayed when the writer starts (at app
+start if a spool is left over) and again after each backoff, and is only
+removed once its rows are stored. Inserts skip uids that already exist, so
+replays never duplicate a message. Several workers may share a spool; one
+whose spool was taken or finished by another simply finds nothing to replay.
+An unexpected error is logged and the loop carries on, so queued rows are
+never left without a writer.
+"""
+import atexit
+import json
+import os
+import queue
+import time
+from datetime import datetime
+
+from sqlalchemy import insert, update
+from sqlalchemy.exc import InterfaceError, OperationalError
+from app import db, socketio, unread, conversations
+from app.models import Message, Conversation, ConversationMember
+
+# Failures worth retrying later; anything else is a problem with the rows themselves
+TRANSIENT_ERRORS = (OperationalError, InterfaceError)
+MAX_BACKOFF = 30.0  # seconds between spool replays while the database is unavailable
+
+
+class ChatWriter:
+    def __init__(self):
+        self.app = None
+        self.queue = None
+        self.started = False
+        self.running = False
+        self.backoff = 0
+        self.replay_at = 0
+
+    def init_app(self, app):
+        self.app = app
+        self.queue = queue.Queue(maxsize=app.config['CHAT_WRITE_QUEUE_SIZE'])
+        self.backoff = app.config['CHAT_WRITE_FLUSH_INTERVAL']
+        if self.enabled and self._spooled():
+            # Messages spooled by an earlier process should not wait for the next chat message
+            self.start()
+
+    @property
+    def enabled(self):
+        return self.app is not None and self.app.config['CHAT_WRITE_BEHIND']
+
+    def submit(self, row):
+        """Queue a message row (a dict of Message columns) for persistence
+
+        Returns False when the queue is full; the caller should then write the
+        message synchronously.
+        """
+        if not self.started:
+            self.start()
+        try:
+            self.queue.put_nowait(row)
+        except queue.Full:
+            return False
+        return True
+
+    def start(self):
+        if self.started:
+            return
+        self.started = self.running = True
+        atexit.register(self.stop)
+        socketio.start_background_task(self._run)
+
+    def stop(self):
+        """Stop the writer and flush everything still queued"""
+        if not self.started:
+            return
+        self.running = False
+        self.flush()
+        self.started = False
+
+    def flush(self):
+        """Synchronously persist every queued message, spooling what cannot be written"""
+        rows = self._drain(None)
+        if rows:
+            self._write(rows)
+
+    def _drain(self, limit):
+        rows = []
+        while limit is None or len(rows) < limit:
+            try:
+                rows.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return rows
+
+    def _run(self):
+        config = self.app.config
+        while self.running:
+            try:
+                if time.monotonic() >= self.replay_at:
+                    self.replay_spool()
+                batch = self._drain(config['CHAT_WRITE_BATCH_SIZE'])
+                if batch:
+                    self._write(batch)
+                    continue
+            except Exception:
+                self.app.logger.exception('Chat writer pass failed')
+            socketio.sleep(config['CHAT_WRITE_FLUSH_INTERVAL'])
+
+    def _write(self, rows):
+        """Persist ``rows``, dead-lettering rows that cannot be stored
+
+        Returns False if the database was unavailable; the rows not yet
+        stored are then in the spool.
+        """
+        try:
+            self._persist(rows)
+            self.backoff = self.app.config['CHAT_WRITE_FLUSH_INTERVAL']
+            return True
+        except TRANSIENT_ERRORS:
+            self.app.logger.exception('Chat writer batch of %d failed; spooling', len(rows))
+            return self._postpone(rows)
+        except Exception as error:
+            if len(rows) == 1:
+                self._dead_letter(rows[0], error)
+                return True
+            self.app.logger.exception('Chat writer batch of %d failed; writing rows one by one', len(rows))
+
+        for i, row in enumerate(rows):
+            try:
+                self._persist([row])
+            except TRANSIENT_ERRORS:
+                self.app.logger.exception('Chat writer lost the database; spooling %d rows', len(rows) - i)
+                return self._postpone(rows[i:])
+            except Exception as error:
+                self._dead_letter(row, error)
+        return True
+
+    def _postpone(self, rows):
+        """Spool ``rows`` and replay the spool after a growing backoff"""
+        self._spool(rows)
+        self.replay_at = time.monotonic() + self.backoff
+        self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+        return False
+
+    def _persist(self, rows):
+        with self.app.app_context():
+            try:
+                write_batch(rows)
+            except Exception:
+                db.session.rollback()
+                raise
+
+    def _dead_letter(self, row, error):
+        self.app.logger.exception('Chat message %s cannot be stored; moved to the dead-letter file', row['uid'])
+        self._append(self.app.config['CHAT_WRITE_DEAD_LETTER'], [row], error=repr(error))
+
+    def _dead_letter_line(self, line, error):
+        self.app.logger.error('Undecodable chat spool line moved to the dead-letter file: %r', error)
+        self._append(self.app.config['CHAT_WRITE_DEAD_LETTER'], [{'line': line}], error=repr(error))
+
+    def _spool(self, rows):
+        self._append(self.app.config['CHAT_WRITE_SPOOL'], rows)
+
+    @staticmethod
+    def _append(path, rows, **extra):
+        with open(path, 'a') as f:
+            for row in rows:
+                f.write(json.dumps(dict(row, **extra), default=datetime.isoformat) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _spooled(self):
+        path = self.app.config['CHAT_WRITE_SPOOL']
+        return os.path.exists(path) or os.path.exists(path + '.replay')
+
+    def replay_spool(self):
+        """Write spooled messages in batches; returns how many were read back"""
+        path = self.app.config['CHAT_WRITE_SPOOL']
+        processing = path + '.replay'
+        # A .replay file is left by a process that stopped mid-replay; finish it first
+        try:
+            if not os.path.exists(processing):
+                # New failures go to a fresh spool while this one is replayed
+                os.replace(path, processing)
+            with open(processing) as f:
+                lines = [line.rstrip('\n') for line in f if line.strip()]
+        except FileNotFoundError:
+            # No spool, or another worker took it first
+            return 0
+        rows = []
+        for line in lines:
+            try:
+                row = json.loads(line)
+                row['timestamp'] = datetime.fromisoformat(row['timestamp'])
+            except (ValueError, TypeError, KeyError) as error:
+                # A line cut short by a crash, for example
+                self._dead_letter_line(line, error)
+                continue
+            rows.append(row)
+
+        batch_size = self.app.config['CHAT_WRITE_BATCH_SIZE']
+        for start in range(0, len(rows), batch_size):
+            if not self._write(rows[start:start + batch_size]):
+                # Still unavailable; keep the rest for the next replay too
+                self._spool(rows[start + batch_size:])
+                break
+        # Every row is now stored, spooled again or dead-lettered
+        try:
+            os.remove(processing)
+        except FileNotFoundError:
+            pass
+        return len(rows)
+
+
+def write_batch(rows):
+    """Insert a batch of message rows and update conversations in one transaction"""
+    existing = {uid for (uid,) in db.session.query(Message.uid).filter(
+        Message.uid.in_([row['uid'] for row in rows])
+    )}
+    rows = [row for row in rows if row['uid'] not in existing]
+    if not rows:
+        return
+
+    for row in rows:
+        conversation = conversations.get_or_create(row['sender_id'], row['recipient_id'], row['item_id'])
+        row['conversation_id'] = conversation.id
+
+    inserted = db.session.execute(
+        insert(Message).returning(Message.id, Message.uid), rows
+    ).all()
+    ids = dict((uid, id) for id, uid in inserted)
+
+    # One summary update per conversation and one counter update per recipient
+    latest = {}
+    unread_counts = {}
+    for row in rows:
+        key = row['conversation_id']
+        if key not in latest or row['timestamp'] >= latest[key]['timestamp']:
+            latest[key] = row
+        pair = (key, row['recipient_id'])
+        unread_counts[pair] = unread_counts.get(pair, 0) + 1
+
+    for conversation_id, row in latest.items():
+        values = {'last_message_id': ids[row['uid']], 'last_activity': row['timestamp']}
+        if row['item_id']:
+            values['item_id'] = row['item_id']
+        db.session.execute(
+            update(Conversation).where(Conversation.id == conversation_id).values(**values)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.execute(
+            update(ConversationMember)
+            .where(ConversationMember.conversation_id == conversation_id)
+            .values(last_activity=row['timestamp'])
+            .execution_options(synchronize_session=False)
+        )
+
+    per_user = {}
+    for (conversation_id, recipient_id), count in unread_counts.items():
+        db.session.execute(
+            update(ConversationMember)
+            .where(ConversationMember.conversation_id == conversation_id,
+                   ConversationMember.user_id == recipient_id)
+            .values(unread_count=ConversationMember.unread_count + count)
+            .execution_options(synchronize_session=False)
+        )
+        per_user[recipient_id] = per_user.get(recipient_id, 0) + count
+    for recipient_id, count in per_user.items():
+        unread.adjust(recipient_id, count)
+
+    db.session.info['messages_written'] = True
+    db.session.commit()
+
+
+writer = ChatWriter()
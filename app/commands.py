@@ -0,0 +1,130 @@
+import click
+from app import db, database, migrations, explain, search, unread, conversations, archive, images, bulk, \
+    facets, purge, recommend
+from app.models import User
+
+
+def register_commands(app):
+    @app.cli.command('db-upgrade')
+    def db_upgrade():
+        """Apply pending schema migrations."""
+        applied = migrations.upgrade()
+        for version, name in applied:
+            click.echo(f'Applied {version}: {name}')
+        click.echo(f'Database is at version {migrations.LATEST}')
+
+    @app.cli.command('db-status')
+    def db_status():
+        """Show the schema version and any pending migrations."""
+        version = migrations.current_version()
+        click.echo('Database is empty' if version is None else f'Database is at version {version}')
+        for number, name, _ in migrations.pending():
+            click.echo(f'Pending {number}: {name}')
+
+    @app.cli.command('db-explain')
+    @click.option('--verbose', '-v', is_flag=True, help='Print every plan, not just failures.')
+    def db_explain(verbose):
+        """Check that the listing pages' queries are served by indexes."""
+        results = explain.check()
+        failures = [result for result in results if not result.ok]
+        for result in results:
+            if verbose or not result.ok:
+                status = 'ok' if result.ok else 'FAILED: ' + ', '.join(result.problems)
+                click.echo(f'[{result.label}] {status}\n  {" ".join(result.statement.split())}')
+                for line in result.plan:
+                    click.echo(f'    {line}')
+        click.echo(f'{len(results)} queries checked, {len(failures)} with full scans or sorts')
+        if failures:
+            raise SystemExit(1)
+
+    @app.cli.command('db-replica-sync')
+    def db_replica_sync():
+        """Copy a SQLite primary into the SQLite files in DATABASE_REPLICA_URLS."""
+        try:
+            count = database.sync_sqlite_replicas(db)
+        except RuntimeError as e:
+            raise click.ClickException(str(e))
+        click.echo(f'Copied the primary into {count} replicas')
+
+    @app.cli.command('search-rebuild')
+    def search_rebuild():
+        """Rebuild the marketplace full-text search index."""
+        search.rebuild_index()
+        click.echo('Search index rebuilt')
+
+    @app.cli.command('unread-recount')
+    def unread_recount():
+        """Recompute every user's unread-message counter."""
+        unread.recount()
+        click.echo('Unread counters recomputed')
+
+    @app.cli.command('purge')
+    @click.option('--batch-size', type=int, help='Rows per transaction (default PURGE_BATCH_SIZE).')
+    def purge_deleted(batch_size):
+        """Remove soft-deleted items and accounts with everything they own."""
+        removed = purge.purge(batch_size)
+        click.echo('Purged ' + (', '.join(f'{count} {name}' for name, count in removed.items()) or 'nothing'))
+
+    @app.cli.command('messages-archive')
+    @click.option('--batch-size', type=int, help='Rows per transaction (default MESSAGE_ARCHIVE_BATCH_SIZE).')
+    def messages_archive(batch_size):
+        """Move old read messages from the message table to the archive."""
+        moved = archive.archive(batch_size)
+        click.echo(f'Archived {moved} messages')
+
+    @app.cli.command('facets-reconcile')
+    def facets_reconcile():
+        """Recompute the marketplace filter counts from the item table."""
+        count = facets.reconcile()
+        click.echo(f'Corrected {count} facet counts')
+
+    @app.cli.command('recommend-rebuild')
+    def recommend_rebuild():
+        """Recompute the similar-items and same-seller lists for every listing."""
+        count = recommend.rebuild()
+        click.echo(f'Indexed {count} listings')
+
+    @app.cli.command('conversations-backfill')
+    def conversations_backfill():
+        """Group messages written before conversations existed into threads."""
+        count = conversations.backfill()
+        click.echo(f'Updated {count} conversations')
+
+    @app.cli.command('images-reprocess')
+    def images_reprocess():
+        """Render uploads that are still waiting for their renditions."""
+        count = images.reprocess_pending()
+        images.shutdown()
+        click.echo(f'Processed {count} uploads')
+
+    @app.cli.command('items-import')
+    @click.argument('listings', type=click.File('rb'))
+    @click.option('--seller', required=True, help='Username that will own the listings.')
+    @click.option('--images', 'images_zip', type=click.Path(exists=True, dir_okay=False),
+                  help='Zip archive with the files named in the image column.')
+    @click.option('--batch-size', default=200, show_default=True)
+    def items_import(listings, seller, images_zip, batch_size):
+        """Create listings from a CSV or NDJSON file."""
+        user = User.query.filter_by(username=seller).first()
+        if user is None:
+            raise click.BadParameter(f'no user named {seller}', param_hint='--seller')
+        rows = bulk.iter_rows(listings, bulk.detect_format(listings.name))
+        report = bulk.import_items(user, rows, bulk.open_archive(images_zip), batch_size)
+        images.shutdown()
+        for line_num, message in report.errors:
+            click.echo(f'line {line_num}: {message}', err=True)
+        click.echo(f'Imported {report.created} items, {len(report.errors)} rows rejected')
+
+    @app.cli.command('items-export')
+    @click.option('--seller', help='Only this user\'s listings.')
+    @click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']), default='csv', show_default=True)
+    @click.option('--output', '-o', type=click.File('w'), default='-')
+    def items_export(seller, fmt, output):
+        """Write listings as CSV or NDJSON without loading them all into memory."""
+        user = None
+        if seller:
+            user = User.query.filter_by(username=seller).first()
+            if user is None:
+                raise click.BadParameter(f'no user named {seller}', param_hint='--seller')
+        for chunk in bulk.export_items(fmt, user):
+            output.write(chunk)
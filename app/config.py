@@ -13,9 +13,94 @@ class Config:
     
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     
+    # Engine tuning: sqlite, sqlite-durable, postgresql or postgresql-pgbouncer (unset: from the URL)
+    DB_PROFILE = os.environ.get('DB_PROFILE')
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 10))
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 20))
+    DB_STATEMENT_TIMEOUT = int(os.environ.get('DB_STATEMENT_TIMEOUT', 5000))  # ms, PostgreSQL only
+    # Comma-separated read replicas for @replica_reads views
+    DATABASE_REPLICA_URLS = [url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url]
+    REPLICA_STICKY_SECONDS = 5  # a user reads from the primary this long after their own write
+    
     UPLOAD_FOLDER = os.path.join(basedir, 'app/static/uploads')
     MAX_CONTENT_LENGTH = 5 * 1024 * 1024  # 5MB
+    IMPORT_MAX_CONTENT_LENGTH = 200 * 1024 * 1024  # bulk listing files plus image zips
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+    # How /uploads/ sends files: direct, x-accel-redirect (nginx) or x-sendfile (Apache/lighttpd)
+    UPLOADS_SERVE_MODE = os.environ.get('UPLOADS_SERVE_MODE', 'direct')
+    UPLOADS_ACCEL_PREFIX = os.environ.get('UPLOADS_ACCEL_PREFIX', '/_uploads/')  # nginx internal location
+    UPLOADS_FALLBACK_MAX_AGE = 3600  # seconds, for names that are not content addressed
+    # Removal of soft-deleted items and accounts (app/purge.py)
+    PURGE_IN_BACKGROUND = os.environ.get('PURGE_IN_BACKGROUND', '1').lower() in ('1', 'true', 'yes')
+    PURGE_BATCH_SIZE = 500  # rows per transaction
+    PURGE_PAUSE = 0.05  # seconds between batches, so other writers get the lock
+    # Moving old read messages to message_archive (app/archive.py); 0 disables a rule
+    MESSAGE_ARCHIVE_AFTER_DAYS = int(os.environ.get('MESSAGE_ARCHIVE_AFTER_DAYS', 180))
+    MESSAGE_HOT_PER_CONVERSATION = int(os.environ.get('MESSAGE_HOT_PER_CONVERSATION', 500))
+    MESSAGE_ARCHIVE_INTERVAL = int(os.environ.get('MESSAGE_ARCHIVE_INTERVAL', 3600))  # seconds; 0 = cron only
+    MESSAGE_ARCHIVE_BATCH_SIZE = 500  # rows per transaction
+    MESSAGE_ARCHIVE_PAUSE = 0.05  # seconds between batches
+    # "Similar items" and "more from this seller" lists (app/recommend.py)
+    RECOMMEND_IN_BACKGROUND = os.environ.get('RECOMMEND_IN_BACKGROUND', '1').lower() in ('1', 'true', 'yes')
+    RECOMMEND_TOP_K = 4  # listings per list
+    RECOMMEND_CANDIDATES = 500  # newest listings of a category or seller compared on each change
+    RECOMMEND_REBUILD_AT = 500  # changed listings at which a full rebuild is cheaper
+    # Background image processes; 0 renders uploads inline after commit
+    IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', 2))
+    
+    # Write-behind batching for chat messages sent over Socket.IO
+    CHAT_WRITE_BEHIND = os.environ.get('CHAT_WRITE_BEHIND', '').lower() in ('1', 'true', 'yes')
+    CHAT_WRITE_BATCH_SIZE = 200
+    CHAT_WRITE_FLUSH_INTERVAL = 0.05  # seconds
+    CHAT_WRITE_QUEUE_SIZE = 10000
+    CHAT_WRITE_SPOOL = os.path.join(basedir, 'chat_spool.ndjson')  # batches waiting for the database
+    CHAT_WRITE_DEAD_LETTER = os.path.join(basedir, 'chat_dead_letter.ndjson')  # rows it rejected
+    
+    # Socket.IO across several workers: unset (single process),
+    # sqlite:///path (workers on one host) or redis://host:port/0 (requirements-redis.txt)
+    SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+    # Shared presence store; follows the message queue unless set
+    PRESENCE_URL = os.environ.get('PRESENCE_URL') or SOCKETIO_MESSAGE_QUEUE
+    PRESENCE_TTL = 45  # seconds without a heartbeat before a user is offline
+    PRESENCE_HEARTBEAT = 15
+    PRESENCE_COALESCE = 2.0  # seconds to absorb reconnects before announcing
+    PRESENCE_MAX_SUBSCRIPTIONS = 200  # users one presence query may cover
+    
+    # Rendered item grids: unset/memory (per-process LRU), sqlite:///path or redis://...
+    CACHE_URL = os.environ.get('CACHE_URL')
+    CACHE_DEFAULT_TTL = 300  # seconds
+    CACHE_MAX_ENTRIES = 1024
+    # JSON API under /api/v1 (app/api.py)
+    API_PAGE_SIZE = 20
+    API_MAX_PAGE_SIZE = 100
+    API_COMPRESS_MIN_SIZE = 512  # bytes; smaller bodies are sent uncompressed
+    
+    # Password hashing: 'bcrypt' or a werkzeug method such as 'scrypt'.
+    # Hashes made with other settings are upgraded on the next login.
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'bcrypt')
+    BCRYPT_LOG_ROUNDS = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+    BCRYPT_HANDLE_LONG_PASSWORDS = True
+    
+    # Seconds a loaded user is reused before reading the row again; 0 disables
+    IDENTITY_CACHE_TTL = int(os.environ.get('IDENTITY_CACHE_TTL', 30))
+    
+    # Chat messages rendered up front and fetched per scroll-back page
+    CHAT_PAGE_SIZE = 30
+    
+    # Typing indicators: a burst ends after this long without keystrokes
+    TYPING_TIMEOUT = 5.0  # seconds
+    TYPING_TICK = 0.25  # how often queued typing changes are emitted
+    
+    # Prometheus-format /metrics; a 404 unless requested with METRICS_TOKEN as a bearer token
+    METRICS_ENABLED = True
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    # ?_profile=1 with the METRICS_TOKEN bearer token returns sampled stacks instead of the page
+    PROFILER_ENABLED = os.environ.get('PROFILER_ENABLED', '').lower() in ('1', 'true', 'yes')
+    PROFILER_INTERVAL = 0.005  # seconds between samples
+    
+    # SQL statement budgets per request: None (off), 'warn' or 'raise'
+    QUERY_BUDGET_MODE = os.environ.get('QUERY_BUDGET_MODE')
+    QUERY_BUDGET_DEFAULT = None
 
 
 
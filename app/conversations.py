@@ -0,0 +1,300 @@
+"""Conversation bookkeeping.
+
+Every message belongs to the conversation of its (sender, recipient) pair.
+The conversation keeps a pointer to its latest message, and each participant's
+ConversationMember row keeps their unread count and last activity. The inbox
+is then one indexed scan over ``(user_id, last_activity)`` and chat history a
+range scan over ``(conversation_id, timestamp)``. Older history may live in
+the message archive (see app/archive.py), which ``history`` reads as well.
+"""
+import re
+from datetime import datetime
+
+from sqlalchemy import case, func, or_, and_, tuple_, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.attributes import set_committed_value
+from app import db, unread, archive
+from app.models import ArchivedMessage, Conversation, ConversationMember, Message
+from app.pagination import encode_cursor, decode_cursor
+
+HISTORY_ORDER = (Message.timestamp, Message.id)
+CHAT_ROOM = re.compile(r'^chat_(\d+)_(\d+)$')
+
+
+def _pair(user_a, user_b):
+    return (user_a, user_b) if user_a <= user_b else (user_b, user_a)
+
+
+def chat_room(user_a, user_b):
+    """Socket.IO room of the chat between two users"""
+    return 'chat_%d_%d' % _pair(user_a, user_b)
+
+
+def in_chat_room(room, user_id):
+    """True if ``room`` is the chat room of a pair that includes ``user_id``"""
+    match = CHAT_ROOM.match(room) if isinstance(room, str) else None
+    if match is None:
+        return False
+    low, high = int(match.group(1)), int(match.group(2))
+    return room == chat_room(low, high) and user_id in (low, high)
+
+
+def _clamped(column, delta):
+    return case((column + delta < 0, 0), else_=column + delta)
+
+
+def _greatest(a, b):
+    # Portable GREATEST(); SQLite only has the two-argument max()
+    return case((a >= b, a), else_=b)
+
+
+def _adjust_member(conversation_id, user_id, delta):
+    db.session.execute(
+        update(ConversationMember)
+        .where(ConversationMember.conversation_id == conversation_id,
+               ConversationMember.user_id == user_id)
+        .values(unread_count=_clamped(ConversationMember.unread_count, delta))
+        .execution_options(synchronize_session=False)
+    )
+
+
+def find(user_a, user_b):
+    low, high = _pair(user_a, user_b)
+    return Conversation.query.filter_by(user_low_id=low, user_high_id=high).first()
+
+
+def get_or_create(user_a, user_b, item_id=None):
+    conversation = find(user_a, user_b)
+    if conversation:
+        return conversation
+
+    low, high = _pair(user_a, user_b)
+    try:
+        with db.session.begin_nested():
+            conversation = Conversation(user_low_id=low, user_high_id=high, item_id=item_id)
+            conversation.members = [ConversationMember(user_id=user_id) for user_id in {low, high}]
+            db.session.add(conversation)
+    except IntegrityError:
+        # Another request created the same pair first
+        conversation = find(user_a, user_b)
+    return conversation
+
+
+def add_message(message):
+    """Add a new message to the session and update its conversation summary"""
+    conversation = get_or_create(message.sender_id, message.recipient_id, message.item_id)
+    message.conversation_id = conversation.id
+    message.timestamp = message.timestamp or datetime.utcnow()
+    db.session.add(message)
+    db.session.flush()
+
+    values = {'last_message_id': message.id, 'last_activity': message.timestamp}
+    if message.item_id:
+        values['item_id'] = message.item_id
+    db.session.execute(
+        update(Conversation).where(Conversation.id == conversation.id).values(**values)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.execute(
+        update(ConversationMember)
+        .where(ConversationMember.conversation_id == conversation.id)
+        .values(
+            last_activity=message.timestamp,
+            unread_count=case(
+                (ConversationMember.user_id == message.recipient_id, ConversationMember.unread_count + 1),
+                else_=ConversationMember.unread_count
+            )
+        )
+        .execution_options(synchronize_session=False)
+    )
+    unread.adjust(message.recipient_id, 1)
+    db.session.info['messages_written'] = True
+    return conversation
+
+
+def message_id(conversation_id, uid):
+    """Id of the stored message with ``uid``, or None while it is still queued"""
+    return db.session.query(Message.id).filter_by(conversation_id=conversation_id, uid=uid).scalar()
+
+
+def mark_read(conversation_id, user_id, up_to=None):
+    """Mark unread messages to ``user_id`` as read, up to message id ``up_to`` if given
+
+    One UPDATE for the messages and one for the member row, which also
+    advances the member's read watermark. Returns the number of messages marked.
+    """
+    stmt = update(Message).where(
+        Message.conversation_id == conversation_id,
+        Message.recipient_id == user_id,
+        Message.read == False
+    )
+    if up_to is not None:
+        stmt = stmt.where(Message.id <= up_to)
+    result = db.session.execute(
+        stmt.values(read=True).execution_options(synchronize_session=False)
+    )
+    
+    watermark = up_to if up_to is not None else db.session.query(func.max(Message.id)).filter(
+        Message.conversation_id == conversation_id
+    ).scalar_subquery()
+    db.session.execute(
+        update(ConversationMember)
+        .where(ConversationMember.conversation_id == conversation_id,
+               ConversationMember.user_id == user_id)
+        .values(
+            unread_count=_clamped(ConversationMember.unread_count, -result.rowcount),
+            last_read_message_id=_greatest(func.coalesce(ConversationMember.last_read_message_id, 0), watermark)
+        )
+        .execution_options(synchronize_session=False)
+    )
+    unread.adjust(user_id, -result.rowcount)
+    return result.rowcount
+
+
+def mark_message_read(message):
+    """Mark one message read; returns False if another request already did
+
+    The UPDATE only matches an unread row, so two concurrent readers never
+    both decrement the counters.
+    """
+    result = db.session.execute(
+        update(Message).where(Message.id == message.id, Message.read == False)
+        .values(read=True).execution_options(synchronize_session=False)
+    )
+    set_committed_value(message, 'read', True)
+    if result.rowcount != 1:
+        return False
+    if message.conversation_id:
+        _adjust_member(message.conversation_id, message.recipient_id, -1)
+    unread.adjust(message.recipient_id, -1)
+    return True
+
+
+def forget_messages(messages_query):
+    """Update counters for messages that are about to be deleted
+
+    Returns the ids of the affected conversations so their last-message
+    pointers can be refreshed once the delete has been flushed.
+    """
+    rows = messages_query.filter(Message.read == False).with_entities(
+        Message.conversation_id, Message.recipient_id, func.count(Message.id)
+    ).group_by(Message.conversation_id, Message.recipient_id).all()
+    per_user = {}
+    for conversation_id, recipient_id, count in rows:
+        if conversation_id:
+            _adjust_member(conversation_id, recipient_id, -count)
+        per_user[recipient_id] = per_user.get(recipient_id, 0) + count
+    for recipient_id, count in per_user.items():
+        unread.adjust(recipient_id, -count)
+
+    return {
+        conversation_id for (conversation_id,) in
+        messages_query.with_entities(Message.conversation_id).distinct()
+        if conversation_id
+    }
+
+
+def remove_message(message):
+    """Delete a message, keeping unread counts and the thread summary correct"""
+    if isinstance(message, ArchivedMessage):
+        # Always read and never a thread's latest, so there is nothing to update
+        db.session.delete(message)
+        return
+    conversation_ids = forget_messages(Message.query.filter_by(id=message.id))
+    db.session.delete(message)
+    db.session.flush()
+    refresh(conversation_ids)
+
+
+def refresh(conversation_ids):
+    """Repoint conversations at their latest remaining message"""
+    for conversation_id in conversation_ids:
+        latest = Message.query.filter_by(conversation_id=conversation_id).order_by(
+            Message.timestamp.desc(), Message.id.desc()
+        ).with_entities(Message.id).first()
+        db.session.execute(
+            update(Conversation).where(Conversation.id == conversation_id)
+            .values(last_message_id=latest.id if latest else None)
+            .execution_options(synchronize_session=False)
+        )
+
+
+def history(conversation_id, limit=50, cursor=None, archived_through=None):
+    """A page of a conversation's messages, oldest first, plus a cursor for older ones
+
+    Without ``cursor`` this is the latest ``limit`` messages. Passing the
+    returned cursor back fetches the page before it, with a range scan over
+    ``(conversation_id, timestamp)``. The cursor is None once the start of
+    the conversation is reached. Pass the conversation's ``archived_through``
+    so the archive is read for pages that reach back that far.
+    """
+    query = Message.query.filter_by(conversation_id=conversation_id)
+    direction, values = decode_cursor(cursor, HISTORY_ORDER)
+    before = values if direction == 'next' else None
+    if before:
+        query = query.filter(tuple_(*HISTORY_ORDER) < tuple_(*before))
+    messages = query.order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit + 1).all()
+    
+    if archived_through and (len(messages) <= limit or messages[-1].timestamp <= archived_through):
+        messages += archive.history(conversation_id, limit + 1, before)
+        messages.sort(key=lambda message: (message.timestamp, message.id), reverse=True)
+        messages = messages[:limit + 1]
+    
+    older = None
+    if len(messages) > limit:
+        messages = messages[:limit]
+        older = encode_cursor('next', (messages[-1].timestamp, messages[-1].id))
+    messages.reverse()
+    return messages, older
+
+
+def message_payload(message):
+    """JSON-ready form of a message for chat clients"""
+    return {
+        'message_id': message.id,
+        'message_uid': message.uid,
+        'sender_id': message.sender_id,
+        'recipient_id': message.recipient_id,
+        'content': message.content,
+        'read': message.read,
+        'timestamp': message.timestamp.strftime('%H:%M'),
+        'full_timestamp': message.timestamp.strftime('%B %d, %Y at %I:%M %p')
+    }
+
+
+def backfill():
+    """Attach messages written before conversations existed and rebuild summaries"""
+    pairs = db.session.query(Message.sender_id, Message.recipient_id).filter(
+        Message.conversation_id.is_(None)
+    ).distinct().all()
+    touched = set()
+    for sender_id, recipient_id in pairs:
+        conversation = get_or_create(sender_id, recipient_id)
+        db.session.execute(
+            update(Message)
+            .where(Message.conversation_id.is_(None),
+                   or_(and_(Message.sender_id == sender_id, Message.recipient_id == recipient_id),
+                       and_(Message.sender_id == recipient_id, Message.recipient_id == sender_id)))
+            .values(conversation_id=conversation.id)
+            .execution_options(synchronize_session=False)
+        )
+        touched.add(conversation.id)
+
+    for conversation_id in touched:
+        latest = Message.query.filter_by(conversation_id=conversation_id).order_by(
+            Message.timestamp.desc(), Message.id.desc()
+        ).first()
+        db.session.execute(
+            update(Conversation).where(Conversation.id == conversation_id)
+            .values(last_message_id=latest.id, last_activity=latest.timestamp,
+                    item_id=func.coalesce(Conversation.item_id, latest.item_id))
+            .execution_options(synchronize_session=False)
+        )
+        counts = dict(Message.query.filter_by(conversation_id=conversation_id, read=False)
+                      .with_entities(Message.recipient_id, func.count(Message.id))
+                      .group_by(Message.recipient_id).all())
+        for member in ConversationMember.query.filter_by(conversation_id=conversation_id):
+            member.unread_count = counts.get(member.user_id, 0)
+            member.last_activity = latest.timestamp
+    db.session.commit()
+    return len(touched)
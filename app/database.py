@@ -0,0 +1,176 @@
+"""Engine tuning profiles and read-replica routing.
+
+``DB_PROFILE`` names one of ``PROFILES``. When it is unset the profile is
+picked from the database URL. SQLite profiles set per-connection pragmas:
+WAL lets readers carry on while chat messages are being written. PostgreSQL
+profiles size the connection pool, ping connections before use and set a
+``statement_timeout``.
+
+``DATABASE_REPLICA_URLS`` adds read replicas as the binds ``replica0``,
+``replica1``, ... . GET requests to views marked ``@replica_reads`` send their
+SELECTs to one replica, chosen per request. Flushes, UPDATE/INSERT/DELETE and
+everything outside those views use the primary. After a request that
+committed, the user reads from the primary for ``REPLICA_STICKY_SECONDS``, so
+the page they are redirected to shows their own write. Other visitors may
+see replica lag, and the fragment cache can keep such a page for its TTL.
+
+Two SQLite files work as a local primary/replica pair. Run
+``flask db-replica-sync`` to copy the primary into the replicas.
+"""
+import random
+import sqlite3
+import time
+
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import NullPool
+
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',  # durable across app crashes; WAL is synced at checkpoints
+    'busy_timeout': 5000,  # ms to wait for a writer instead of failing with "database is locked"
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64000,  # negative means KiB, so 64MB per connection
+    'temp_store': 'MEMORY',
+}
+
+PROFILES = {
+    'sqlite': {'pragmas': SQLITE_PRAGMAS},
+    # For hosts where losing the last transactions on power failure is not acceptable
+    'sqlite-durable': {'pragmas': dict(SQLITE_PRAGMAS, synchronous='FULL')},
+    'postgresql': {
+        'engine': {'pool_pre_ping': True, 'pool_recycle': 1800},
+        'statement_timeout': True,
+    },
+    # Behind PgBouncer in transaction mode: let the bouncer do the pooling
+    'postgresql-pgbouncer': {
+        'engine': {'pool_pre_ping': True, 'poolclass': NullPool},
+        'statement_timeout': False,
+    },
+}
+
+
+def profile_for(url, name=None):
+    dialect = make_url(url).get_backend_name()
+    name = name or ('sqlite' if dialect == 'sqlite' else 'postgresql' if dialect == 'postgresql' else None)
+    if name is None:
+        return {}
+    if name not in PROFILES:
+        raise ValueError(f'Unknown DB_PROFILE: {name}')
+    if bool(PROFILES[name].get('pragmas')) != (dialect == 'sqlite'):
+        raise ValueError(f'DB_PROFILE {name} does not apply to {dialect} databases')
+    return PROFILES[name]
+
+
+def engine_options(config, url):
+    """SQLAlchemy engine arguments for ``url`` under the configured profile"""
+    profile = profile_for(url, config['DB_PROFILE'])
+    options = dict(profile.get('engine', {}))
+    if 'pool_pre_ping' in options and 'poolclass' not in options:
+        options.update(pool_size=config['DB_POOL_SIZE'], max_overflow=config['DB_MAX_OVERFLOW'])
+    if profile.get('statement_timeout') and config['DB_STATEMENT_TIMEOUT']:
+        options['connect_args'] = {'options': f"-c statement_timeout={config['DB_STATEMENT_TIMEOUT']}"}
+    if profile.get('pragmas'):
+        # Python's own wait, in seconds, for the same lock busy_timeout covers
+        options['connect_args'] = {'timeout': profile['pragmas']['busy_timeout'] / 1000}
+    return options
+
+
+def configure(app):
+    """Fill in engine options and replica binds; call before ``db.init_app``"""
+    config = app.config
+    options = engine_options(config, config['SQLALCHEMY_DATABASE_URI'])
+    options.update(config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+    config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+    binds = config.setdefault('SQLALCHEMY_BINDS', {})
+    for i, url in enumerate(config['DATABASE_REPLICA_URLS']):
+        binds[replica_key(i)] = dict(engine_options(config, url), url=url)
+
+
+def replica_key(index):
+    return f'replica{index}'
+
+
+def _pragma_listener(pragmas, read_only=False):
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+        if read_only:
+            cursor.execute('PRAGMA query_only = ON')
+        cursor.close()
+    return set_pragmas
+
+
+def init_app(app, db):
+    """Attach SQLite pragmas to the engines once ``db.init_app`` created them"""
+    with app.app_context():
+        for key, engine in db.engines.items():
+            if engine.dialect.name != 'sqlite':
+                continue
+            pragmas = profile_for(engine.url, app.config['DB_PROFILE']).get('pragmas', {})
+            event.listen(engine, 'connect', _pragma_listener(pragmas, read_only=key is not None))
+    if not event.contains(db.session, 'after_commit', _mark_write):
+        event.listen(db.session, 'after_commit', _mark_write)
+    app.before_request(_choose_replica)
+    app.after_request(_remember_write)
+
+
+def replica_reads(view):
+    """Let GET requests to this view read from a replica"""
+    view.replica_reads = True
+    return view
+
+
+def _choose_replica():
+    replicas = current_app.config['DATABASE_REPLICA_URLS']
+    view = current_app.view_functions.get(request.endpoint)
+    if not replicas or request.method != 'GET' or not getattr(view, 'replica_reads', False):
+        return
+    if session.get('db_primary_until', 0) > time.time():
+        return
+    g.db_replica = replica_key(random.randrange(len(replicas)))
+
+
+def _remember_write(response):
+    if g.pop('db_wrote', False) and current_app.config['DATABASE_REPLICA_URLS']:
+        session['db_primary_until'] = time.time() + current_app.config['REPLICA_STICKY_SECONDS']
+    return response
+
+
+class RoutingSession(Session):
+    """Sends SELECTs to the request's replica, everything else to the primary"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and clause is not None and not self._flushing
+                and not getattr(clause, 'is_dml', False) and has_request_context()):
+            key = g.get('db_replica')
+            if key is not None:
+                return self._db.engines[key]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def _mark_write(db_session):
+    if has_request_context():
+        g.db_wrote = True
+
+
+def sync_sqlite_replicas(db):
+    """Copy a SQLite primary into SQLite replica files with the backup API; returns the count"""
+    replicas = [engine for key, engine in db.engines.items() if key is not None and key.startswith('replica')]
+    if db.engine.dialect.name != 'sqlite' or any(engine.dialect.name != 'sqlite' for engine in replicas):
+        raise RuntimeError('db-replica-sync only copies SQLite files; use your database\'s replication')
+    source = sqlite3.connect(db.engine.url.database)
+    try:
+        for engine in replicas:
+            target = sqlite3.connect(engine.url.database)
+            try:
+                source.backup(target)
+            finally:
+                target.close()
+    finally:
+        source.close()
+    return len(replicas)
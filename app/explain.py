@@ -0,0 +1,183 @@
+"""Query-plan check for the listing pages.
+
+``flask db-explain`` requests every listing page in ``PAGES`` through the
+test client, with caches bypassed, and records each SELECT the page sends.
+It then runs ``EXPLAIN`` on those statements against the current database.
+These plans are reported as failures:
+
+* reading a whole table (SQLite ``SCAN <table>``, PostgreSQL ``Seq Scan``)
+* walking a whole index (SQLite ``SCAN <table> USING INDEX``)
+* sorting the rows that matched (SQLite ``USE TEMP B-TREE FOR ORDER BY``,
+  PostgreSQL ``Sort``), which reads every match to return one page
+
+``ALLOWED`` lists the few pages where one of these is intended.
+
+PostgreSQL is asked to avoid sequential scans for the check
+(``enable_seqscan = off``), so small development tables still show whether
+an index can serve the query.
+
+Run it after adding a listing query or changing an index. It exits non-zero
+on failure, so CI can run it against a migrated database.
+"""
+import re
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import event
+from app import db
+from app.cache import cache
+from app.models import ConversationMember, User
+from app.pagination import encode_cursor, invalidate_count
+
+# (label, URL, needs a logged-in user); {username}, {cursor} (a next-page
+# token) and {other_id} (someone the user has a conversation with) are filled in
+PAGES = [
+    ('index', '/', False),
+    ('marketplace', '/marketplace', False),
+    ('marketplace by category', '/marketplace?category=weapon', False),
+    ('marketplace by rarity', '/marketplace?rarity=rare', False),
+    ('marketplace by category and rarity', '/marketplace?category=weapon&rarity=rare', False),
+    ('marketplace search', '/marketplace?search=sword', False),
+    ('marketplace next page', '/marketplace?cursor={cursor}', False),
+    ('marketplace by category, next page', '/marketplace?category=weapon&cursor={cursor}', False),
+    ('marketplace by rarity, next page', '/marketplace?rarity=rare&cursor={cursor}', False),
+    ('profile', '/profile/{username}', False),
+    ('profile next page', '/profile/{username}?cursor={cursor}', False),
+    ('inbox', '/messages/inbox', True),
+    ('sent', '/messages/sent', True),
+    ('chat', '/messages/chat/{other_id}', True),
+    ('chat history', '/messages/chat/{other_id}/history?cursor={cursor}', True),
+    ('api items', '/api/v1/items', False),
+    ('api items by category', '/api/v1/items?category=weapon', False),
+    ('api items by rarity', '/api/v1/items?rarity=rare', False),
+    ('api items by category and rarity', '/api/v1/items?category=weapon&rarity=rare', False),
+    ('api items by seller', '/api/v1/items?seller={username}', False),
+    ('api items search', '/api/v1/items?search=sword', False),
+    ('api items next page', '/api/v1/items?cursor={cursor}', False),
+    ('api user', '/api/v1/users/{username}', False),
+    ('api user items', '/api/v1/users/{username}/items', False),
+    ('api threads', '/api/v1/threads', True),
+    ('api thread messages', '/api/v1/threads/{other_id}/messages', True),
+]
+
+# Tables that are read whole on purpose: one row per (category, rarity)
+ALLOWED_SCANS = {'facet_count'}
+# Plan problems accepted on particular pages, by label
+ALLOWED = {
+    # Unfiltered newest-first pages stop walking after one page
+    'index': {'walk of ix_item_created'},
+    'marketplace': {'walk of ix_item_created'},
+    'api items': {'walk of ix_item_created'},
+    # Full-text matches come back in rowid order and are sorted by date
+    'marketplace search': {'sort'},
+    'api items search': {'sort'},
+}
+
+_sqlite_scan = re.compile(r'^SCAN (\w+)(?: AS \w+)?(?: USING (?:COVERING )?INDEX (\w+))?$')
+_sqlite_sort = re.compile(r'^USE TEMP B-TREE FOR (?:.+ )?ORDER BY$')
+_postgres_scan = re.compile(r'Seq Scan on (\w+)')
+_postgres_sort = re.compile(r'^\s*(?:->\s+)?Sort\s')
+
+
+class PlanCheck:
+    def __init__(self, label, statement, plan, problems):
+        self.label = label
+        self.statement = statement
+        self.plan = plan
+        self.problems = problems
+
+    @property
+    def ok(self):
+        return not self.problems
+
+
+def _capture(client, url):
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            statements.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        response = client.get(url)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+    if response.status_code != 200:
+        raise RuntimeError(f'{url} returned {response.status_code}')
+    return statements
+
+
+def _sqlite_problems(lines):
+    for line in lines:
+        scan = _sqlite_scan.match(line)
+        if scan and scan.group(2) is None and scan.group(1) not in ALLOWED_SCANS:
+            yield f'full scan of {scan.group(1)}'
+        elif scan and scan.group(2):
+            yield f'walk of {scan.group(2)}'
+        elif _sqlite_sort.match(line):
+            yield 'sort'
+
+
+def _postgres_problems(lines):
+    for line in lines:
+        scan = _postgres_scan.search(line)
+        if scan and scan.group(1) not in ALLOWED_SCANS:
+            yield f'full scan of {scan.group(1)}'
+        elif _postgres_sort.match(line):
+            yield 'sort'
+
+
+def _explain(connection, statement, parameters):
+    """``(plan lines, problems)`` for one statement"""
+    if connection.dialect.name == 'sqlite':
+        rows = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).all()
+        lines = [row[-1] for row in rows]
+        return lines, list(_sqlite_problems(lines))
+    lines = [row[0] for row in connection.exec_driver_sql('EXPLAIN ' + statement, parameters)]
+    return lines, list(_postgres_problems(lines))
+
+
+def _placeholders(user):
+    """Values for the URLs in ``PAGES``; a key is missing when nothing can fill it"""
+    values = {'cursor': encode_cursor('next', (datetime.utcnow(), 0))}
+    if user is not None:
+        values['username'] = user.username
+        member = ConversationMember.query.filter_by(user_id=user.id).first()
+        if member is not None:
+            values['other_id'] = member.conversation.other_user(user.id).id
+    return values
+
+
+def check():
+    """Plan every SELECT the listing pages send; returns a list of ``PlanCheck``"""
+    user = User.query.filter_by(deleted_at=None).first()
+    client = current_app.test_client()
+    if user is not None:
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user.id)
+            session['_fresh'] = True
+
+    values = _placeholders(user)
+    results = []
+    for label, url, needs_login in PAGES:
+        try:
+            url = url.format(**values)
+        except KeyError:
+            continue
+        if user is None and needs_login:
+            continue
+        # Render from the database, not from the fragment or count caches
+        cache.bump()
+        if user is not None:
+            invalidate_count(('profile_items', user.id))
+        statements = _capture(client, url)
+
+        with db.engine.connect() as connection:
+            if connection.dialect.name == 'postgresql':
+                connection.exec_driver_sql('SET enable_seqscan = off')
+            for statement, parameters in statements:
+                lines, problems = _explain(connection, statement, parameters)
+                problems = [problem for problem in problems if problem not in ALLOWED.get(label, ())]
+                results.append(PlanCheck(label, statement, lines, problems))
+    return results
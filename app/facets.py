@@ -0,0 +1,145 @@
+"""Listing counts for the marketplace category and rarity filters.
+
+``facet_count`` stores one row per ``(category, rarity)`` pair. Every flush
+that inserts, deletes or re-categorises an Item applies the matching
+``+1``/``-1`` upserts in the same transaction, so reading the counts is
+O(facets) instead of a ``GROUP BY`` over ``item``. Tombstoned items (see
+app/purge.py) are not counted. Bulk SQL that bypasses the ORM is not tracked
+unless it calls ``forget``; ``reconcile`` (``flask facets-reconcile``)
+recomputes the table from ``item`` and fixes any drift.
+
+Counts for a search term cannot be kept incrementally. They are computed with
+a ``GROUP BY`` over the matches and cached, like the result fragments, under
+the ``items`` version stamp.
+"""
+from collections import Counter
+
+from sqlalchemy import event, func, inspect, insert, select, update, delete
+from sqlalchemy.dialects import postgresql, sqlite
+from app import db
+from app.models import Item, FacetCount
+from app.forms import ItemForm
+from app.cache import cache
+from app.search import search_items
+
+CATEGORIES = ItemForm.category.kwargs['choices']
+RARITIES = ItemForm.rarity.kwargs['choices']
+
+
+def _upsert(connection, deltas):
+    """Add each ``{(category, rarity): delta}`` to the stored counts"""
+    table = FacetCount.__table__
+    dialect = connection.dialect.name
+    for (category, rarity), delta in deltas.items():
+        if not delta:
+            continue
+        if dialect in ('sqlite', 'postgresql'):
+            dialect_insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+            stmt = dialect_insert(table).values(category=category, rarity=rarity, count=max(delta, 0))
+            connection.execute(stmt.on_conflict_do_update(
+                index_elements=[table.c.category, table.c.rarity],
+                set_={'count': table.c.count + delta}
+            ))
+            continue
+        updated = connection.execute(
+            update(table).where(table.c.category == category, table.c.rarity == rarity)
+            .values(count=table.c.count + delta)
+        ).rowcount
+        if not updated:
+            connection.execute(insert(table).values(category=category, rarity=rarity, count=max(delta, 0)))
+
+
+def _grouped(query):
+    """``{(category, rarity): count}`` for an Item query"""
+    rows = query.order_by(None).with_entities(Item.category, Item.rarity, func.count(Item.id)) \
+        .group_by(Item.category, Item.rarity)
+    return {(category, rarity): count for category, rarity, count in rows}
+
+
+def counts(search=None):
+    """Listings per ``(category, rarity)``, optionally restricted to a search"""
+    key = cache.key('facets', search or '')
+    cached = cache.backend.get(key)
+    if cached is not None:
+        return cached
+    if search:
+        result = _grouped(search_items(Item.query, search))
+    else:
+        result = {(row.category, row.rarity): row.count for row in FacetCount.query if row.count}
+    cache.backend.set(key, result, cache.ttl)
+    return result
+
+
+def options(facet_counts, category='all', rarity='all'):
+    """Category and rarity choices as ``(value, label, count)``
+
+    Category counts honour the selected rarity and rarity counts honour the
+    selected category, so each number is what picking that option would show.
+    """
+    by_category = Counter()
+    by_rarity = Counter()
+    for (item_category, item_rarity), count in facet_counts.items():
+        if rarity == 'all' or item_rarity == rarity:
+            by_category[item_category] += count
+        if category == 'all' or item_category == category:
+            by_rarity[item_rarity] += count
+    return (
+        [(value, label, by_category[value]) for value, label in CATEGORIES],
+        [(value, label, by_rarity[value]) for value, label in RARITIES],
+    )
+
+
+def forget(query):
+    """Subtract the listings matched by an Item query, before bulk SQL removes them"""
+    deltas = {key: -count for key, count in _grouped(query).items()}
+    _upsert(db.session.connection(), deltas)
+
+
+def reconcile():
+    """Recompute the stored counts from ``item``; returns how many pairs were wrong"""
+    actual = _grouped(Item.query)
+    stored = {(row.category, row.rarity): row.count for row in FacetCount.query}
+    drift = {key: actual.get(key, 0) - stored.get(key, 0)
+             for key in set(actual) | set(stored) if actual.get(key, 0) != stored.get(key, 0)}
+    _upsert(db.session.connection(), drift)
+    db.session.execute(delete(FacetCount).where(FacetCount.count <= 0))
+    db.session.commit()
+    cache.bump()
+    return len(drift)
+
+
+@event.listens_for(db.metadata, 'after_create')
+def _populate_after_create(target, connection, tables=(), **kw):
+    # Count listings that were written before the table existed
+    if FacetCount.__table__ not in tables:
+        return
+    connection.execute(insert(FacetCount.__table__).from_select(
+        ['category', 'rarity', 'count'],
+        select(Item.category, Item.rarity, func.count(Item.id)).where(Item.deleted_at.is_(None))
+        .group_by(Item.category, Item.rarity)
+    ))
+
+
+@event.listens_for(db.session, 'after_flush')
+def _count_item_writes(session, flush_context):
+    deltas = Counter()
+    for obj in session.new:
+        if isinstance(obj, Item) and obj.deleted_at is None:
+            deltas[(obj.category, obj.rarity)] += 1
+    for obj in list(session.dirty) + list(session.deleted):
+        if not isinstance(obj, Item):
+            continue
+        state = inspect(obj)
+        histories = [state.attrs[key].history for key in ('category', 'rarity', 'deleted_at')]
+        if obj not in session.deleted and not any(history.has_changes() for history in histories):
+            continue
+        old_category, old_rarity, old_deleted_at = (
+            history.deleted[0] if history.deleted else getattr(obj, key)
+            for history, key in zip(histories, ('category', 'rarity', 'deleted_at'))
+        )
+        if old_deleted_at is None:
+            deltas[(old_category, old_rarity)] -= 1
+        if obj not in session.deleted and obj.deleted_at is None:
+            deltas[(obj.category, obj.rarity)] += 1
+    if deltas:
+        _upsert(session.connection(), deltas)
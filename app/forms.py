@@ -1,6 +1,6 @@
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, TextAreaField, SelectField
-from flask_wtf.file import FileField, FileAllowed
+from flask_wtf.file import FileField, FileAllowed, FileRequired
 from wtforms.validators import DataRequired, Email, EqualTo, Length, ValidationError
 from app.models import User
 
@@ -57,4 +57,10 @@ class MessageForm(FlaskForm):
 class ProfileForm(FlaskForm):
     avatar = FileField('Profile Picture', validators=[
         FileAllowed(['jpg', 'jpeg', 'png', 'gif'], 'Images only!')
-    ])
\ No newline at end of file
+    ])
+
+class ImportForm(FlaskForm):
+    listings = FileField('Listings file (CSV or NDJSON)', validators=[
+        FileRequired(), FileAllowed(['csv', 'ndjson', 'jsonl', 'json'], 'CSV or NDJSON only')
+    ])
+    images = FileField('Images (optional zip)', validators=[FileAllowed(['zip'], 'Zip archives only')])
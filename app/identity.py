@@ -0,0 +1,116 @@
+"""Cached user loading for Flask-Login.
+
+``load_user`` runs on every request and on every Socket.IO event. Instead of a
+SELECT each time, the user's columns are kept in the cache backend
+(``CACHE_URL``) for ``IDENTITY_CACHE_TTL`` seconds. They are attached to the
+session with ``merge(load=False)``, which issues no SQL. A socket connection
+also keeps its user's snapshot for as long as it is open, refreshed after the
+same TTL.
+
+Entries are dropped after any commit that changes the user row (profile and
+avatar edits, unread counter updates) and on logout.
+"""
+import time
+
+from flask import request, has_request_context
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import make_transient_to_detached
+from app import db
+from app.cache import create_backend
+from app.models import User
+
+# Never cached; loaded from the database on first access instead
+UNCACHED_COLUMNS = {'password_hash'}
+
+
+class IdentityCache:
+    def __init__(self):
+        self.backend = None
+        self.ttl = 0
+        self.connections = {}
+
+    def init_app(self, app):
+        self.backend = create_backend(app.config['CACHE_URL'], app.config['CACHE_MAX_ENTRIES'])
+        self.ttl = app.config['IDENTITY_CACHE_TTL']
+
+    @staticmethod
+    def key(user_id):
+        return f'user:{user_id}'
+
+    def load(self, user_id):
+        """The user with ``user_id``, without a query when a fresh snapshot exists"""
+        if not self.ttl:
+            user = db.session.get(User, user_id)
+            return user if user is not None and user.deleted_at is None else None
+
+        sid = getattr(request, 'sid', None) if has_request_context() else None
+        data = None
+        if sid:
+            hit = self.connections.get(sid)
+            if hit and hit[0] > time.monotonic() and hit[1]['id'] == user_id:
+                data = hit[1]
+        if data is None:
+            data = self.backend.get(self.key(user_id))
+
+        if data is None:
+            user = db.session.get(User, user_id)
+            if user is None or user.deleted_at is not None:
+                return None
+            data = self.snapshot(user)
+            self.backend.set(self.key(user_id), data, self.ttl)
+        else:
+            user = self.attach(data)
+
+        if sid:
+            self.connections[sid] = (time.monotonic() + self.ttl, data)
+        return user
+
+    @staticmethod
+    def snapshot(user):
+        return {
+            attr.key: getattr(user, attr.key)
+            for attr in inspect(User).column_attrs if attr.key not in UNCACHED_COLUMNS
+        }
+
+    @staticmethod
+    def attach(data):
+        user = User(**data)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    def forget(self, user_id):
+        if self.backend is not None:
+            self.backend.delete(self.key(user_id))
+        for sid, (_, data) in list(self.connections.items()):
+            if data['id'] == user_id:
+                self.connections.pop(sid, None)
+
+    def release(self, sid):
+        """Drop a closed socket connection's snapshot"""
+        self.connections.pop(sid, None)
+
+
+def forget_after_commit(user_id):
+    """Drop a user's snapshot once the current transaction commits"""
+    db.session.info.setdefault('identity_forget', set()).add(user_id)
+
+
+identity = IdentityCache()
+
+
+@event.listens_for(db.session, 'after_flush')
+def _track_user_writes(session, flush_context):
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, User):
+            session.info.setdefault('identity_forget', set()).add(obj.id)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _forget_after_commit(session):
+    for user_id in session.info.pop('identity_forget', None) or ():
+        identity.forget(user_id)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_after_rollback(session):
+    session.info.pop('identity_forget', None)
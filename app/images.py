@@ -0,0 +1,251 @@
+"""Background image processing for uploads.
+
+Uploads are written untouched to ``uploads/<folder>/raw/<sha256>.<ext>`` and
+the model stores ``raw/...`` so the original can be shown straight away. Once
+the request commits, a process pool renders every size in RENDITIONS as WebP
+plus a JPEG/PNG fallback into ``uploads/<folder>/r/`` and swaps the stored name
+to ``r/<sha256>.<ext>`` with a single conditional UPDATE. Identical uploads
+share one set of renditions.
+"""
+import glob
+import hashlib
+import multiprocessing
+import os
+import re
+import secrets
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import current_app, url_for
+from PIL import Image, ImageOps
+from sqlalchemy import event, select, update
+from app import db, metrics
+from app.models import User, Item
+from app.cache import cache
+from app.identity import identity
+
+RENDITIONS = {
+    'items': {'card': (400, 300), 'detail': (1000, 1000)},
+    'avatars': {'avatar': (200, 200), 'thumb': (80, 80)},
+}
+
+# Which column points at files in each upload folder
+TARGETS = {
+    'items': Item.image,
+    'avatars': User.avatar,
+}
+
+RAW_PREFIX = 'raw/'
+PROCESSED_PREFIX = 'r/'
+# Names this module stores (plus random hex names from before it existed), with
+# an optional rendition suffix; default pictures and anything else never match
+STORED_NAME = re.compile(r'^(?:raw/|r/)?([0-9a-f]{16,})(?:_[a-z]+)?\.[a-z0-9]+$')
+
+_executor = None
+
+
+def upload_dir(folder):
+    return os.path.join(current_app.root_path, 'static', 'uploads', folder)
+
+
+def is_processed(filename):
+    return bool(filename) and filename.startswith(PROCESSED_PREFIX)
+
+
+def image_url(folder, filename, rendition, fmt=None):
+    """URL of a rendition; ``fmt='webp'`` for the WebP variant, else the fallback"""
+    if is_processed(filename):
+        stem, ext = os.path.splitext(filename)
+        filename = f'{stem}_{rendition}.{fmt or ext[1:]}'
+    return url_for('uploads', folder=folder, filename=filename)
+
+
+def _tmp_path(path):
+    # Unique per writer so concurrent jobs for the same content never collide
+    return f'{path}.{os.getpid()}-{secrets.token_hex(4)}.tmp'
+
+
+def _atomic_save(img, path, fmt, **options):
+    tmp_path = _tmp_path(path)
+    img.save(tmp_path, fmt, **options)
+    os.replace(tmp_path, path)
+
+
+def render(raw_path, out_dir, digest, renditions):
+    """Write every rendition of ``raw_path``; runs in a worker process
+
+    Returns the fallback extension, ``png`` for images with transparency and
+    ``jpg`` otherwise.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    with Image.open(raw_path) as original:
+        img = ImageOps.exif_transpose(original)
+        has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+        img = img.convert('RGBA' if has_alpha else 'RGB')
+    fallback = 'png' if has_alpha else 'jpg'
+
+    for name, size in renditions.items():
+        copy = img.copy()
+        copy.thumbnail(size, Image.LANCZOS)
+        base = os.path.join(out_dir, f'{digest}_{name}')
+        _atomic_save(copy, f'{base}.webp', 'WEBP', quality=80, method=4)
+        if has_alpha:
+            _atomic_save(copy, f'{base}.png', 'PNG', optimize=True)
+        else:
+            _atomic_save(copy, f'{base}.jpg', 'JPEG', quality=85, optimize=True, progressive=True)
+    return fallback
+
+
+def _existing_renditions(folder, digest):
+    """Final filename if this content was already processed, else None"""
+    out_dir = os.path.join(upload_dir(folder), 'r')
+    last = list(RENDITIONS[folder])[-1]
+    for ext in ('jpg', 'png'):
+        if os.path.exists(os.path.join(out_dir, f'{digest}_{last}.{ext}')):
+            return f'{PROCESSED_PREFIX}{digest}.{ext}'
+    return None
+
+
+def save_upload(file_storage, folder):
+    """Store an upload and queue it for processing; returns the name to save on the model"""
+    data = file_storage.read()
+    digest = hashlib.sha256(data).hexdigest()[:32]
+
+    existing = _existing_renditions(folder, digest)
+    if existing:
+        return existing
+
+    _, ext = os.path.splitext(file_storage.filename)
+    raw_name = f'{RAW_PREFIX}{digest}{ext.lower()}'
+    raw_path = os.path.join(upload_dir(folder), raw_name)
+    if not os.path.exists(raw_path):
+        os.makedirs(os.path.dirname(raw_path), exist_ok=True)
+        tmp_path = _tmp_path(raw_path)
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, raw_path)
+
+    # Processing starts after commit so the swap always finds the new row
+    db.session.info.setdefault('image_jobs', set()).add((folder, raw_name))
+    return raw_name
+
+
+def _get_executor(app):
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=app.config['IMAGE_WORKERS'],
+            mp_context=multiprocessing.get_context('spawn')
+        )
+    return _executor
+
+
+def _swap(app, folder, raw_name, fallback):
+    digest = os.path.splitext(raw_name[len(RAW_PREFIX):])[0]
+    final_name = f'{PROCESSED_PREFIX}{digest}.{fallback}'
+    column = TARGETS[folder]
+    with app.app_context(), db.engine.begin() as connection:
+        if folder == 'avatars':
+            user_ids = connection.execute(select(User.id).where(column == raw_name)).scalars().all()
+        connection.execute(
+            update(column.class_).where(column == raw_name).values({column.key: final_name})
+        )
+    if folder == 'avatars':
+        # Cached identities still point at the raw upload
+        for user_id in user_ids:
+            identity.forget(user_id)
+    if folder == 'items':
+        # Cached item cards still point at the raw upload
+        cache.bump()
+
+
+def submit(app, folder, raw_name):
+    """Render ``raw_name`` and point every row using it at the renditions"""
+    raw_path = os.path.join(app.root_path, 'static', 'uploads', folder, raw_name)
+    out_dir = os.path.join(app.root_path, 'static', 'uploads', folder, 'r')
+    digest = os.path.splitext(os.path.basename(raw_name))[0]
+    args = (raw_path, out_dir, digest, RENDITIONS[folder])
+
+    started = time.perf_counter()
+    if not app.config['IMAGE_WORKERS']:
+        _swap(app, folder, raw_name, render(*args))
+        metrics.image_seconds.observe(time.perf_counter() - started, folder=folder)
+        return
+
+    def done(future):
+        try:
+            _swap(app, folder, raw_name, future.result())
+            metrics.image_seconds.observe(time.perf_counter() - started, folder=folder)
+        except Exception:
+            # The row keeps showing the raw upload; 'flask images-reprocess' retries it
+            app.logger.exception('Image processing failed for %s/%s', folder, raw_name)
+
+    _get_executor(app).submit(render, *args).add_done_callback(done)
+
+
+def reprocess_pending():
+    """Queue every stored upload that never reached its final renditions"""
+    app = current_app._get_current_object()
+    count = 0
+    for folder, column in TARGETS.items():
+        names = db.session.query(column).filter(column.startswith(RAW_PREFIX)).distinct()
+        for (raw_name,) in names:
+            submit(app, folder, raw_name)
+            count += 1
+    return count
+
+
+def remove_unreferenced(folder, filenames):
+    """Delete the files behind ``filenames`` that no row uses any more; returns the count"""
+    column = TARGETS[folder]
+    base = upload_dir(folder)
+    removed = 0
+    for filename in set(filenames):
+        match = STORED_NAME.match(filename or '')
+        if not match:
+            continue
+        digest = match.group(1)
+        if filename.startswith((RAW_PREFIX, PROCESSED_PREFIX)):
+            # Identical uploads share the raw file and renditions
+            in_use = column.like(f'{RAW_PREFIX}{digest}.%') | column.like(f'{PROCESSED_PREFIX}{digest}.%')
+            paths = glob.glob(os.path.join(base, 'raw', f'{digest}.*')) + \
+                glob.glob(os.path.join(base, 'r', f'{digest}_*.*'))
+        else:
+            in_use = column == filename
+            paths = [os.path.join(base, filename)]
+        if db.session.execute(
+            select(column).where(in_use).limit(1).execution_options(include_deleted=True)
+        ).first():
+            continue
+        for path in paths:
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+    return removed
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+
+@event.listens_for(db.session, 'after_commit')
+def _submit_after_commit(session):
+    jobs = session.info.pop('image_jobs', None)
+    if jobs:
+        app = current_app._get_current_object()
+        for folder, raw_name in jobs:
+            try:
+                submit(app, folder, raw_name)
+            except Exception:
+                # The upload is already stored; 'flask images-reprocess' picks it up later
+                app.logger.exception('Could not queue %s/%s for processing', folder, raw_name)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_after_rollback(session):
+    session.info.pop('image_jobs', None)
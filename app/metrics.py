@@ -0,0 +1,297 @@
+"""Built-in metrics in the Prometheus text format.
+
+``init_app`` records the following:
+
+* per-endpoint request latency
+* SQL statement counts and time, through engine events
+* Socket.IO handler latency, for handlers decorated with ``@socket_event``
+* upload and image processing time
+
+Live gauges (connections, rooms, queues) are read when ``/metrics`` is
+scraped. ``/metrics`` answers only requests carrying ``Authorization:
+Bearer <METRICS_TOKEN>``; without a token configured it is a 404 for
+everyone. The client address is not trusted, since behind a reverse proxy
+every request comes from loopback.
+
+With ``PROFILER_ENABLED``, adding ``?_profile=1`` to any URL of a request
+carrying the same token samples the request's stack every ``PROFILER_INTERVAL`` seconds. The response is replaced
+by the collapsed stacks (one ``frame;frame;frame count`` line each), which
+flamegraph tools read directly. Sampling uses a helper thread, so it sees
+real threads (the threaded dev server or gunicorn gthread), not eventlet
+green threads.
+"""
+import functools
+import hmac
+import inspect
+import sys
+import threading
+import time
+from collections import Counter as _Tally
+
+from flask import Response, abort, current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+_metrics = []
+_gauges = []
+
+
+def _label_text(labels):
+    if not labels:
+        return ''
+    pairs = ','.join('%s="%s"' % (key, str(value).replace('\\', r'\\').replace('"', r'\"'))
+                     for key, value in labels)
+    return '{' + pairs + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield self.name, key, value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.series = {}
+        _metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [0] * len(self.buckets) + [0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def samples(self):
+        for key, series in sorted(self.series.items()):
+            for bound, count in zip(self.buckets, series):
+                yield f'{self.name}_bucket', key + (('le', repr(bound)),), count
+            yield f'{self.name}_bucket', key + (('le', '+Inf'),), series[-2]
+            yield f'{self.name}_count', key, series[-2]
+            yield f'{self.name}_sum', key, series[-1]
+
+
+def gauge(name, help):
+    """Register a function returning a number or a ``{labels dict tuple: value}`` mapping"""
+    def decorator(fn):
+        _gauges.append((name, help, fn))
+        return fn
+    return decorator
+
+
+http_request_seconds = Histogram('http_request_duration_seconds', 'Request latency by endpoint')
+sql_statements = Counter('sql_statements_total', 'SQL statements executed')
+sql_seconds = Histogram('sql_statement_duration_seconds', 'SQL statement execution time')
+socket_event_seconds = Histogram('socketio_event_duration_seconds', 'Socket.IO handler latency by event')
+socket_event_errors = Counter('socketio_event_errors_total', 'Socket.IO handlers that raised')
+upload_seconds = Histogram('upload_save_duration_seconds', 'Time spent storing an upload in the request')
+image_seconds = Histogram('image_processing_duration_seconds',
+                          'Time from queueing an upload to its renditions being live')
+
+
+def socket_event(handler):
+    """Record latency for a Socket.IO handler, labelled with its name minus ``handle_``"""
+    name = handler.__name__.removeprefix('handle_')
+    params = inspect.signature(handler).parameters
+    takes_varargs = any(p.kind is p.VAR_POSITIONAL for p in params.values())
+
+    @functools.wraps(handler)
+    def wrapper(*args):
+        # Flask-SocketIO retries connect handlers without arguments on TypeError
+        if not takes_varargs:
+            args = args[:len(params)]
+        started = time.perf_counter()
+        try:
+            return handler(*args)
+        except Exception:
+            socket_event_errors.inc(event=name)
+            raise
+        finally:
+            socket_event_seconds.observe(time.perf_counter() - started, event=name)
+    return wrapper
+
+
+def _endpoint():
+    if has_request_context():
+        if getattr(request, 'event', None):
+            return 'socketio:' + request.event['message']
+        return request.endpoint or ''
+    return 'background'
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._metrics_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_metrics_started', None)
+    endpoint = _endpoint()
+    sql_statements.inc(endpoint=endpoint)
+    if started is not None:
+        sql_seconds.observe(time.perf_counter() - started, endpoint=endpoint)
+
+
+def _authorized():
+    """Whether the request carries the configured ``METRICS_TOKEN``"""
+    token = current_app.config['METRICS_TOKEN']
+    return bool(token) and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')
+
+
+def _start_timer():
+    g.metrics_started = time.perf_counter()
+    if current_app.config['PROFILER_ENABLED'] and request.args.get('_profile') and _authorized():
+        g.profiler = SamplingProfiler(current_app.config['PROFILER_INTERVAL'])
+        g.profiler.start()
+
+
+def _record_request(response):
+    started = g.pop('metrics_started', None)
+    if started is not None and request.endpoint != 'metrics':
+        http_request_seconds.observe(time.perf_counter() - started, endpoint=request.endpoint or '404',
+                                     method=request.method, status=response.status_code)
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        return Response(profiler.stop(), mimetype='text/plain')
+    return response
+
+
+class SamplingProfiler:
+    """Samples one thread's stack from a helper thread"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.thread_id = threading.get_ident()
+        self.stacks = _Tally()
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+
+    def _sample(self):
+        while self.running:
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({code.co_filename}:{frame.f_lineno})')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        with _lock:
+            samples = list(metric.samples())
+        for name, labels, value in samples:
+            lines.append(f'{name}{_label_text(labels)} {value}')
+    for name, help, fn in _gauges:
+        lines.append(f'# HELP {name} {help}')
+        lines.append(f'# TYPE {name} gauge')
+        value = fn()
+        if isinstance(value, dict):
+            for labels, sample in sorted(value.items()):
+                lines.append(f'{name}{_label_text(labels)} {sample}')
+        else:
+            lines.append(f'{name} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view():
+    if not _authorized():
+        abort(404)
+    return Response(render(), mimetype='text/plain; version=0.0.4')
+
+
+@gauge('socketio_connections', 'Authenticated Socket.IO connections on this worker')
+def _connections():
+    from app.presence import presence
+    return len(presence)
+
+
+def _room_type(room):
+    """Room names carry user ids, so only their prefix is exported"""
+    prefix = room.split('_', 1)[0]
+    return prefix if prefix in ('chat', 'user', 'presence') else 'other'
+
+
+def _rooms_by_type():
+    from app import socketio
+    counts, members = _Tally(), _Tally()
+    if socketio.server is not None:
+        for room, sids in list(socketio.server.manager.rooms.get('/', {}).items()):
+            # Skip the all-clients room and each client's private room
+            if room is not None and room not in sids:
+                counts[_room_type(room)] += 1
+                members[_room_type(room)] += len(sids)
+    return counts, members
+
+
+@gauge('socketio_rooms', 'Rooms on this worker by type')
+def _room_counts():
+    return {(('type', kind),): count for kind, count in _rooms_by_type()[0].items()}
+
+
+@gauge('socketio_room_members', 'Members of rooms on this worker by room type')
+def _room_members():
+    return {(('type', kind),): count for kind, count in _rooms_by_type()[1].items()}
+
+
+@gauge('typing_active_bursts', 'Users currently typing on this worker')
+def _typing_bursts():
+    from app.typing_indicators import tracker
+    return len(tracker.active)
+
+
+@gauge('chat_write_queue_depth', 'Chat messages waiting for write-behind')
+def _write_queue():
+    from app.chat_writer import writer
+    return writer.queue.qsize() if writer.queue is not None else 0
+
+
+def init_app(app):
+    if not app.config['METRICS_ENABLED']:
+        return
+    if not event.contains(Engine, 'after_cursor_execute', _after_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    app.before_request(_start_timer)
+    app.after_request(_record_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
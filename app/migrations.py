@@ -0,0 +1,199 @@
+"""Versioned schema migrations.
+
+``flask db-upgrade`` brings the database to the latest version. It runs as a
+deploy step (see build.sh); the app never changes the schema when it starts.
+Applied versions are recorded in ``schema_version``.
+
+A database with no tables is built straight from the models and stamped with
+the latest version. Databases created by ``db.create_all()`` before
+versioning existed start at version 0 and run every step. They may be at any
+point of the schema's history, so each step checks which tables, columns and
+indexes already exist before adding them. Data backfills can be re-run
+safely, so a step that failed halfway can simply be retried.
+
+Add a step by appending to ``MIGRATIONS``. Never edit or reorder one that has
+shipped.
+"""
+from datetime import datetime
+
+import sqlalchemy as sa
+from sqlalchemy.schema import CreateColumn
+from app import db, conversations, unread, search, facets, recommend
+from app.models import User, Item, Message, ArchivedMessage, Conversation, ConversationMember, FacetCount, \
+    ItemRecommendation, ItemVector, RecommendationTerm
+
+SCHEMA_TABLE = sa.Table(
+    'schema_version', sa.MetaData(),
+    sa.Column('version', sa.Integer, primary_key=True),
+    sa.Column('name', sa.String(100), nullable=False),
+    sa.Column('applied_at', sa.DateTime, nullable=False),
+)
+
+
+def _connection():
+    return db.session.connection()
+
+
+def _has_column(model, name):
+    table = model.__table__.name
+    return any(column['name'] == name for column in sa.inspect(_connection()).get_columns(table))
+
+
+def _add_columns(model, *names):
+    """``ALTER TABLE ... ADD COLUMN`` for model columns the table is missing"""
+    connection = _connection()
+    table = connection.dialect.identifier_preparer.quote(model.__table__.name)
+    for name in names:
+        if not _has_column(model, name):
+            spec = CreateColumn(model.__table__.c[name]).compile(dialect=connection.dialect)
+            connection.execute(sa.text(f'ALTER TABLE {table} ADD COLUMN {spec}'))
+
+
+def _is_unique(model, columns):
+    inspector = sa.inspect(_connection())
+    table = model.__table__.name
+    return any(index['unique'] and index['column_names'] == columns for index in inspector.get_indexes(table)) \
+        or any(constraint['column_names'] == columns for constraint in inspector.get_unique_constraints(table))
+
+
+def _create_indexes(model, *names):
+    indexes = {index.name: index for index in model.__table__.indexes}
+    for name in names:
+        indexes[name].create(_connection(), checkfirst=True)
+
+
+def _create_tables(*models):
+    # Also fires the after_create hooks (search index, facet counts)
+    db.metadata.create_all(_connection(), tables=[model.__table__ for model in models])
+
+
+def _conversations():
+    _create_tables(Conversation, ConversationMember)
+    _add_columns(Message, 'conversation_id', 'uid')
+    _add_columns(ConversationMember, 'last_read_message_id')
+    # backfill() loads whole Conversation rows, which map step 7's column too
+    _add_columns(Conversation, 'archived_through')
+    _create_indexes(Message, 'ix_message_conversation_timestamp')
+    _create_indexes(ConversationMember, 'ix_conversation_member_inbox')
+    if not _is_unique(Message, ['uid']):
+        # SQLite cannot add a UNIQUE column, so the constraint becomes an index; plain DDL, since
+        # an sa.Index on the model's column would stay on its table for every later create_all
+        _connection().execute(sa.text('CREATE UNIQUE INDEX ix_message_uid ON message (uid)'))
+    db.session.commit()
+    conversations.backfill()
+
+
+def _unread_counters():
+    _add_columns(User, 'unread_count')
+    db.session.commit()
+    unread.recount()
+
+
+def _search_index():
+    search.create_index(_connection())
+
+
+def _tombstones():
+    _add_columns(User, 'deleted_at')
+    _add_columns(Item, 'deleted_at')
+    _create_indexes(User, 'ix_user_tombstone')
+    _create_indexes(Item, 'ix_item_tombstone')
+
+
+def _facet_counts():
+    _create_tables(FacetCount)
+    db.session.commit()
+    facets.reconcile()
+
+
+def _drop_indexes(*names):
+    connection = _connection()
+    for name in names:
+        connection.execute(sa.text(f'DROP INDEX IF EXISTS {connection.dialect.identifier_preparer.quote(name)}'))
+
+
+def _listing_indexes():
+    # Full deleted_at indexes from before the tombstone indexes were partial
+    _drop_indexes('ix_user_deleted_at', 'ix_item_deleted_at')
+    _create_indexes(Message, 'ix_message_recipient_read', 'ix_message_recipient_timestamp',
+                    'ix_message_sender_timestamp')
+    _create_indexes(Item, 'ix_item_category_rarity_created', 'ix_item_created', 'ix_item_seller_created')
+
+
+def _message_archive():
+    _create_tables(ArchivedMessage)
+    _add_columns(Conversation, 'archived_through')
+
+
+def _item_versions():
+    _add_columns(Item, 'updated_at')
+    db.session.execute(
+        sa.update(Item).where(Item.updated_at.is_(None)).values(updated_at=Item.created_at)
+        .execution_options(synchronize_session=False, include_deleted=True)
+    )
+
+
+def _recommendations():
+    _create_tables(ItemRecommendation, ItemVector, RecommendationTerm)
+    db.session.commit()
+    recommend.rebuild()
+
+
+def _single_filter_indexes():
+    _create_indexes(Item, 'ix_item_category_created', 'ix_item_rarity_created')
+
+
+MIGRATIONS = [
+    (1, 'conversations and read watermarks', _conversations),
+    (2, 'unread counters', _unread_counters),
+    (3, 'full-text search index', _search_index),
+    (4, 'soft-delete tombstones', _tombstones),
+    (5, 'facet counts', _facet_counts),
+    (6, 'composite indexes for listing pages', _listing_indexes),
+    (7, 'message archive', _message_archive),
+    (8, 'item row versions', _item_versions),
+    (9, 'related listings', _recommendations),
+    (10, 'indexes for single-filter listings', _single_filter_indexes),
+]
+LATEST = MIGRATIONS[-1][0]
+
+
+def current_version():
+    """Applied version; 0 for an unversioned database, None for an empty one"""
+    tables = sa.inspect(_connection()).get_table_names()
+    if SCHEMA_TABLE.name in tables:
+        return db.session.execute(sa.select(sa.func.max(SCHEMA_TABLE.c.version))).scalar() or 0
+    return 0 if User.__table__.name in tables else None
+
+
+def pending():
+    version = current_version()
+    if version is None:
+        return MIGRATIONS
+    return [migration for migration in MIGRATIONS if migration[0] > version]
+
+
+def _record(version, name):
+    db.session.execute(SCHEMA_TABLE.insert().values(version=version, name=name, applied_at=datetime.utcnow()))
+
+
+def upgrade():
+    """Apply pending steps, each in its own transaction; returns ``(version, name)`` pairs"""
+    version = current_version()
+    SCHEMA_TABLE.create(_connection(), checkfirst=True)
+    if version is None:
+        db.metadata.create_all(_connection())
+        for number, name, _ in MIGRATIONS:
+            _record(number, name)
+        db.session.commit()
+        return [(LATEST, 'created from the models')]
+
+    applied = []
+    for number, name, step in MIGRATIONS:
+        if number <= version:
+            continue
+        step()
+        _record(number, name)
+        db.session.commit()
+        applied.append((number, name))
+    return applied
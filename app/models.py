@@ -1,11 +1,13 @@
+import uuid
 from datetime import datetime
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
-from app import db, login_manager
+from app import db, login_manager, passwords
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    # Served from the identity cache when possible (see app/identity.py)
+    from app.identity import identity
+    return identity.load(int(user_id))
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -14,6 +16,9 @@ class User(UserMixin, db.Model):
     password_hash = db.Column(db.String(200), nullable=False)
     avatar = db.Column(db.String(200), default='default_avatar.png')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    unread_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Tombstone; the row and everything it owns are removed by app/purge.py
+    deleted_at = db.Column(db.DateTime, nullable=True)
     
     # Relationships
     items = db.relationship('Item', backref='seller', lazy='dynamic', cascade='all, delete-orphan')
@@ -23,13 +28,22 @@ class User(UserMixin, db.Model):
                                        backref='recipient', lazy='dynamic', cascade='all, delete-orphan')
     
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = passwords.hash_password(password)
     
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return passwords.verify(self.password_hash, password)
+    
+    def password_needs_rehash(self):
+        return passwords.needs_rehash(self.password_hash)
     
     def unread_message_count(self):
-        return Message.query.filter_by(recipient_id=self.id, read=False).count()
+        return self.unread_count
+    
+    __table_args__ = (
+        # Only tombstones, for the purge; a full index would match every live row
+        db.Index('ix_user_tombstone', 'deleted_at', sqlite_where=db.text('deleted_at IS NOT NULL'),
+                 postgresql_where=db.text('deleted_at IS NOT NULL')),
+    )
     
     def __repr__(self):
         return f'<User {self.username}>'
@@ -44,14 +58,80 @@ class Item(db.Model):
     rarity = db.Column(db.String(20), nullable=False)
     seller_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Row version for API validators; set on every ORM update
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Tombstone; hidden from queries at once, removed later by app/purge.py
+    deleted_at = db.Column(db.DateTime, nullable=True)
     
     # Relationship with messages
     messages = db.relationship('Message', backref='item', lazy='dynamic', cascade='all, delete-orphan')
     
+    __table_args__ = (
+        # Marketplace filters and the unfiltered newest-first listing
+        db.Index('ix_item_category_rarity_created', 'category', 'rarity', 'created_at'),
+        # One filter alone; the three-column index would sort a whole category
+        db.Index('ix_item_category_created', 'category', 'created_at'),
+        db.Index('ix_item_rarity_created', 'rarity', 'created_at'),
+        db.Index('ix_item_created', 'created_at'),
+        # Profile listings
+        db.Index('ix_item_seller_created', 'seller_id', 'created_at'),
+        # Only tombstones, for the purge; a full index would match every live row
+        db.Index('ix_item_tombstone', 'deleted_at', sqlite_where=db.text('deleted_at IS NOT NULL'),
+                 postgresql_where=db.text('deleted_at IS NOT NULL')),
+    )
+    
     def __repr__(self):
         return f'<Item {self.name}>'
 
 
+class FacetCount(db.Model):
+    """Number of listings per (category, rarity), maintained by app/facets.py"""
+    category = db.Column(db.String(50), primary_key=True)
+    rarity = db.Column(db.String(20), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    
+    def __repr__(self):
+        return f'<FacetCount {self.category}/{self.rarity}: {self.count}>'
+
+
+class ItemRecommendation(db.Model):
+    """One of an item's top-K neighbours, maintained by app/recommend.py"""
+    __tablename__ = 'item_recommendation'
+    item_id = db.Column(db.Integer, db.ForeignKey('item.id'), primary_key=True)
+    # 'similar' across the catalog, or 'seller' among the same seller's listings
+    kind = db.Column(db.String(10), primary_key=True)
+    recommended_id = db.Column(db.Integer, db.ForeignKey('item.id'), primary_key=True)
+    score = db.Column(db.Float, nullable=False)
+    
+    __table_args__ = (
+        # Lists that mention an item, when it changes or goes away
+        db.Index('ix_item_recommendation_recommended', 'recommended_id'),
+    )
+    
+    def __repr__(self):
+        return f'<ItemRecommendation {self.item_id} {self.kind} {self.recommended_id}>'
+
+
+class ItemVector(db.Model):
+    """An item's term frequencies as JSON, as counted in ``recommendation_term``"""
+    __tablename__ = 'item_vector'
+    item_id = db.Column(db.Integer, db.ForeignKey('item.id'), primary_key=True)
+    terms = db.Column(db.Text, nullable=False)
+    
+    def __repr__(self):
+        return f'<ItemVector {self.item_id}>'
+
+
+class RecommendationTerm(db.Model):
+    """Number of indexed listings containing a term, for IDF weights"""
+    __tablename__ = 'recommendation_term'
+    term = db.Column(db.String(100), primary_key=True)
+    documents = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    
+    def __repr__(self):
+        return f'<RecommendationTerm {self.term}: {self.documents}>'
+
+
 class Message(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     sender_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -61,6 +141,96 @@ class Message(db.Model):
     content = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     read = db.Column(db.Boolean, default=False)
+    conversation_id = db.Column(db.Integer, db.ForeignKey('conversation.id'), nullable=True)
+    # Client-visible id, assigned before the row is written (see chat_writer)
+    uid = db.Column(db.String(32), unique=True, nullable=True, default=lambda: uuid.uuid4().hex)
+    
+    conversation = db.relationship('Conversation', foreign_keys=[conversation_id],
+                                   backref=db.backref('messages', lazy='dynamic'))
+    
+    __table_args__ = (
+        db.Index('ix_message_conversation_timestamp', 'conversation_id', 'timestamp'),
+        # Unread counts, received and sent listings
+        db.Index('ix_message_recipient_read', 'recipient_id', 'read'),
+        db.Index('ix_message_recipient_timestamp', 'recipient_id', 'timestamp'),
+        db.Index('ix_message_sender_timestamp', 'sender_id', 'timestamp'),
+    )
+    
+    def __repr__(self):
+        return f'<Message from {self.sender_id} to {self.recipient_id}>'
+
+
+class ArchivedMessage(db.Model):
+    """A read message moved out of the hot ``message`` table; it keeps its id"""
+    __tablename__ = 'message_archive'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    sender_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    recipient_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    item_id = db.Column(db.Integer, db.ForeignKey('item.id'), nullable=True)
+    subject = db.Column(db.String(200), nullable=False)
+    content = db.Column(db.Text, nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False)
+    read = db.Column(db.Boolean, nullable=False, default=True)
+    conversation_id = db.Column(db.Integer, db.ForeignKey('conversation.id'), nullable=False)
+    uid = db.Column(db.String(32), nullable=True)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    sender = db.relationship('User', foreign_keys=[sender_id])
+    recipient = db.relationship('User', foreign_keys=[recipient_id])
+    item = db.relationship('Item')
+    
+    __table_args__ = (
+        # Chat history; the purge also finds a deleted user's messages through their conversations
+        db.Index('ix_message_archive_conversation_timestamp', 'conversation_id', 'timestamp'),
+        db.Index('ix_message_archive_item', 'item_id'),
+    )
+    
+    def __repr__(self):
+        return f'<ArchivedMessage from {self.sender_id} to {self.recipient_id}>'
+
+
+class Conversation(db.Model):
+    """A thread between two users, stored with the lower user id first"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_low_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_high_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    item_id = db.Column(db.Integer, db.ForeignKey('item.id'), nullable=True)
+    last_message_id = db.Column(db.Integer, db.ForeignKey('message.id', use_alter=True,
+                                name='fk_conversation_last_message'), nullable=True)
+    last_activity = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Timestamp of the newest message moved to the archive (see app/archive.py)
+    archived_through = db.Column(db.DateTime, nullable=True)
+    
+    user_low = db.relationship('User', foreign_keys=[user_low_id])
+    user_high = db.relationship('User', foreign_keys=[user_high_id])
+    item = db.relationship('Item')
+    last_message = db.relationship('Message', foreign_keys=[last_message_id], post_update=True)
+    members = db.relationship('ConversationMember', backref='conversation', cascade='all, delete-orphan')
+    
+    __table_args__ = (
+        db.UniqueConstraint('user_low_id', 'user_high_id', name='uq_conversation_pair'),
+    )
+    
+    def other_user(self, user_id):
+        return self.user_high if user_id == self.user_low_id else self.user_low
+    
+    def __repr__(self):
+        return f'<Conversation {self.user_low_id}-{self.user_high_id}>'
+
+
+class ConversationMember(db.Model):
+    """Per-participant view of a conversation: unread count and inbox ordering"""
+    conversation_id = db.Column(db.Integer, db.ForeignKey('conversation.id'), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    unread_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    last_activity = db.Column(db.DateTime, default=datetime.utcnow)
+    # Highest message id this member has read up to
+    last_read_message_id = db.Column(db.Integer, nullable=True)
+    
+    __table_args__ = (
+        db.Index('ix_conversation_member_inbox', 'user_id', 'last_activity', 'conversation_id'),
+    )
     
     def __repr__(self):
-        return f'<Message from {self.sender_id} to {self.recipient_id}>'
\ No newline at end of file
+        return f'<ConversationMember {self.conversation_id}:{self.user_id}>'
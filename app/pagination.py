@@ -0,0 +1,138 @@
+"""Cursor (keyset) pagination for listing pages.
+
+Instead of ``OFFSET n`` plus ``COUNT(*)``, each page remembers the sort key of
+its first and last row in an opaque, signed token. The next page is fetched
+with ``WHERE (created_at, id) < (:created_at, :id)``, which an index on the sort
+key answers directly, so every page costs the same as the first one.
+"""
+from datetime import datetime
+
+from flask import current_app
+from itsdangerous import BadSignature, URLSafeSerializer
+from sqlalchemy import tuple_
+from app.cache import LRUCache
+
+COUNT_CACHE_TTL = 60
+# Bounded, so every distinct search or filter combination cannot grow it forever
+_count_cache = LRUCache(max_entries=1024)
+
+
+def _serializer():
+    return URLSafeSerializer(current_app.config['SECRET_KEY'], salt='page-cursor')
+
+
+def encode_cursor(direction, values):
+    return _serializer().dumps([direction] + [
+        value.isoformat() if isinstance(value, datetime) else value for value in values
+    ])
+
+
+def decode_cursor(token, columns):
+    """Return ``(direction, values)`` for a cursor, or ``(None, None)`` if it is invalid"""
+    if not token:
+        return None, None
+    try:
+        direction, *values = _serializer().loads(token)
+    except (BadSignature, ValueError, TypeError):
+        return None, None
+    if direction not in ('next', 'prev', 'offset') or (direction != 'offset' and len(values) != len(columns)):
+        return None, None
+    if direction == 'offset':
+        return direction, values
+    try:
+        values = [
+            datetime.fromisoformat(value) if column.type.python_type is datetime else value
+            for column, value in zip(columns, values)
+        ]
+    except (ValueError, TypeError, NotImplementedError):
+        return None, None
+    return direction, values
+
+
+def cached_count(key, query, ttl=COUNT_CACHE_TTL):
+    """COUNT(*) for ``query``, reused for ``ttl`` seconds under ``key``"""
+    total = _count_cache.get(key)
+    if total is None:
+        total = query.order_by(None).count()
+        _count_cache.set(key, total, ttl)
+    return total
+
+
+def invalidate_count(key):
+    _count_cache.delete(key)
+
+
+class CursorPage:
+    """One page of results with opaque tokens for its neighbours"""
+
+    def __init__(self, items, next_cursor=None, prev_cursor=None, total=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.total = total
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def keyset_paginate(query, columns, per_page, cursor=None, total=None):
+    """Paginate ``query`` newest-first on ``columns``, e.g. ``(Item.created_at, Item.id)``
+
+    ``columns`` must identify a row uniquely; the last one is normally the
+    primary key. ``total`` is passed through untouched so callers can supply an
+    optional or cached count.
+    """
+    direction, values = decode_cursor(cursor, columns)
+    key = tuple_(*columns)
+
+    if direction == 'prev':
+        query = query.filter(key > tuple_(*values)).order_by(*[c.asc() for c in columns])
+    else:
+        if direction == 'next':
+            query = query.filter(key < tuple_(*values))
+        query = query.order_by(*[c.desc() for c in columns])
+
+    rows = query.limit(per_page + 1).all()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if direction == 'prev':
+        rows.reverse()
+
+    def row_key(row):
+        return [getattr(row, c.key) for c in columns]
+
+    next_cursor = prev_cursor = None
+    if rows:
+        if has_more or direction == 'prev':
+            next_cursor = encode_cursor('next', row_key(rows[-1]))
+        if direction == 'next' or (direction == 'prev' and has_more):
+            prev_cursor = encode_cursor('prev', row_key(rows[0]))
+
+    return CursorPage(rows, next_cursor, prev_cursor, total)
+
+
+def offset_paginate(query, per_page, cursor=None, total=None):
+    """Token-based paging for queries with a computed order, such as search ranking
+
+    The offset is hidden inside the same kind of opaque token so templates
+    can treat both pagination styles alike.
+    """
+    direction, values = decode_cursor(cursor, ())
+    offset = 0
+    if direction == 'offset' and values and isinstance(values[0], int):
+        offset = max(values[0], 0)
+
+    rows = query.offset(offset).limit(per_page + 1).all()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+
+    next_cursor = encode_cursor('offset', [offset + per_page]) if has_more else None
+    prev_cursor = None
+    if offset > 0:
+        prev_cursor = encode_cursor('offset', [max(offset - per_page, 0)])
+    return CursorPage(rows, next_cursor, prev_cursor, total)
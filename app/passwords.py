@@ -0,0 +1,41 @@
+"""Password hashing.
+
+``PASSWORD_HASH_METHOD`` is ``bcrypt`` (cost ``BCRYPT_LOG_ROUNDS``) or any
+werkzeug method such as ``scrypt`` or ``pbkdf2:sha256:600000``. Hashes made
+with other settings still verify, and ``needs_rehash`` reports them so login
+can upgrade them.
+"""
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash
+from app import bcrypt
+
+BCRYPT_PREFIXES = ('$2a$', '$2b$', '$2y$')
+
+
+def _method():
+    return current_app.config['PASSWORD_HASH_METHOD']
+
+
+def hash_password(password):
+    if _method() == 'bcrypt':
+        return bcrypt.generate_password_hash(password).decode('utf-8')
+    return generate_password_hash(password, method=_method())
+
+
+def verify(password_hash, password):
+    if password_hash.startswith(BCRYPT_PREFIXES):
+        return bcrypt.check_password_hash(password_hash, password)
+    return check_password_hash(password_hash, password)
+
+
+def needs_rehash(password_hash):
+    """True if the hash was made with a different method or cost than configured"""
+    method = _method()
+    if password_hash.startswith(BCRYPT_PREFIXES):
+        rounds = int(password_hash.split('$')[2])
+        return method != 'bcrypt' or rounds != current_app.config['BCRYPT_LOG_ROUNDS']
+    if method == 'bcrypt':
+        return True
+    # werkzeug stores e.g. "scrypt:32768:8:1$salt$hash"; "scrypt" accepts any parameters
+    stored = password_hash.split('$', 1)[0]
+    return stored != method and not stored.startswith(method + ':')
@@ -0,0 +1,249 @@
+"""Who is online, shared across Socket.IO workers.
+
+Each worker tracks its own connections (sid -> user id) in memory.
+``PRESENCE_URL`` picks the backend that makes them visible to other workers:
+
+* unset / ``memory`` - this process only
+* ``sqlite:///path`` - a SQLite file shared by workers on one host
+* ``redis://...``    - any Redis-protocol server (optional ``redis`` package)
+
+Shared entries are refreshed by a heartbeat. If a worker dies without cleaning
+up, its users drop out after ``PRESENCE_TTL`` seconds.
+
+Status changes are not broadcast. Clients subscribe to the users they show
+(``presence_<id>`` rooms), and changes are coalesced for ``PRESENCE_COALESCE``
+seconds so a reconnecting tab produces no event at all.
+"""
+import threading
+import time
+import uuid
+
+from app import socketio
+from app.bus import REDIS_PREFIXES, SQLITE_PREFIX, connect_sqlite, require_redis, sqlite_path
+
+
+class MemoryPresence:
+    """Connections of this process only"""
+
+    def __init__(self):
+        self.sids = {}
+        self.users = {}
+
+    def add(self, sid, user_id):
+        """Record a connection; returns True if the user was offline before"""
+        was_online = self.is_online(user_id)
+        self.sids[sid] = user_id
+        self.users.setdefault(user_id, set()).add(sid)
+        self._store_add(sid, user_id)
+        return not was_online
+
+    def remove(self, sid):
+        """Forget a connection; returns ``(user_id, went_offline)``"""
+        user_id = self.sids.pop(sid, None)
+        if user_id is None:
+            return None, False
+        sids = self.users[user_id]
+        sids.discard(sid)
+        if not sids:
+            del self.users[user_id]
+        self._store_remove(sid, user_id)
+        return user_id, not self.is_online(user_id)
+
+    def user_for(self, sid):
+        return self.sids.get(sid)
+
+    def is_online(self, user_id):
+        return user_id in self.online([user_id])
+
+    def online(self, user_ids):
+        """The subset of ``user_ids`` with at least one open connection"""
+        return {user_id for user_id in user_ids if user_id in self.users}
+
+    def __len__(self):
+        return len(self.sids)
+
+    def _store_add(self, sid, user_id):
+        pass
+
+    def _store_remove(self, sid, user_id):
+        pass
+
+
+class SharedPresence(MemoryPresence):
+    """Base for backends that other workers can read"""
+
+    def __init__(self, ttl, heartbeat):
+        super().__init__()
+        self.node = uuid.uuid4().hex
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat
+        self.beating = False
+
+    def add(self, sid, user_id):
+        if not self.beating:
+            self.beating = True
+            socketio.start_background_task(self._beat)
+        return super().add(sid, user_id)
+
+    def _beat(self):
+        while True:
+            socketio.sleep(self.heartbeat_interval)
+            try:
+                self.heartbeat()
+            except Exception:
+                presence.app.logger.exception('Presence heartbeat failed')
+
+    def heartbeat(self):
+        raise NotImplementedError
+
+
+class SqlitePresence(SharedPresence):
+    def __init__(self, url, ttl=45, heartbeat=15):
+        super().__init__(ttl, heartbeat)
+        self.lock = threading.Lock()
+        self.conn = connect_sqlite(sqlite_path(url))
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS presence ('
+            'sid TEXT PRIMARY KEY, user_id INTEGER NOT NULL, '
+            'node TEXT NOT NULL, seen REAL NOT NULL)'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS ix_presence_user ON presence (user_id, seen)')
+
+    def _store_add(self, sid, user_id):
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO presence (sid, user_id, node, seen) VALUES (?, ?, ?, ?)',
+                (sid, user_id, self.node, time.time())
+            )
+
+    def _store_remove(self, sid, user_id):
+        with self.lock:
+            self.conn.execute('DELETE FROM presence WHERE sid = ?', (sid,))
+
+    def heartbeat(self):
+        now = time.time()
+        with self.lock:
+            self.conn.execute('UPDATE presence SET seen = ? WHERE node = ?', (now, self.node))
+            self.conn.execute('DELETE FROM presence WHERE seen < ?', (now - self.ttl,))
+
+    def online(self, user_ids):
+        user_ids = list(set(user_ids))
+        found = set()
+        cutoff = time.time() - self.ttl
+        with self.lock:
+            for start in range(0, len(user_ids), 500):
+                chunk = user_ids[start:start + 500]
+                rows = self.conn.execute(
+                    'SELECT DISTINCT user_id FROM presence WHERE seen >= ? AND user_id IN (%s)'
+                    % ','.join('?' * len(chunk)),
+                    [cutoff] + chunk
+                )
+                found.update(user_id for (user_id,) in rows)
+        return found
+
+
+class RedisPresence(SharedPresence):
+    """One sorted set per user: sid -> last heartbeat time"""
+
+    def __init__(self, url, ttl=45, heartbeat=15, client=None):
+        super().__init__(ttl, heartbeat)
+        self.redis = client or require_redis('PRESENCE_URL').Redis.from_url(url)
+
+    @staticmethod
+    def key(user_id):
+        return f'presence:user:{user_id}'
+
+    def _store_add(self, sid, user_id):
+        pipe = self.redis.pipeline()
+        pipe.zadd(self.key(user_id), {sid: time.time()})
+        pipe.expire(self.key(user_id), self.ttl * 2)
+        pipe.execute()
+
+    def _store_remove(self, sid, user_id):
+        self.redis.zrem(self.key(user_id), sid)
+
+    def heartbeat(self):
+        now = time.time()
+        pipe = self.redis.pipeline()
+        for user_id, sids in list(self.users.items()):
+            pipe.zadd(self.key(user_id), dict.fromkeys(sids, now))
+            pipe.zremrangebyscore(self.key(user_id), '-inf', now - self.ttl)
+            pipe.expire(self.key(user_id), self.ttl * 2)
+        pipe.execute()
+
+    def online(self, user_ids):
+        user_ids = list(set(user_ids))
+        cutoff = time.time() - self.ttl
+        pipe = self.redis.pipeline()
+        for user_id in user_ids:
+            pipe.zcount(self.key(user_id), cutoff, '+inf')
+        return {user_id for user_id, count in zip(user_ids, pipe.execute()) if count}
+
+
+def create_store(url, ttl=45, heartbeat=15):
+    if not url or url == 'memory':
+        return MemoryPresence()
+    if url.startswith(SQLITE_PREFIX):
+        return SqlitePresence(url, ttl, heartbeat)
+    if url.startswith(REDIS_PREFIXES):
+        return RedisPresence(url, ttl, heartbeat)
+    raise ValueError(f'Unsupported PRESENCE_URL: {url}')
+
+
+def presence_room(user_id):
+    return f'presence_{user_id}'
+
+
+class Presence:
+    """Application-wide handle on the configured presence backend"""
+
+    def __init__(self):
+        self.app = None
+        self.store = MemoryPresence()
+        self.coalesce = 2.0
+        self.pending = {}
+        self.flushing = False
+
+    def init_app(self, app):
+        self.app = app
+        self.store = create_store(
+            app.config['PRESENCE_URL'], app.config['PRESENCE_TTL'], app.config['PRESENCE_HEARTBEAT']
+        )
+        self.coalesce = app.config['PRESENCE_COALESCE']
+
+    def changed(self, user_id, was_online):
+        """Queue an announcement for a user whose status just flipped"""
+        # Keep the status from before the first change in this window
+        self.pending.setdefault(user_id, was_online)
+        if not self.flushing:
+            self.flushing = True
+            socketio.start_background_task(self._flush_loop)
+
+    def _flush_loop(self):
+        while True:
+            socketio.sleep(self.coalesce)
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('Presence flush failed')
+
+    def flush(self):
+        """Announce users whose status differs from before the window"""
+        pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        online = self.store.online(pending)
+        for user_id, was_online in pending.items():
+            is_online = user_id in online
+            if is_online != was_online:
+                socketio.emit('presence', {'user_id': user_id, 'online': is_online},
+                              to=presence_room(user_id))
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def __len__(self):
+        return len(self.store)
+
+
+presence = Presence()
@@ -0,0 +1,232 @@
+"""Soft deletes and the background purge.
+
+Deleting an item or an account used to load every dependent message into the
+session and delete them one by one inside the request. Now the request only
+writes a tombstone (``deleted_at``), which is a single UPDATE:
+
+* ``delete_item`` tombstones one listing
+* ``delete_user`` tombstones an account and, with one set-based UPDATE, all
+  of its listings
+
+Tombstoned items disappear from every ORM query at once, through
+``with_loader_criteria``. Pass ``execution_options(include_deleted=True)`` to
+see them. Tombstoned users cannot log in and have no profile page. Their rows
+stay until the purge has removed what they own.
+
+``purge`` removes the rows in dependency order: messages and archived
+messages, then conversations, then items and their now-unused upload files,
+then users. SQLite does not enforce foreign keys here, so no step relies on
+``ON DELETE``: each one deletes or detaches every row that points at what it
+removes. Each step deletes at most ``PURGE_BATCH_SIZE`` rows per
+transaction and pauses ``PURGE_PAUSE`` seconds between batches, so removing a
+power user never holds long locks. After any commit that writes a tombstone
+the purge starts as a background task. ``flask purge`` runs it by hand or from cron.
+"""
+import threading
+from collections import Counter
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import delete, event, or_, select, update
+from sqlalchemy.orm import with_loader_criteria
+from app import db, socketio, conversations, facets, images, recommend
+from app.models import User, Item, Message, ArchivedMessage, Conversation, ConversationMember
+from app.cache import cache
+from app.identity import forget_after_commit
+from app.pagination import invalidate_count
+
+
+def delete_item(item):
+    item.deleted_at = datetime.utcnow()
+    db.session.info['purge'] = True
+
+
+def delete_user(user):
+    """Tombstone ``user`` and their listings; the caller commits"""
+    now = datetime.utcnow()
+    user.deleted_at = now
+    live_items = Item.query.filter(Item.seller_id == user.id)
+    facets.forget(live_items)
+    db.session.execute(
+        update(Item).where(Item.seller_id == user.id, Item.deleted_at.is_(None))
+        .values(deleted_at=now)
+        .execution_options(synchronize_session=False)
+    )
+    cache.bump_after_commit()
+    invalidate_count(('profile_items', user.id))
+    db.session.info['purge'] = True
+
+
+def _deleted_items():
+    return select(Item.id).where(Item.deleted_at.isnot(None))
+
+
+def _deleted_users():
+    return select(User.id).where(User.deleted_at.isnot(None))
+
+
+def _ids(stmt, batch_size):
+    return db.session.execute(
+        stmt.limit(batch_size).execution_options(include_deleted=True)
+    ).all()
+
+
+def _purge_messages(batch_size):
+    rows = _ids(select(Message.id).where(or_(
+        Message.item_id.in_(_deleted_items()),
+        Message.sender_id.in_(_deleted_users()),
+        Message.recipient_id.in_(_deleted_users()),
+    )), batch_size)
+    ids = [row.id for row in rows]
+    if ids:
+        conversation_ids = conversations.forget_messages(Message.query.filter(Message.id.in_(ids)))
+        db.session.execute(delete(Message).where(Message.id.in_(ids)).execution_options(synchronize_session=False))
+        conversations.refresh(conversation_ids)
+    return len(ids), None
+
+
+def _purge_archived_messages(batch_size):
+    deleted_conversations = select(Conversation.id).where(or_(
+        Conversation.user_low_id.in_(_deleted_users()),
+        Conversation.user_high_id.in_(_deleted_users()),
+    ))
+    ids = [row.id for row in _ids(select(ArchivedMessage.id).where(or_(
+        ArchivedMessage.item_id.in_(_deleted_items()),
+        ArchivedMessage.conversation_id.in_(deleted_conversations),
+    )), batch_size)]
+    if ids:
+        # Archived messages are read and never a thread's latest, so no counters change
+        db.session.execute(delete(ArchivedMessage).where(ArchivedMessage.id.in_(ids))
+                           .execution_options(synchronize_session=False))
+    return len(ids), None
+
+
+def _purge_conversations(batch_size):
+    ids = [row.id for row in _ids(select(Conversation.id).where(or_(
+        Conversation.user_low_id.in_(_deleted_users()),
+        Conversation.user_high_id.in_(_deleted_users()),
+    )), batch_size)]
+    if ids:
+        db.session.execute(delete(ConversationMember).where(ConversationMember.conversation_id.in_(ids))
+                           .execution_options(synchronize_session=False))
+        db.session.execute(delete(Conversation).where(Conversation.id.in_(ids))
+                           .execution_options(synchronize_session=False))
+    return len(ids), None
+
+
+def _purge_items(batch_size):
+    rows = _ids(select(Item.id, Item.image).where(Item.deleted_at.isnot(None)), batch_size)
+    ids = [row.id for row in rows]
+    if ids:
+        # Messages went first, so only the thread summaries still point here
+        db.session.execute(update(Conversation).where(Conversation.item_id.in_(ids)).values(item_id=None)
+                           .execution_options(synchronize_session=False))
+        recommend.forget(ids)
+        db.session.execute(delete(Item).where(Item.id.in_(ids))
+                           .execution_options(synchronize_session=False, include_deleted=True))
+    return len(ids), ('items', [row.image for row in rows])
+
+
+def _purge_users(batch_size):
+    rows = _ids(select(User.id, User.avatar).where(
+        User.deleted_at.isnot(None), ~User.id.in_(select(Item.seller_id))
+    ), batch_size)
+    ids = [row.id for row in rows]
+    if ids:
+        db.session.execute(delete(ConversationMember).where(ConversationMember.user_id.in_(ids))
+                           .execution_options(synchronize_session=False))
+        db.session.execute(delete(User).where(User.id.in_(ids)).execution_options(synchronize_session=False))
+        for user_id in ids:
+            forget_after_commit(user_id)
+    return len(ids), ('avatars', [row.avatar for row in rows])
+
+
+STEPS = (
+    ('messages', _purge_messages),
+    ('archived messages', _purge_archived_messages),
+    ('conversations', _purge_conversations),
+    ('items', _purge_items),
+    ('users', _purge_users),
+)
+
+
+def purge(batch_size=None, pause=None):
+    """Remove tombstoned rows and what they own; returns counts per kind"""
+    batch_size = batch_size or current_app.config['PURGE_BATCH_SIZE']
+    pause = current_app.config['PURGE_PAUSE'] if pause is None else pause
+    removed = Counter()
+    for name, step in STEPS:
+        while True:
+            count, files = step(batch_size)
+            db.session.commit()
+            if not count:
+                break
+            removed[name] += count
+            if files:
+                # Only once the rows are gone, so a rollback never loses a picture
+                removed['files'] += images.remove_unreferenced(*files)
+                db.session.commit()
+            # Yields to other green threads under eventlet, where time.sleep would block the hub
+            socketio.sleep(pause)
+    return removed
+
+
+class Purger:
+    """Runs ``purge`` as a background task, at most once at a time per process"""
+
+    def __init__(self):
+        self.app = None
+        self.lock = threading.Lock()
+        self.running = False
+        self.again = False
+
+    def init_app(self, app):
+        self.app = app
+
+    def schedule(self):
+        if self.app is None or not self.app.config['PURGE_IN_BACKGROUND']:
+            return
+        with self.lock:
+            if self.running:
+                # Pick up tombstones written while the current run was going
+                self.again = True
+                return
+            self.running = True
+        socketio.start_background_task(self._run)
+
+    def _run(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    purge()
+            except Exception:
+                # Tombstoned rows stay hidden; the next run or 'flask purge' retries
+                self.app.logger.exception('Purge failed')
+            with self.lock:
+                if not self.again:
+                    self.running = False
+                    return
+                self.again = False
+
+
+purger = Purger()
+
+
+@event.listens_for(db.session, 'do_orm_execute')
+def _hide_deleted_items(execute_state):
+    if (execute_state.is_select and not execute_state.is_column_load
+            and not execute_state.execution_options.get('include_deleted', False)):
+        execute_state.statement = execute_state.statement.options(
+            with_loader_criteria(Item, Item.deleted_at.is_(None), include_aliases=True)
+        )
+
+
+@event.listens_for(db.session, 'after_commit')
+def _schedule_after_commit(session):
+    if session.info.pop('purge', None):
+        purger.schedule()
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_after_rollback(session):
+    session.info.pop('purge', None)
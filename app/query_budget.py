@@ -0,0 +1,61 @@
+"""Per-request SQL statement counting.
+
+When ``QUERY_BUDGET_MODE`` is ``'warn'`` or ``'raise'``, every statement a
+request sends to the database is counted. Views declare how many statements
+they are allowed with ``@query_budget(n)``; going over the budget logs a
+warning or raises ``QueryBudgetExceeded`` so N+1 regressions show up in
+development and tests instead of in production. tests/test_query_budget.py
+requests every budgeted view in ``'raise'`` mode.
+"""
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def query_budget(limit):
+    """Declare the maximum number of SQL statements a view may issue"""
+    def decorator(view):
+        view.query_budget = limit
+        return view
+    return decorator
+
+
+def query_count():
+    """Statements issued so far by the current request"""
+    return g.get('sql_query_count', 0)
+
+
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.sql_query_count = g.get('sql_query_count', 0) + 1
+
+
+def _reset_count():
+    # g outlives the request when it runs inside an outer app context (tests, db-explain)
+    g.sql_query_count = 0
+
+
+def _check_budget(response):
+    view = current_app.view_functions.get(request.endpoint)
+    limit = getattr(view, 'query_budget', current_app.config['QUERY_BUDGET_DEFAULT'])
+    count = query_count()
+    response.headers['X-SQL-Queries'] = str(count)
+    if limit is not None and count > limit:
+        message = f'{request.endpoint} issued {count} SQL statements (budget {limit})'
+        if current_app.config['QUERY_BUDGET_MODE'] == 'raise':
+            raise QueryBudgetExceeded(message)
+        current_app.logger.warning(message)
+    return response
+
+
+def init_app(app):
+    if app.config['QUERY_BUDGET_MODE'] not in ('warn', 'raise'):
+        return
+    if not event.contains(Engine, 'before_cursor_execute', _count_statement):
+        event.listen(Engine, 'before_cursor_execute', _count_statement)
+    app.before_request(_reset_count)
+    app.after_request(_check_budget)
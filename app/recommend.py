@@ -0,0 +1,360 @@
+"""Precomputed "similar items" and "more from this seller" lists.
+
+Every listing has a TF-IDF vector of its name (counted ``NAME_WEIGHT`` times)
+and description. Two listings score
+
+    TEXT_WEIGHT * cosine + CATEGORY_WEIGHT * same category + RARITY_WEIGHT * same rarity
+
+``item_recommendation`` keeps the ``RECOMMEND_TOP_K`` best scores per item,
+of two kinds: ``similar`` over the whole catalog and ``seller`` among the same
+seller's listings. ``item_detail`` reads both with one query, a range scan
+on the table's primary key.
+
+``rebuild`` (``flask recommend-rebuild``) recomputes everything in one pass
+with an inverted index, so only listings that share a term are compared.
+Terms in more than ``COMMON_TERM_RATIO`` of the listings carry almost no
+weight and are left out of the index, which keeps the pass near linear.
+
+After a commit that creates, edits or deletes listings, ``update`` runs as a
+background task. It recounts the document frequencies from the stored
+``item_vector``, compares each changed listing with the newest
+``RECOMMEND_CANDIDATES`` of its category and of its seller, and rewrites its
+lists. Where the changed listing now beats an entry in a candidate's lists,
+it takes that entry's place. A list that loses an edited or deleted listing
+stays one short until the next rebuild, and listings in other categories
+that share only text are found by the rebuild alone. When
+``RECOMMEND_REBUILD_AT`` or more listings changed at once, as after a bulk
+import, a rebuild runs instead.
+"""
+import heapq
+import json
+import math
+import re
+import threading
+from collections import Counter, defaultdict
+
+from flask import current_app
+from sqlalchemy import delete, event, func, inspect, insert, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import joinedload
+from app import db, socketio
+from app.models import Item, ItemRecommendation, ItemVector, RecommendationTerm
+
+TOKEN = re.compile(r'[^\W\d_]{2,}', re.UNICODE)
+NAME_WEIGHT = 2
+TEXT_WEIGHT = 0.6
+CATEGORY_WEIGHT = 0.3
+RARITY_WEIGHT = 0.1
+COMMON_TERM_RATIO = 0.5
+KINDS = ('similar', 'seller')
+# Item columns the scores need
+COLUMNS = (Item.id, Item.name, Item.description, Item.category, Item.rarity, Item.seller_id)
+# Changes to these columns move an item's scores
+TRACKED = ('name', 'description', 'category', 'rarity', 'seller_id', 'deleted_at')
+INSERT_CHUNK = 5000
+
+
+def term_frequencies(name, description):
+    """Sublinear term frequencies of a listing's text"""
+    counts = Counter()
+    for text, weight in ((name, NAME_WEIGHT), (description, 1)):
+        for term in TOKEN.findall(text.lower()):
+            if len(term) <= 100:
+                counts[term] += weight
+    return {term: round(1 + math.log(count), 4) for term, count in counts.items()}
+
+
+def _idf(documents, total):
+    return math.log((total + 1) / (documents + 1)) + 1
+
+
+def _normalized(frequencies, idf):
+    weights = {term: frequency * idf(term) for term, frequency in frequencies.items()}
+    norm = math.sqrt(sum(weight * weight for weight in weights.values())) or 1.0
+    return {term: weight / norm for term, weight in weights.items()}
+
+
+def _cosine(a, b):
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(weight * b.get(term, 0.0) for term, weight in a.items())
+
+
+def _score(text, a, b):
+    return (TEXT_WEIGHT * text + CATEGORY_WEIGHT * (a.category == b.category)
+            + RARITY_WEIGHT * (a.rarity == b.rarity))
+
+
+def _top(row, candidates, text, k):
+    """``[(score, id)]`` of the best ``k`` candidates for ``row``, newest first on ties"""
+    scores = ((round(_score(text.get(other.id, 0.0), row, other), 6), other.id)
+              for other in candidates if other.id != row.id)
+    # A listing with nothing in common is no recommendation
+    return heapq.nlargest(k, (entry for entry in scores if entry[0] > 0))
+
+
+def _insert(model, rows):
+    for start in range(0, len(rows), INSERT_CHUNK):
+        db.session.execute(insert(model), rows[start:start + INSERT_CHUNK])
+
+
+def _newest(query, limit):
+    return query.order_by(Item.created_at.desc(), Item.id.desc()).limit(limit)
+
+
+def rebuild():
+    """Recompute every vector and list in one pass; returns the number of listings"""
+    config = current_app.config
+    k, limit = config['RECOMMEND_TOP_K'], config['RECOMMEND_CANDIDATES']
+    rows = db.session.execute(
+        select(*COLUMNS).where(Item.deleted_at.is_(None)).order_by(Item.created_at.desc(), Item.id.desc())
+    ).all()
+
+    frequencies = {row.id: term_frequencies(row.name, row.description) for row in rows}
+    documents = Counter(term for terms in frequencies.values() for term in terms)
+    total = len(rows)
+    vectors = {item_id: _normalized(terms, lambda term: _idf(documents[term], total))
+               for item_id, terms in frequencies.items()}
+
+    postings = defaultdict(list)
+    common = max(COMMON_TERM_RATIO * total, 2)
+    for item_id, vector in vectors.items():
+        for term, weight in vector.items():
+            if documents[term] <= common:
+                postings[term].append((item_id, weight))
+
+    # Rows are newest first, so these lists are too
+    by_id = {row.id: row for row in rows}
+    by_seller = defaultdict(list)
+    by_category = defaultdict(list)
+    for row in rows:
+        if len(by_seller[row.seller_id]) < limit:
+            by_seller[row.seller_id].append(row)
+        for key in ((row.category,), (row.category, row.rarity)):
+            if len(by_category[key]) < k + 1:
+                by_category[key].append(row)
+
+    recommendations = []
+    for row in rows:
+        text = Counter()
+        for term, weight in vectors[row.id].items():
+            for other_id, other_weight in postings.get(term, ()):
+                text[other_id] += weight * other_weight
+        # Listings without shared terms score on category and rarity alone; the newest few are enough
+        candidates = {by_id[other_id] for other_id in text} | set(by_category[(row.category,)]) \
+            | set(by_category[(row.category, row.rarity)])
+        for kind, pool in (('similar', candidates), ('seller', by_seller[row.seller_id])):
+            recommendations.extend(
+                {'item_id': row.id, 'kind': kind, 'recommended_id': other_id, 'score': score}
+                for score, other_id in _top(row, pool, text, k)
+            )
+
+    db.session.execute(delete(ItemRecommendation))
+    db.session.execute(delete(ItemVector))
+    db.session.execute(delete(RecommendationTerm))
+    _insert(ItemVector, [{'item_id': item_id, 'terms': json.dumps(terms)} for item_id, terms in frequencies.items()])
+    _insert(RecommendationTerm, [{'term': term, 'documents': count} for term, count in documents.items()])
+    _insert(ItemRecommendation, recommendations)
+    db.session.commit()
+    return total
+
+
+def _adjust_documents(deltas):
+    """Add each ``{term: delta}`` to the stored document frequencies"""
+    connection = db.session.connection()
+    table = RecommendationTerm.__table__
+    dialect = connection.dialect.name
+    for term, delta in deltas.items():
+        if not delta:
+            continue
+        if dialect in ('sqlite', 'postgresql'):
+            dialect_insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+            stmt = dialect_insert(table).values(term=term, documents=max(delta, 0))
+            connection.execute(stmt.on_conflict_do_update(
+                index_elements=[table.c.term], set_={'documents': table.c.documents + delta}
+            ))
+            continue
+        updated = connection.execute(
+            update(table).where(table.c.term == term).values(documents=table.c.documents + delta)
+        ).rowcount
+        if not updated:
+            connection.execute(insert(table).values(term=term, documents=max(delta, 0)))
+
+
+def forget(item_ids):
+    """Drop listings from the index, e.g. before they are deleted"""
+    item_ids = list(item_ids)
+    if not item_ids:
+        return
+    stored = db.session.execute(select(ItemVector.terms).where(ItemVector.item_id.in_(item_ids))).scalars()
+    _adjust_documents(Counter({term: -1 for terms in stored for term in json.loads(terms)}))
+    for model, column in ((ItemVector, ItemVector.item_id), (ItemRecommendation, ItemRecommendation.item_id),
+                          (ItemRecommendation, ItemRecommendation.recommended_id)):
+        db.session.execute(delete(model).where(column.in_(item_ids)).execution_options(synchronize_session=False))
+
+
+def _reindex(row):
+    """Store a listing's new vector and return it"""
+    terms = term_frequencies(row.name, row.description)
+    stored = db.session.get(ItemVector, row.id)
+    old = set(json.loads(stored.terms)) if stored else set()
+    deltas = Counter({term: 1 for term in set(terms) - old})
+    deltas.update({term: -1 for term in old - set(terms)})
+    _adjust_documents(deltas)
+    db.session.merge(ItemVector(item_id=row.id, terms=json.dumps(terms)))
+    return terms
+
+
+def _update_one(row, k, limit):
+    terms = _reindex(row)
+    db.session.flush()
+
+    same_category = _newest(select(*COLUMNS).where(Item.category == row.category), limit)
+    same_seller = _newest(select(*COLUMNS).where(Item.seller_id == row.seller_id), limit)
+    candidates = {other.id: other for query in (same_category, same_seller)
+                  for other in db.session.execute(query) if other.id != row.id}
+    stored = {item_id: json.loads(vector) for item_id, vector in db.session.execute(
+        select(ItemVector.item_id, ItemVector.terms).where(ItemVector.item_id.in_(list(candidates)))
+    )}
+    vocabulary = set(terms).union(*stored.values())
+    documents = dict(db.session.execute(
+        select(RecommendationTerm.term, RecommendationTerm.documents)
+        .where(RecommendationTerm.term.in_(list(vocabulary)))
+    ).all())
+    total = db.session.query(func.count(ItemVector.item_id)).scalar()
+
+    def idf(term):
+        return _idf(documents.get(term, 0), total)
+    vector = _normalized(terms, idf)
+    text = {other_id: _cosine(vector, _normalized(other_terms, idf)) for other_id, other_terms in stored.items()}
+
+    # This listing's own lists, and its scores in the lists that mention it
+    db.session.execute(delete(ItemRecommendation).where(
+        (ItemRecommendation.item_id == row.id) | (ItemRecommendation.recommended_id == row.id)
+    ).execution_options(synchronize_session=False))
+    pools = {
+        'similar': list(candidates.values()),
+        'seller': [other for other in candidates.values() if other.seller_id == row.seller_id],
+    }
+    _insert(ItemRecommendation, [
+        {'item_id': row.id, 'kind': kind, 'recommended_id': other_id, 'score': score}
+        for kind, pool in pools.items() for score, other_id in _top(row, pool, text, k)
+    ])
+
+    lists = defaultdict(list)
+    for entry in db.session.execute(
+        select(ItemRecommendation.item_id, ItemRecommendation.kind, ItemRecommendation.recommended_id,
+               ItemRecommendation.score).where(ItemRecommendation.item_id.in_(list(candidates)))
+    ):
+        lists[(entry.item_id, entry.kind)].append(entry)
+    for kind, pool in pools.items():
+        for other in pool:
+            score = round(_score(text.get(other.id, 0.0), other, row), 6)
+            if score <= 0:
+                continue
+            entries = lists[(other.id, kind)]
+            if len(entries) >= k:
+                weakest = min(entries, key=lambda entry: (entry.score, entry.recommended_id))
+                if (weakest.score, weakest.recommended_id) >= (score, row.id):
+                    continue
+                db.session.execute(delete(ItemRecommendation).where(
+                    ItemRecommendation.item_id == other.id, ItemRecommendation.kind == kind,
+                    ItemRecommendation.recommended_id == weakest.recommended_id
+                ).execution_options(synchronize_session=False))
+            db.session.execute(insert(ItemRecommendation).values(
+                item_id=other.id, kind=kind, recommended_id=row.id, score=score
+            ))
+
+
+def update(item_ids):
+    """Re-score changed listings and forget deleted ones"""
+    config = current_app.config
+    item_ids = set(item_ids)
+    if len(item_ids) >= config['RECOMMEND_REBUILD_AT']:
+        rebuild()
+        return
+    rows = db.session.execute(select(*COLUMNS).where(Item.id.in_(item_ids), Item.deleted_at.is_(None))).all()
+    forget(item_ids - {row.id for row in rows})
+    for row in rows:
+        _update_one(row, config['RECOMMEND_TOP_K'], config['RECOMMEND_CANDIDATES'])
+    db.session.commit()
+
+
+def for_item(item_id):
+    """``{kind: [Item, ...]}`` of an item's stored recommendations, best first"""
+    rows = db.session.query(ItemRecommendation.kind, Item).join(
+        Item, Item.id == ItemRecommendation.recommended_id
+    ).options(joinedload(Item.seller)).filter(ItemRecommendation.item_id == item_id).order_by(
+        ItemRecommendation.score.desc(), ItemRecommendation.recommended_id.desc()
+    ).all()
+    related = {kind: [] for kind in KINDS}
+    for kind, item in rows:
+        related[kind].append(item)
+    return related
+
+
+class Recommender:
+    """Runs ``update`` as a background task, at most once at a time per process"""
+
+    def __init__(self):
+        self.app = None
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.running = False
+
+    def init_app(self, app):
+        self.app = app
+
+    def schedule(self, item_ids):
+        if self.app is None or not self.app.config['RECOMMEND_IN_BACKGROUND']:
+            return
+        with self.lock:
+            self.pending |= item_ids
+            if self.running:
+                return
+            self.running = True
+        socketio.start_background_task(self._run)
+
+    def _run(self):
+        while True:
+            with self.lock:
+                item_ids, self.pending = self.pending, set()
+                if not item_ids:
+                    self.running = False
+                    return
+            try:
+                with self.app.app_context():
+                    update(item_ids)
+            except Exception:
+                # Lists go stale until the next change or 'flask recommend-rebuild'
+                self.app.logger.exception('Recommendation update failed')
+
+
+recommender = Recommender()
+
+
+@event.listens_for(db.session, 'after_flush')
+def _track_item_writes(session, flush_context):
+    changed = set()
+    for obj in session.new:
+        if isinstance(obj, Item):
+            changed.add(obj.id)
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Item) and (obj in session.deleted or any(
+            inspect(obj).attrs[key].history.has_changes() for key in TRACKED
+        )):
+            changed.add(obj.id)
+    if changed:
+        session.info.setdefault('recommend', set()).update(changed)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _schedule_after_commit(session):
+    changed = session.info.pop('recommend', None)
+    if changed:
+        recommender.schedule(changed)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_after_rollback(session):
+    session.info.pop('recommend', None)
@@ -1,65 +1,85 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, request, current_app
+from flask import Blueprint, render_template, redirect, url_for, flash, request, current_app, jsonify, \
+    Response, stream_with_context, abort
 from flask_login import login_user, logout_user, login_required, current_user
 from werkzeug.utils import secure_filename
-from PIL import Image
-import os
-import secrets
-from app import db
-from app.models import User, Item, Message
-from app.forms import RegistrationForm, LoginForm, ItemForm, MessageForm, ProfileForm
+from app import db, conversations, archive, images, metrics, bulk, facets, purge, recommend
+from app.models import User, Item, Message, ConversationMember, Conversation
+from app.forms import RegistrationForm, LoginForm, ItemForm, MessageForm, ProfileForm, ImportForm
+from app.search import search_items
+from app.pagination import keyset_paginate, offset_paginate, cached_count, invalidate_count
+from app.query_budget import query_budget
+from app.database import replica_reads
+from app.presence import presence
+from app.cache import cache
+from app.identity import identity
 from sqlalchemy import or_, and_
+from sqlalchemy.orm import joinedload
+import time
 
 main = Blueprint('main', __name__)
 auth = Blueprint('auth', __name__, url_prefix='/auth')
 
 # Helper function for saving pictures
-def save_picture(form_picture, folder, size=(500, 500)):
-    """Save and resize uploaded pictures"""
-    random_hex = secrets.token_hex(8)
-    _, f_ext = os.path.splitext(form_picture.filename)
-    picture_fn = random_hex + f_ext
-    picture_path = os.path.join(current_app.root_path, 'static', 'uploads', folder, picture_fn)
-    
-    # Resize image
-    output_size = size
-    img = Image.open(form_picture)
-    img.thumbnail(output_size)
-    img.save(picture_path)
-    
-    return picture_fn
+def save_picture(form_picture, folder):
+    """Store an uploaded picture; resizing happens in the background image pipeline"""
+    started = time.perf_counter()
+    filename = images.save_upload(form_picture, folder)
+    metrics.upload_seconds.observe(time.perf_counter() - started, folder=folder)
+    return filename
 
 @main.route('/')
+@query_budget(2)
+@replica_reads
 def index():
-    items = Item.query.order_by(Item.created_at.desc()).limit(6).all()
-    return render_template('index.html', items=items)
+    def render_cards():
+        items = Item.query.options(joinedload(Item.seller)).order_by(Item.created_at.desc()).limit(6).all()
+        return render_template('_index_cards.html', items=items) if items else ''
+    
+    cards = cache.fragment('index', (), render_cards)
+    return render_template('index.html', cards=cards)
 
 @main.route('/marketplace')
+# A search with typos costs up to 3 statements for the cards and 3 for the facet counts
+@query_budget(7)
+@replica_reads
 def marketplace():
-    page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor')
     category = request.args.get('category', 'all')
     rarity = request.args.get('rarity', 'all')
     search = request.args.get('search', '')
     
-    query = Item.query
-    
-    if category != 'all':
-        query = query.filter_by(category=category)
-    if rarity != 'all':
-        query = query.filter_by(rarity=rarity)
-    if search:
-        query = query.filter(Item.name.ilike(f'%{search}%'))
-    
-    items = query.order_by(Item.created_at.desc()).paginate(
-        page=page, per_page=12, error_out=False
-    )
-    
-    return render_template('marketplace.html', items=items, 
-                         category=category, rarity=rarity, search=search)
+    def render_cards():
+        query = Item.query.options(joinedload(Item.seller))
+        
+        if category != 'all':
+            query = query.filter_by(category=category)
+        if rarity != 'all':
+            query = query.filter_by(rarity=rarity)
+        if search:
+            items = offset_paginate(search_items(query, search), 12, cursor)
+        else:
+            items = keyset_paginate(query, (Item.created_at, Item.id), 12, cursor)
+        if not items.items:
+            return ''
+        return render_template('_marketplace_cards.html', items=items,
+                               category=category, rarity=rarity, search=search)
+    
+    # Item cards are shared by every visitor; only the page chrome is per user
+    cards = cache.fragment('marketplace', (category, rarity, search, cursor), render_cards)
+    categories, rarities = facets.options(facets.counts(search), category, rarity)
+    return render_template('marketplace.html', cards=cards, 
+                         category=category, rarity=rarity, search=search,
+                         categories=categories, rarities=rarities)
 
 @main.route('/item/<int:item_id>')
+# The item, then both related-listing lists in one query
+@query_budget(3)
+@replica_reads
 def item_detail(item_id):
-    item = Item.query.get_or_404(item_id)
-    return render_template('item_detail.html', item=item)
+    item = Item.query.options(joinedload(Item.seller)).filter_by(id=item_id).first_or_404()
+    related = recommend.for_item(item_id)
+    return render_template('item_detail.html', item=item, similar=related['similar'],
+                           seller_items=related['seller'])
 
 @main.route('/item/create', methods=['GET', 'POST'])
 @login_required
@@ -82,6 +102,7 @@ def create_item():
         )
         db.session.add(item)
         db.session.commit()
+        invalidate_count(('profile_items', current_user.id))
         flash('Your item has been listed!', 'success')
         return redirect(url_for('main.item_detail', item_id=item.id))
     return render_template('create_item.html', form=form)
@@ -129,19 +150,57 @@ def delete_item(item_id):
         flash('You can only delete your own items.', 'danger')
         return redirect(url_for('main.item_detail', item_id=item.id))
     
-    db.session.delete(item)
+    # Tombstone only; its messages and files are removed by the background purge
+    purge.delete_item(item)
     db.session.commit()
+    invalidate_count(('profile_items', current_user.id))
     
     flash('Item deleted successfully.', 'success')
     return redirect(url_for('main.marketplace'))
 
+@main.route('/item/import', methods=['GET', 'POST'])
+@login_required
+def import_items():
+    """Create many listings from a CSV/NDJSON file and an optional zip of images"""
+    # Listing files and image archives are allowed to be larger than single uploads
+    request.max_content_length = current_app.config['IMPORT_MAX_CONTENT_LENGTH']
+    form = ImportForm()
+    report = None
+    if form.validate_on_submit():
+        listings = form.listings.data
+        upload = bulk.open_archive(form.images.data) if form.images.data else None
+        report = bulk.import_items(
+            current_user, bulk.iter_rows(listings.stream, bulk.detect_format(listings.filename)), upload
+        )
+        flash(f'Imported {report.created} items, {len(report.errors)} rows rejected.',
+              'success' if not report.errors else 'warning')
+    return render_template('import_items.html', form=form, report=report)
+
+@main.route('/item/export')
+@login_required
+def export_items():
+    """Stream listings as CSV or NDJSON (?format=ndjson), optionally for one ?seller="""
+    fmt = 'ndjson' if request.args.get('format') == 'ndjson' else 'csv'
+    seller = None
+    if request.args.get('seller'):
+        seller = User.query.filter_by(username=request.args['seller']).first_or_404()
+    filename = f"listings-{seller.username if seller else 'all'}.{fmt}"
+    return Response(
+        stream_with_context(bulk.export_items(fmt, seller)),
+        mimetype='text/csv' if fmt == 'csv' else 'application/x-ndjson',
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
+
 @main.route('/profile/<username>')
+@query_budget(4)
+@replica_reads
 def profile(username):
-    user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get('page', 1, type=int)
-    items = Item.query.filter_by(seller_id=user.id).order_by(
-        Item.created_at.desc()
-    ).paginate(page=page, per_page=9, error_out=False)
+    user = User.query.filter_by(username=username, deleted_at=None).first_or_404()
+    query = Item.query.filter_by(seller_id=user.id)
+    items = keyset_paginate(
+        query, (Item.created_at, Item.id), 9, request.args.get('cursor'),
+        total=cached_count(('profile_items', user.id), query)
+    )
     
     return render_template('profile.html', user=user, items=items)
 
@@ -151,7 +210,7 @@ def edit_profile():
     form = ProfileForm()
     if form.validate_on_submit():
         if form.avatar.data:
-            avatar_file = save_picture(form.avatar.data, 'avatars', size=(200, 200))
+            avatar_file = save_picture(form.avatar.data, 'avatars')
             current_user.avatar = avatar_file
             db.session.commit()
             flash('Profile picture updated!', 'success')
@@ -160,22 +219,31 @@ def edit_profile():
     return render_template('edit_profile.html', form=form)
 
 @main.route('/messages/inbox')
+@query_budget(2)
 @login_required
 def inbox():
-    page = request.args.get('page', 1, type=int)
-    messages = Message.query.filter_by(recipient_id=current_user.id).order_by(
-        Message.timestamp.desc()
-    ).paginate(page=page, per_page=20, error_out=False)
+    threads = keyset_paginate(
+        ConversationMember.query.options(
+            joinedload(ConversationMember.conversation).options(
+                joinedload(Conversation.user_low),
+                joinedload(Conversation.user_high),
+                joinedload(Conversation.last_message)
+            )
+        ).filter_by(user_id=current_user.id),
+        (ConversationMember.last_activity, ConversationMember.conversation_id), 20,
+        request.args.get('cursor')
+    )
     
-    return render_template('messages/inbox.html', messages=messages)
+    return render_template('messages/inbox.html', threads=threads)
 
 @main.route('/messages/sent')
+@query_budget(2)
 @login_required
 def sent():
-    page = request.args.get('page', 1, type=int)
-    messages = Message.query.filter_by(sender_id=current_user.id).order_by(
-        Message.timestamp.desc()
-    ).paginate(page=page, per_page=20, error_out=False)
+    messages = keyset_paginate(
+        Message.query.options(joinedload(Message.recipient)).filter_by(sender_id=current_user.id),
+        (Message.timestamp, Message.id), 20, request.args.get('cursor')
+    )
     
     return render_template('messages/sent.html', messages=messages)
 
@@ -183,20 +251,20 @@ def sent():
 @main.route('/messages/compose/<int:recipient_id>/<int:item_id>', methods=['GET', 'POST'])
 @login_required
 def compose_message(recipient_id, item_id=None):
-    recipient = User.query.get_or_404(recipient_id)
+    recipient = User.query.filter_by(id=recipient_id, deleted_at=None).first_or_404()
     item = Item.query.get(item_id) if item_id else None
     
     form = MessageForm()
     
     if form.validate_on_submit():
         message = Message(
-            sender=current_user,
-            recipient=recipient,
+            sender_id=current_user.id,
+            recipient_id=recipient.id,
             item_id=item_id,
             subject=form.subject.data,
             content=form.content.data
         )
-        db.session.add(message)
+        conversations.add_message(message)
         db.session.commit()
         
         flash('Message sent successfully!', 'success')
@@ -209,9 +277,15 @@ def compose_message(recipient_id, item_id=None):
     return render_template('messages/compose.html', form=form, recipient=recipient, item=item)
 
 @main.route('/messages/<int:message_id>')
+@query_budget(6)
 @login_required
 def view_message(message_id):
-    message = Message.query.get_or_404(message_id)
+    # Old messages may have moved to the archive
+    message = Message.query.options(
+        joinedload(Message.sender), joinedload(Message.recipient), joinedload(Message.item)
+    ).filter_by(id=message_id).first() or archive.find(message_id)
+    if message is None:
+        abort(404)
     
     # Check if user is sender or recipient
     if message.recipient_id != current_user.id and message.sender_id != current_user.id:
@@ -220,7 +294,7 @@ def view_message(message_id):
     
     # Mark as read if recipient is viewing
     if message.recipient_id == current_user.id and not message.read:
-        message.read = True
+        conversations.mark_message_read(message)
         db.session.commit()
     
     return render_template('messages/view.html', message=message)
@@ -228,14 +302,16 @@ def view_message(message_id):
 @main.route('/messages/<int:message_id>/delete', methods=['POST'])
 @login_required
 def delete_message(message_id):
-    message = Message.query.get_or_404(message_id)
+    message = Message.query.get(message_id) or archive.find(message_id)
+    if message is None:
+        abort(404)
     
     # Check if user is sender or recipient
     if message.recipient_id != current_user.id and message.sender_id != current_user.id:
         flash('Unauthorized access.', 'danger')
         return redirect(url_for('main.inbox'))
     
-    db.session.delete(message)
+    conversations.remove_message(message)
     db.session.commit()
     
     flash('Message deleted.', 'success')
@@ -263,8 +339,12 @@ def login():
     
     form = LoginForm()
     if form.validate_on_submit():
-        user = User.query.filter_by(username=form.username.data).first()
+        user = User.query.filter_by(username=form.username.data, deleted_at=None).first()
         if user and user.check_password(form.password.data):
+            if user.password_needs_rehash():
+                # Hashing settings changed since this hash was made
+                user.set_password(form.password.data)
+                db.session.commit()
             login_user(user)
             flash(f'Welcome back, {user.username}!', 'success')
             next_page = request.args.get('next')
@@ -276,33 +356,70 @@ def login():
 @auth.route('/logout')
 @login_required
 def logout():
+    identity.forget(current_user.id)
     logout_user()
     flash('You have been logged out.', 'info')
     return redirect(url_for('main.index'))
 
+@auth.route('/delete', methods=['POST'])
+@login_required
+def delete_account():
+    # Tombstone only; listings, messages and files are removed by the background purge
+    user_id = current_user.id
+    purge.delete_user(current_user._get_current_object())
+    db.session.commit()
+    identity.forget(user_id)
+    logout_user()
+    flash('Your account has been deleted.', 'info')
+    return redirect(url_for('main.index'))
+
 @main.route('/messages/chat/<int:other_user_id>')
 @main.route('/messages/chat/<int:other_user_id>/<int:item_id>')
+@query_budget(10)
 @login_required
 def chat(other_user_id, item_id=None):
     """Real-time chat interface"""
     other_user = User.query.get_or_404(other_user_id)
     item = Item.query.get(item_id) if item_id else None
     
-    # Get existing messages between these two users
-    messages = Message.query.filter(
-        db.or_(
-            db.and_(Message.sender_id == current_user.id, Message.recipient_id == other_user_id),
-            db.and_(Message.sender_id == other_user_id, Message.recipient_id == current_user.id)
-        )
-    ).order_by(Message.timestamp.desc()).limit(50).all()
-    
-    # Mark messages as read
-    for msg in messages:
-        if msg.recipient_id == current_user.id and not msg.read:
-            msg.read = True
-    db.session.commit()
+    # Mark read up to the newest message, then load the latest page
+    messages, older_cursor = [], None
+    conversation = conversations.find(current_user.id, other_user_id)
+    if conversation:
+        conversation_id, archived_through = conversation.id, conversation.archived_through
+        if conversation.last_message_id:
+            conversations.mark_read(conversation_id, current_user.id, up_to=conversation.last_message_id)
+            db.session.commit()
+        messages, older_cursor = conversations.history(conversation_id, current_app.config['CHAT_PAGE_SIZE'],
+                                                       archived_through=archived_through)
     
     return render_template('messages/chat.html', 
                          other_user=other_user, 
                          item=item, 
-                         messages=reversed(messages))
\ No newline at end of file
+                         messages=messages,
+                         older_cursor=older_cursor)
+
+@main.route('/messages/chat/<int:other_user_id>/history')
+# One more statement for pages that reach into the message archive
+@query_budget(4)
+@login_required
+def chat_history(other_user_id):
+    """Older chat messages as JSON, one page per ?cursor= token"""
+    conversation = conversations.find(current_user.id, other_user_id)
+    if not conversation:
+        return jsonify(messages=[], cursor=None)
+    messages, older_cursor = conversations.history(
+        conversation.id, current_app.config['CHAT_PAGE_SIZE'], request.args.get('cursor'),
+        archived_through=conversation.archived_through
+    )
+    return jsonify(messages=[conversations.message_payload(m) for m in messages], cursor=older_cursor)
+
+
+@main.route('/presence')
+@query_budget(1)
+@login_required
+def presence_status():
+    """Which of the given users (?ids=1,2,3) are online"""
+    limit = current_app.config['PRESENCE_MAX_SUBSCRIPTIONS']
+    user_ids = [int(user_id) for user_id in request.args.get('ids', '').split(',') if user_id.isdigit()][:limit]
+    return jsonify(online=sorted(presence.online(user_ids)))
@@ -0,0 +1,168 @@
+"""Full-text search over marketplace items.
+
+SQLite keeps an FTS5 external-content table in sync with ``item`` through
+triggers, so every insert/update/delete done by the routes is indexed in the
+same transaction. PostgreSQL uses a GIN index over a tsvector expression plus
+a trigram index on ``name`` for typo tolerance. Any other database falls back
+to the old ILIKE scan.
+"""
+import difflib
+import re
+
+from sqlalchemy import column, event, false, func, literal_column, or_, table, text
+from app import db
+from app.models import Item
+
+MAX_TERMS = 8
+FUZZY_CUTOFF = 0.75
+FUZZY_CANDIDATES = 3
+
+_token_re = re.compile(r'\w+', re.UNICODE)
+_item_fts = table('item_fts', column('rowid'))
+
+SQLITE_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS item_fts USING fts5(
+        name, description,
+        content='item', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )""",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS item_fts_vocab USING fts5vocab(item_fts, 'row')",
+    """CREATE TRIGGER IF NOT EXISTS item_fts_ai AFTER INSERT ON item BEGIN
+        INSERT INTO item_fts(rowid, name, description) VALUES (new.id, new.name, new.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS item_fts_ad AFTER DELETE ON item BEGIN
+        INSERT INTO item_fts(item_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS item_fts_au AFTER UPDATE OF name, description ON item BEGIN
+        INSERT INTO item_fts(item_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+        INSERT INTO item_fts(rowid, name, description) VALUES (new.id, new.name, new.description);
+    END""",
+]
+
+POSTGRES_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    """CREATE INDEX IF NOT EXISTS ix_item_search ON item
+        USING GIN (to_tsvector('english', name || ' ' || description))""",
+    "CREATE INDEX IF NOT EXISTS ix_item_name_trgm ON item USING GIN (name gin_trgm_ops)",
+]
+
+
+def _terms(search):
+    return _token_re.findall(search.lower())[:MAX_TERMS]
+
+
+def create_index(connection):
+    """Create the search index for the connected database if it is missing"""
+    dialect = connection.dialect.name
+    if dialect == 'sqlite':
+        exists = connection.execute(
+            text("SELECT 1 FROM sqlite_master WHERE name = 'item_fts'")
+        ).first()
+        for statement in SQLITE_DDL:
+            connection.execute(text(statement))
+        if not exists:
+            # Index rows that were written before the FTS table existed
+            connection.execute(text("INSERT INTO item_fts(item_fts) VALUES ('rebuild')"))
+    elif dialect == 'postgresql':
+        for statement in POSTGRES_DDL:
+            connection.execute(text(statement))
+
+
+def rebuild_index():
+    """Recreate the search index from the item table"""
+    with db.engine.begin() as connection:
+        create_index(connection)
+        if connection.dialect.name == 'sqlite':
+            connection.execute(text("INSERT INTO item_fts(item_fts) VALUES ('rebuild')"))
+        elif connection.dialect.name == 'postgresql':
+            connection.execute(text('REINDEX INDEX ix_item_search'))
+            connection.execute(text('REINDEX INDEX ix_item_name_trgm'))
+
+
+@event.listens_for(db.metadata, 'after_create')
+def _create_index_after_create_all(target, connection, **kw):
+    create_index(connection)
+
+
+def _next_prefix(prefix):
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def _sqlite_match(terms):
+    """Build an FTS5 MATCH expression with prefix and typo alternatives
+
+    Both vocabulary lookups are batched across all terms so a search costs at
+    most two small queries on top of the MATCH itself.
+    """
+    params = {}
+    probes = []
+    for i, term in enumerate(terms):
+        params[f'lo{i}'], params[f'hi{i}'] = term, _next_prefix(term)
+        probes.append(
+            f'SELECT {i} WHERE EXISTS (SELECT 1 FROM item_fts_vocab '
+            f'WHERE term >= :lo{i} AND term < :hi{i})'
+        )
+    found = set(db.session.execute(text(' UNION ALL '.join(probes)), params).scalars())
+    missing = [term for i, term in enumerate(terms) if i not in found]
+
+    corrections = {}
+    if missing:
+        # Only words sharing the first letter are considered, which keeps the
+        # candidate scan bounded by a slice of the vocabulary
+        firsts = sorted({term[0] for term in missing})
+        params = {}
+        ranges = []
+        for i, first in enumerate(firsts):
+            params[f'lo{i}'], params[f'hi{i}'] = first, _next_prefix(first)
+            ranges.append(f'(term >= :lo{i} AND term < :hi{i})')
+        candidates = db.session.execute(
+            text('SELECT term FROM item_fts_vocab WHERE ' + ' OR '.join(ranges)), params
+        ).scalars().all()
+        for term in missing:
+            corrections[term] = difflib.get_close_matches(
+                term, [word for word in candidates if word[0] == term[0]],
+                n=FUZZY_CANDIDATES, cutoff=FUZZY_CUTOFF
+            )
+
+    groups = []
+    for term in terms:
+        alternatives = [f'"{term}"*'] + [f'"{word}"' for word in corrections.get(term, [])]
+        groups.append('(' + ' OR '.join(alternatives) + ')')
+    return ' AND '.join(groups)
+
+
+def _search_sqlite(query, terms):
+    match = _sqlite_match(terms)
+    return query.join(_item_fts, _item_fts.c.rowid == Item.id).filter(
+        text('item_fts MATCH :search_match').bindparams(search_match=match)
+    ).order_by(text('bm25(item_fts, 10.0, 1.0)'), Item.id.desc())
+
+
+def _search_postgresql(query, terms, search):
+    config = literal_column("'english'")
+    document = func.to_tsvector(config, Item.name.op('||')(literal_column("' '")).op('||')(Item.description))
+    tsquery = func.to_tsquery(config, ' & '.join(f'{term}:*' for term in terms))
+    rank = func.ts_rank(document, tsquery) + func.similarity(Item.name, search)
+    return query.filter(
+        or_(document.op('@@')(tsquery), Item.name.op('%')(search))
+    ).order_by(rank.desc(), Item.id.desc())
+
+
+def search_items(query, search):
+    """Restrict an Item query to matches for ``search``, best matches first"""
+    terms = _terms(search)
+    if not terms:
+        return query.filter(false())
+
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'sqlite':
+        return _search_sqlite(query, terms)
+    if dialect == 'postgresql':
+        return _search_postgresql(query, terms, search)
+
+    pattern = f'%{search}%'
+    return query.filter(
+        or_(Item.name.ilike(pattern), Item.description.ilike(pattern))
+    ).order_by(Item.created_at.desc())
@@ -1,106 +1,229 @@
-from flask import request
+from flask import request, current_app
 from flask_login import current_user
 from flask_socketio import emit, join_room, leave_room
-from app import socketio, db
-from app.models import Message, User
+from app import socketio, db, conversations, unread
+from app.chat_writer import writer as chat_writer
+from app.presence import presence, presence_room
+from app.identity import identity
+from app.metrics import socket_event
+from app.typing_indicators import tracker as typing_tracker
+from app.models import Item, Message, User
+from app.pagination import decode_cursor
 from datetime import datetime
-
-# Store active users and their rooms
-active_users = {}
+import uuid
 
 @socketio.on('connect')
+@socket_event
 def handle_connect():
     if current_user.is_authenticated:
-        active_users[request.sid] = current_user.id
-        emit('user_connected', {'user_id': current_user.id}, broadcast=True)
-        print(f"User {current_user.username} connected")
+        if presence.add(request.sid, current_user.id):
+            presence.changed(current_user.id, was_online=False)
+        join_room(unread.user_room(current_user.id))
+        current_app.logger.info('User %s connected', current_user.username)
 
 @socketio.on('disconnect')
+@socket_event
 def handle_disconnect():
-    if request.sid in active_users:
-        user_id = active_users[request.sid]
-        del active_users[request.sid]
-        emit('user_disconnected', {'user_id': user_id}, broadcast=True)
-        print(f"User disconnected")
+    identity.release(request.sid)
+    user_id, went_offline = presence.remove(request.sid)
+    if went_offline:
+        presence.changed(user_id, was_online=True)
+        typing_tracker.stop_all(user_id)
+    if user_id is not None:
+        current_app.logger.info('User %s disconnected', user_id)
+
+def _presence_ids(data):
+    limit = current_app.config['PRESENCE_MAX_SUBSCRIPTIONS']
+    try:
+        return list({int(user_id) for user_id in (data or {}).get('user_ids', [])})[:limit]
+    except (TypeError, ValueError):
+        return []
+
+@socketio.on('presence_subscribe')
+@socket_event
+def handle_presence_subscribe(data):
+    """Follow the online status of specific users; acks with who is online now"""
+    if not current_user.is_authenticated:
+        return
+    
+    user_ids = _presence_ids(data)
+    for user_id in user_ids:
+        join_room(presence_room(user_id))
+    return {'online': sorted(presence.online(user_ids))}
+
+@socketio.on('presence_unsubscribe')
+@socket_event
+def handle_presence_unsubscribe(data):
+    """Stop following users"""
+    for user_id in _presence_ids(data):
+        leave_room(presence_room(user_id))
+
+def _own_chat_room(data):
+    """The requested chat room if the current user is one of its pair, else None"""
+    room = (data or {}).get('room')
+    return room if conversations.in_chat_room(room, current_user.id) else None
 
 @socketio.on('join_chat')
+@socket_event
 def handle_join_chat(data):
-    """User joins a chat room with another user"""
+    """User joins the chat room they share with another user"""
     if not current_user.is_authenticated:
         return
     
-    room = data.get('room')
+    # Other rooms (user_<id>, presence_<id>) carry private pushes
+    room = _own_chat_room(data)
+    if room is None:
+        return {'error': 'Not your chat room'}
     join_room(room)
     emit('joined_chat', {'room': room, 'user': current_user.username}, room=room)
-    print(f"{current_user.username} joined room {room}")
+    current_app.logger.info('%s joined room %s', current_user.username, room)
 
 @socketio.on('leave_chat')
+@socket_event
 def handle_leave_chat(data):
     """User leaves a chat room"""
     if not current_user.is_authenticated:
         return
     
-    room = data.get('room')
+    room = _own_chat_room(data)
+    if room is None:
+        return
     leave_room(room)
     emit('left_chat', {'user': current_user.username}, room=room)
 
 @socketio.on('send_message')
+@socket_event
 def handle_send_message(data):
     """Handle real-time message sending"""
     if not current_user.is_authenticated:
         return
     
-    recipient_id = data.get('recipient_id')
+    data = data or {}
+    try:
+        recipient_id = int(data.get('recipient_id'))
+        item_id = int(data['item_id']) if data.get('item_id') else None
+    except (TypeError, ValueError):
+        return {'error': 'Invalid recipient or item'}
     content = data.get('content')
-    item_id = data.get('item_id')
-    room = data.get('room')
+    if not isinstance(content, str) or not content.strip():
+        return {'error': 'Empty message'}
     
-    # Save message to database
-    message = Message(
-        sender_id=current_user.id,
-        recipient_id=recipient_id,
-        content=content,
-        item_id=item_id,
-        subject=f"Chat message",
-        timestamp=datetime.utcnow()
-    )
-    db.session.add(message)
-    db.session.commit()
+    # Deleted accounts and listings take no new messages
+    recipient = db.session.query(User.id).filter_by(id=recipient_id, deleted_at=None).first()
+    if recipient is None or recipient_id == current_user.id:
+        return {'error': 'Unknown recipient'}
+    if item_id is not None and db.session.query(Item.id).filter_by(id=item_id, deleted_at=None).first() is None:
+        return {'error': 'Unknown item'}
+    # The client's room is not trusted; the pair decides where this goes
+    room = conversations.chat_room(current_user.id, recipient_id)
+    
+    row = {
+        'uid': uuid.uuid4().hex,
+        'sender_id': current_user.id,
+        'recipient_id': recipient_id,
+        'content': content,
+        'item_id': item_id,
+        'subject': "Chat message",
+        'timestamp': datetime.utcnow()
+    }
+    
+    typing_tracker.stop(room, current_user.id)
+    
+    # Save message to database, or hand it to the write-behind queue
+    message_id = None
+    if not (chat_writer.enabled and chat_writer.submit(row)):
+        message = Message(**row)
+        conversations.add_message(message)
+        db.session.commit()
+        message_id = message.id
     
     # Emit to the room
     emit('receive_message', {
-        'message_id': message.id,
+        'message_id': message_id,
+        'message_uid': row['uid'],
         'sender_id': current_user.id,
         'sender_username': current_user.username,
         'sender_avatar': current_user.avatar,
         'recipient_id': recipient_id,
         'content': content,
-        'timestamp': message.timestamp.strftime('%H:%M'),
-        'full_timestamp': message.timestamp.strftime('%B %d, %Y at %I:%M %p')
+        'timestamp': row['timestamp'].strftime('%H:%M'),
+        'full_timestamp': row['timestamp'].strftime('%B %d, %Y at %I:%M %p')
     }, room=room)
     
-    print(f"Message sent from {current_user.username} in room {room}")
+    current_app.logger.info('Message sent from %s in room %s', current_user.username, room)
+
+@socketio.on('mark_read')
+@socket_event
+def handle_mark_read(data):
+    """Mark messages from another user as read, up to ``up_to`` (a message id) or ``up_to_uid``
+
+    With write-behind a just-received message has a uid but no id yet. If
+    that uid is not stored yet the ack says ``pending`` and the client asks
+    again shortly.
+    """
+    if not current_user.is_authenticated:
+        return
+    
+    data = data or {}
+    try:
+        other_user_id = int(data.get('other_user_id'))
+        up_to = int(data['up_to']) if data.get('up_to') is not None else None
+    except (TypeError, ValueError):
+        return {'error': 'Invalid user or message id'}
+    conversation = conversations.find(current_user.id, other_user_id)
+    if not conversation:
+        return {'updated': 0}
+    if up_to is None and data.get('up_to_uid'):
+        up_to = conversations.message_id(conversation.id, str(data['up_to_uid']))
+        if up_to is None:
+            return {'updated': 0, 'pending': True}
+    updated = conversations.mark_read(conversation.id, current_user.id, up_to)
+    db.session.commit()
+    return {'updated': updated}
+
+@socketio.on('history')
+@socket_event
+def handle_history(data):
+    """Acknowledge with the page of messages before ``cursor`` and the next cursor"""
+    if not current_user.is_authenticated:
+        return
+    
+    data = data or {}
+    try:
+        other_user_id = int(data.get('other_user_id'))
+    except (TypeError, ValueError):
+        return {'error': 'Invalid user id'}
+    cursor = data.get('cursor')
+    # history() would quietly restart from the newest page
+    if cursor and decode_cursor(cursor, conversations.HISTORY_ORDER)[0] != 'next':
+        return {'error': 'Invalid cursor'}
+    conversation = conversations.find(current_user.id, other_user_id)
+    if not conversation:
+        return {'messages': [], 'cursor': None}
+    messages, older_cursor = conversations.history(
+        conversation.id, current_app.config['CHAT_PAGE_SIZE'], cursor,
+        archived_through=conversation.archived_through
+    )
+    return {'messages': [conversations.message_payload(m) for m in messages], 'cursor': older_cursor}
 
 @socketio.on('typing')
+@socket_event
 def handle_typing(data):
-    """Handle typing indicator"""
+    """Handle typing indicator; repeated events only extend the current burst"""
     if not current_user.is_authenticated:
         return
     
-    room = data.get('room')
-    emit('user_typing', {
-        'user': current_user.username,
-        'user_id': current_user.id
-    }, room=room, include_self=False)
+    room = _own_chat_room(data)
+    if room is not None:
+        typing_tracker.start(room, current_user.id, current_user.username)
 
 @socketio.on('stop_typing')
+@socket_event
 def handle_stop_typing(data):
     """Handle stop typing indicator"""
     if not current_user.is_authenticated:
         return
     
-    room = data.get('room')
-    emit('user_stop_typing', {
-        'user': current_user.username,
-        'user_id': current_user.id
-    }, room=room, include_self=False)
\ No newline at end of file
+    room = _own_chat_room(data)
+    if room is not None:
+        typing_tracker.stop(room, current_user.id)
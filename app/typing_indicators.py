@@ -0,0 +1,81 @@
+"""Server-side typing state for chat rooms.
+
+Clients may send ``typing`` on every keystroke. The server records who is
+typing in which room and sends one "started" and one "stopped" per burst. A
+burst ends on ``stop_typing``, on a sent message, on disconnect, or after
+``TYPING_TIMEOUT`` seconds without a ``typing`` event. Changes are collected
+and emitted once per ``TYPING_TICK``, as a single ``typing_update`` per room.
+A start and stop that cancel out within one tick are never sent.
+"""
+import time
+
+from app import socketio
+
+
+class TypingTracker:
+    def __init__(self):
+        self.app = None
+        self.timeout = 5.0
+        self.tick = 0.25
+        self.active = {}
+        self.pending = {}
+        self.running = False
+
+    def init_app(self, app):
+        self.app = app
+        self.timeout = app.config['TYPING_TIMEOUT']
+        self.tick = app.config['TYPING_TICK']
+
+    def start(self, room, user_id, username):
+        key = (room, user_id)
+        if key not in self.active:
+            self._queue(room, user_id, username, True)
+        self.active[key] = (time.monotonic() + self.timeout, username)
+
+    def stop(self, room, user_id):
+        entry = self.active.pop((room, user_id), None)
+        if entry:
+            self._queue(room, user_id, entry[1], False)
+
+    def stop_all(self, user_id):
+        """End every burst of a user, e.g. when their socket disconnects"""
+        for room, typist in [key for key in self.active if key[1] == user_id]:
+            self.stop(room, typist)
+
+    def _queue(self, room, user_id, username, typing):
+        changes = self.pending.setdefault(room, {})
+        if user_id in changes and changes[user_id][1] != typing:
+            # Nobody has seen the previous change yet, so both can be dropped
+            del changes[user_id]
+        else:
+            changes[user_id] = (username, typing)
+        if not self.running:
+            self.running = True
+            socketio.start_background_task(self._run)
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.tick)
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('Typing flush failed')
+
+    def flush(self):
+        """Expire stale bursts and emit this tick's changes"""
+        now = time.monotonic()
+        for key, (expires, _) in list(self.active.items()):
+            if expires <= now:
+                self.stop(*key)
+
+        pending, self.pending = self.pending, {}
+        for room, changes in pending.items():
+            # An empty room would broadcast to every client
+            if room and changes:
+                socketio.emit('typing_update', {'changes': [
+                    {'user_id': user_id, 'user': username, 'typing': typing}
+                    for user_id, (username, typing) in changes.items()
+                ]}, to=room)
+
+
+tracker = TypingTracker()
@@ -0,0 +1,55 @@
+"""Denormalized unread-message counters.
+
+``User.unread_count`` is adjusted with a single atomic ``UPDATE`` whenever a
+message is created, read or deleted, so rendering the inbox badge never needs
+a ``COUNT(*)``. New values are pushed over Socket.IO to the ``user_<id>`` room
+once the surrounding transaction commits.
+"""
+from sqlalchemy import case, event, func, select, update
+from app import db, socketio
+from app.models import User, Message
+from app import identity
+
+
+def user_room(user_id):
+    return f'user_{user_id}'
+
+
+def adjust(user_id, delta):
+    """Add ``delta`` to a user's unread counter, never going below zero"""
+    if not delta:
+        return None
+    new_value = User.unread_count + delta
+    count = db.session.execute(
+        update(User).where(User.id == user_id)
+        .values(unread_count=case((new_value < 0, 0), else_=new_value))
+        .returning(User.unread_count)
+        .execution_options(synchronize_session=False)
+    ).scalar()
+    db.session.info.setdefault('unread_push', {})[user_id] = count
+    identity.forget_after_commit(user_id)
+    return count
+
+
+def recount(user_ids=None):
+    """Recompute counters from the message table"""
+    unread = select(func.count(Message.id)).where(
+        Message.recipient_id == User.id, Message.read == False
+    ).scalar_subquery()
+    stmt = update(User).values(unread_count=unread)
+    if user_ids is not None:
+        stmt = stmt.where(User.id.in_(user_ids))
+    db.session.execute(stmt.execution_options(synchronize_session=False))
+    db.session.commit()
+
+
+@event.listens_for(db.session, 'after_commit')
+def _push_after_commit(session):
+    pending = session.info.pop('unread_push', None)
+    for user_id, count in (pending or {}).items():
+        socketio.emit('unread_count', {'count': count}, to=user_room(user_id))
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_after_rollback(session):
+    session.info.pop('unread_push', None)
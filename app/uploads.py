@@ -0,0 +1,96 @@
+"""Serving of user uploads under ``/uploads/<folder>/<filename>``.
+
+Upload names are content addressed (``raw/<sha256>.<ext>`` and
+``r/<sha256>_<rendition>.<ext>``, see app/images.py) or random hex names from
+before the image pipeline existed. Such a name never points at different
+bytes, so these files are sent with a one-year ``immutable`` Cache-Control and
+a strong ETag taken from the name. Any other file, such as a default picture,
+gets ``UPLOADS_FALLBACK_MAX_AGE`` and an ETag from its size and mtime.
+
+``If-None-Match``/``If-Modified-Since`` (304) and ``Range`` (206) are handled
+by werkzeug. The body is a file object handed to ``wsgi.file_wrapper``, so
+servers with sendfile support (gunicorn's sync and gthread workers) copy it
+in the kernel. A ``<name>.br`` or ``<name>.gz`` next to a file is sent instead
+when the client accepts that encoding.
+
+``UPLOADS_SERVE_MODE`` moves the byte copying out of Python:
+
+* ``direct`` (default) - the worker streams the file itself
+* ``x-accel-redirect`` - nginx serves ``UPLOADS_ACCEL_PREFIX`` + path from an
+  ``internal`` location
+* ``x-sendfile``       - Apache mod_xsendfile / lighttpd serve the absolute path
+
+Either proxy mode keeps image traffic off the workers that also carry chat
+sockets. Python only answers 304s and resolves the path.
+"""
+import mimetypes
+import os
+
+from flask import Response, abort, current_app, request
+from werkzeug.utils import safe_join, send_file
+from app.images import RENDITIONS, STORED_NAME, upload_dir
+from app.query_budget import query_budget
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+# Preferred first when the client accepts both
+PRECOMPRESSED = (('br', '.br'), ('gzip', '.gz'))
+
+
+def _precompressed(path):
+    """``(path, encoding)`` of the best variant the client accepts"""
+    for encoding, suffix in PRECOMPRESSED:
+        if encoding in request.accept_encodings and os.path.isfile(path + suffix):
+            return path + suffix, encoding
+    return path, None
+
+
+@query_budget(0)
+def serve_upload(folder, filename):
+    if folder not in RENDITIONS or filename.endswith('.tmp'):
+        abort(404)
+    path = safe_join(upload_dir(folder), filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    match = STORED_NAME.match(filename)
+    mode = current_app.config['UPLOADS_SERVE_MODE']
+    # nginx picks precompressed files itself (gzip_static / brotli_static)
+    body_path, encoding = _precompressed(path) if mode != 'x-accel-redirect' else (path, None)
+
+    if match:
+        # The name identifies the bytes, so it is a valid strong validator
+        etag = filename.replace('/', '-') + (f'.{encoding}' if encoding else '')
+        max_age = IMMUTABLE_MAX_AGE
+    else:
+        stat = os.stat(body_path)
+        etag = f'{int(stat.st_mtime)}-{stat.st_size}' + (f'.{encoding}' if encoding else '')
+        max_age = current_app.config['UPLOADS_FALLBACK_MAX_AGE']
+
+    if mode == 'x-accel-redirect':
+        response = Response(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = current_app.config['UPLOADS_ACCEL_PREFIX'] + f'{folder}/{filename}'
+        response.set_etag(etag)
+        response.last_modified = int(os.stat(path).st_mtime)
+        response.make_conditional(request)
+    else:
+        response = send_file(
+            body_path, request.environ, mimetype=mimetype, etag=etag, max_age=max_age,
+            use_x_sendfile=mode == 'x-sendfile'
+        )
+        # werkzeug only advertises ranges on range requests
+        response.accept_ranges = 'bytes'
+    if encoding:
+        response.content_encoding = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    if match:
+        response.cache_control.immutable = True
+    return response
+
+
+def init_app(app):
+    if app.config['UPLOADS_SERVE_MODE'] not in ('direct', 'x-accel-redirect', 'x-sendfile'):
+        raise ValueError(f"Unsupported UPLOADS_SERVE_MODE: {app.config['UPLOADS_SERVE_MODE']}")
+    app.add_url_rule('/uploads/<folder>/<path:filename>', 'uploads', serve_upload)
@@ -0,0 +1,10 @@
+"""Local benchmark suite for Agora of Olympus.
+
+Seeds a throwaway SQLite database with synthetic users, items and messages,
+drives the main HTTP routes with Flask test clients and chat traffic with
+Socket.IO test clients, and reports throughput, p50/p95/p99 latency and SQL
+statements per request. Everything runs in-process with no network.
+
+    python -m bench --users 200 --items 2000 --messages 5000 --save baseline.json
+    python -m bench --compare baseline.json
+"""
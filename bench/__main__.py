@@ -0,0 +1,100 @@
+"""Command line entry point: python -m bench --help"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from threading import Lock
+
+from app import create_app, db, migrations
+from app.config import Config
+from bench import report, scenarios
+from bench.seed import seed
+
+
+def make_config(db_path, cache):
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + db_path
+        WTF_CSRF_ENABLED = False
+        QUERY_BUDGET_MODE = 'warn'
+        IMAGE_WORKERS = 0
+        CHAT_WRITE_BEHIND = False
+        BCRYPT_LOG_ROUNDS = 4
+        SOCKETIO_MESSAGE_QUEUE = None
+        PRESENCE_URL = None
+        CACHE_URL = None
+        if not cache:
+            CACHE_DEFAULT_TTL = 0
+            IDENTITY_CACHE_TTL = 0
+    return BenchConfig
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench', description=__doc__)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--items', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=3000)
+    parser.add_argument('--requests', type=int, default=700, help='HTTP requests to replay')
+    parser.add_argument('--concurrency', type=int, default=4, help='concurrent HTTP clients')
+    parser.add_argument('--sockets', type=int, default=8, help='concurrent Socket.IO clients')
+    parser.add_argument('--rounds', type=int, default=25, help='typing/send rounds per socket client')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-cache', action='store_true', help='disable fragment and identity caches')
+    parser.add_argument('--db', help='SQLite file to use (default: a fresh temporary file)')
+    parser.add_argument('--save', metavar='JSON', help='write results as a baseline')
+    parser.add_argument('--compare', metavar='JSON', help='compare against a saved baseline')
+    parser.add_argument('--threshold', type=float, default=20.0,
+                        help='p95 increase (percent) reported as a regression')
+    args = parser.parse_args(argv)
+    if args.concurrency > args.users or args.sockets > args.users:
+        parser.error('--concurrency and --sockets cannot exceed --users')
+
+    db_path = args.db or os.path.join(tempfile.mkdtemp(prefix='agora-bench-'), 'bench.db')
+    fresh = not os.path.exists(db_path)
+    app = create_app(make_config(db_path, cache=not args.no_cache))
+    app.logger.setLevel('ERROR')
+
+    started = time.perf_counter()
+    with app.app_context():
+        if fresh:
+            migrations.upgrade()
+            user_ids, item_ids = seed(args.users, args.items, args.messages, args.seed)
+        else:
+            from app.models import User, Item
+            user_ids = [id for (id,) in db.session.query(User.id).order_by(User.id)]
+            item_ids = [id for (id,) in db.session.query(Item.id)]
+    print(f'database {db_path} ready in {time.perf_counter() - started:.1f}s')
+
+    samples = defaultdict(list)
+    lock = Lock()
+
+    def record(name, seconds, queries, ok):
+        with lock:
+            samples[name].append((seconds, queries, ok))
+
+    scenarios.count_queries(app)
+    plan = scenarios.http_plan(args.requests, user_ids, item_ids, args.seed)
+    wall_times = {
+        'http': scenarios.run_http(app, plan, args.concurrency, record),
+        'socket': scenarios.run_sockets(app, args.sockets, args.rounds, user_ids, record),
+    }
+
+    results = report.summarize(samples, wall_times)
+    report.print_report(results, wall_times, print)
+
+    params = {key: value for key, value in vars(args).items()
+              if key not in ('db', 'save', 'compare', 'threshold')}
+    if args.save:
+        report.save(args.save, params, results, wall_times)
+        print(f'baseline saved to {args.save}')
+    if args.compare:
+        regressions = report.compare(args.compare, params, results, print, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
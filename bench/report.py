@@ -0,0 +1,78 @@
+"""Latency statistics, baselines and comparisons"""
+import json
+import statistics
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def summarize(samples, wall_times):
+    """``samples`` maps name -> list of (seconds, queries, ok)"""
+    results = {}
+    for name, rows in sorted(samples.items()):
+        latencies = [seconds for seconds, _, _ in rows]
+        queries = [count for _, count, _ in rows if count is not None]
+        group = name.split(':')[0]
+        results[name] = {
+            'count': len(rows),
+            'errors': sum(1 for _, _, ok in rows if not ok),
+            'rps': len(rows) / wall_times[group] if wall_times.get(group) else None,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'queries': statistics.mean(queries) if queries else None,
+        }
+    return results
+
+
+def _fmt(value, spec='.1f'):
+    return '-' if value is None else format(value, spec)
+
+
+def print_report(results, wall_times, out):
+    out(f"{'name':28} {'count':>6} {'err':>4} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'sql':>6}")
+    for name, row in results.items():
+        out(f"{name:28} {row['count']:6d} {row['errors']:4d} {_fmt(row['rps']):>8} "
+            f"{_fmt(row['p50_ms'], '.2f'):>8} {_fmt(row['p95_ms'], '.2f'):>8} "
+            f"{_fmt(row['p99_ms'], '.2f'):>8} {_fmt(row['queries']):>6}")
+    for group, seconds in sorted(wall_times.items()):
+        total = sum(row['count'] for name, row in results.items() if name.startswith(group + ':'))
+        out(f'{group}: {total} operations in {seconds:.2f}s ({total / seconds:.1f}/s)')
+
+
+def save(path, params, results, wall_times):
+    with open(path, 'w') as f:
+        json.dump({'params': params, 'wall_times': wall_times, 'results': results}, f, indent=2, sort_keys=True)
+
+
+def compare(path, params, results, out, threshold=20.0):
+    """Print changes against a saved baseline; returns names whose p95 regressed by more than ``threshold`` %"""
+    with open(path) as f:
+        baseline = json.load(f)
+    if baseline['params'] != params:
+        out('warning: baseline was recorded with different parameters')
+        for key in sorted(set(params) | set(baseline['params'])):
+            if params.get(key) != baseline['params'].get(key):
+                out(f"  {key}: baseline={baseline['params'].get(key)} now={params.get(key)}")
+
+    regressions = []
+    out(f"{'name':28} {'p95 base':>9} {'p95 now':>9} {'change':>8} {'sql base':>9} {'sql now':>8}")
+    for name, row in results.items():
+        old = baseline['results'].get(name)
+        if not old:
+            out(f'{name:28} (not in baseline)')
+            continue
+        change = (row['p95_ms'] - old['p95_ms']) / old['p95_ms'] * 100 if old['p95_ms'] else 0.0
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        elif row['queries'] is not None and old['queries'] is not None and row['queries'] > old['queries']:
+            regressions.append(name)
+            flag = '  MORE SQL'
+        out(f"{name:28} {old['p95_ms']:9.2f} {row['p95_ms']:9.2f} {change:+7.1f}% "
+            f"{_fmt(old['queries']):>9} {_fmt(row['queries']):>8}{flag}")
+    return regressions
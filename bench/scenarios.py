@@ -0,0 +1,108 @@
+"""HTTP and Socket.IO workloads"""
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import event
+from app import db, socketio
+from app.presence import presence
+from app.typing_indicators import tracker as typing_tracker
+from bench.seed import CATEGORIES, RARITIES, WORDS, PASSWORD, username
+
+_local = threading.local()
+
+
+def _count_statement(*args):
+    _local.queries = getattr(_local, 'queries', 0) + 1
+
+
+def count_queries(app):
+    """Count SQL statements per thread (socket events have no X-SQL-Queries header)"""
+    with app.app_context():
+        if not event.contains(db.engine, 'before_cursor_execute', _count_statement):
+            event.listen(db.engine, 'before_cursor_execute', _count_statement)
+
+
+def _login(app, user_number):
+    client = app.test_client()
+    client.post('/auth/login', data={'username': username(user_number), 'password': PASSWORD})
+    return client
+
+
+def http_plan(requests, user_ids, item_ids, seed=1):
+    """A fixed list of (route name, url) to replay"""
+    rng = random.Random(seed)
+    partners = user_ids[:max(2, len(user_ids) // 5)]
+    routes = [
+        ('index', lambda: '/'),
+        ('marketplace', lambda: '/marketplace'),
+        ('marketplace_filter', lambda: f'/marketplace?category={rng.choice(CATEGORIES)}&rarity={rng.choice(RARITIES)}'),
+        ('marketplace_search', lambda: f'/marketplace?search={rng.choice(WORDS)}'),
+        ('item_detail', lambda: f'/item/{rng.choice(item_ids)}'),
+        ('inbox', lambda: '/messages/inbox'),
+        ('chat', lambda: f'/messages/chat/{rng.choice(partners)}'),
+    ]
+    return [(name, url()) for name, url in (rng.choice(routes) for _ in range(requests))]
+
+
+def run_http(app, plan, concurrency, record):
+    """Replay ``plan`` with ``concurrency`` logged-in clients; returns wall time"""
+    def worker(index):
+        client = _login(app, index)
+        for name, url in plan[index::concurrency]:
+            started = time.perf_counter()
+            response = client.get(url)
+            elapsed = time.perf_counter() - started
+            queries = response.headers.get('X-SQL-Queries')
+            record(f'http:{name}', elapsed, int(queries) if queries else None, response.status_code < 400)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(worker, range(concurrency)))
+    return time.perf_counter() - started
+
+
+def run_sockets(app, clients, rounds, user_ids, record):
+    """``clients`` chat users each joining a room and typing then sending ``rounds`` times"""
+    partners = user_ids[:max(2, len(user_ids) // 5)]
+    stop = threading.Event()
+
+    def timed(name, emit, *args):
+        _local.queries = 0
+        started = time.perf_counter()
+        emit(*args)
+        record(f'socket:{name}', time.perf_counter() - started, _local.queries, True)
+
+    def worker(index):
+        user_id = user_ids[index]
+        partner = partners[index % len(partners)]
+        if partner == user_id:
+            partner = partners[(index + 1) % len(partners)]
+        room = f'chat_{min(user_id, partner)}_{max(user_id, partner)}'
+        client = socketio.test_client(app, flask_test_client=_login(app, index))
+        timed('join_chat', client.emit, 'join_chat', {'room': room})
+        for n in range(rounds):
+            timed('typing', client.emit, 'typing', {'room': room})
+            timed('send_message', client.emit, 'send_message',
+                  {'room': room, 'recipient_id': partner, 'content': f'bench message {n}'})
+            timed('stop_typing', client.emit, 'stop_typing', {'room': room})
+            client.get_received()
+        client.disconnect()
+
+    def ticker():
+        # Background loops are not scheduled under the test client; run their ticks here
+        while not stop.is_set():
+            time.sleep(typing_tracker.tick)
+            with app.app_context():
+                timed('tick', lambda: (typing_tracker.flush(), presence.flush()))
+
+    tick = threading.Thread(target=ticker, daemon=True)
+    tick.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(clients) as pool:
+        list(pool.map(worker, range(clients)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    tick.join()
+    return elapsed
@@ -0,0 +1,81 @@
+"""Synthetic data for benchmarks"""
+import random
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert
+from app import db, facets, recommend
+from app.chat_writer import write_batch
+from app.models import User, Item
+
+PASSWORD = 'benchpass'
+CATEGORIES = ['weapon', 'armor', 'potion', 'artifact', 'scroll', 'jewel', 'other']
+RARITIES = ['common', 'uncommon', 'rare', 'epic', 'legendary', 'mythical']
+WORDS = ['sword', 'shield', 'helm', 'amulet', 'elixir', 'tome', 'ring', 'bow', 'spear',
+         'golden', 'ancient', 'cursed', 'blessed', 'olympian', 'titan', 'storm', 'shadow',
+         'zeus', 'athena', 'hermes', 'ares', 'poseidon', 'hades', 'apollo']
+
+
+def username(n):
+    return f'bench{n}'
+
+
+def seed(users=100, items=1000, messages=3000, seed=1, batch_size=500):
+    """Fill the current app's database; the same arguments give the same data"""
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1)
+
+    user = User(username='_', email='_')
+    user.set_password(PASSWORD)
+    password_hash = user.password_hash
+    db.session.execute(insert(User), [
+        {'username': username(n), 'email': f'{username(n)}@bench.local',
+         'password_hash': password_hash, 'created_at': start}
+        for n in range(users)
+    ])
+    user_ids = [id for (id,) in db.session.query(User.id).order_by(User.id)]
+
+    rows = []
+    for n in range(items):
+        name = ' '.join(rng.choice(WORDS) for _ in range(3)).title()
+        rows.append({
+            'name': name,
+            'description': ' '.join(rng.choice(WORDS) for _ in range(25)),
+            'category': rng.choice(CATEGORIES),
+            'rarity': rng.choice(RARITIES),
+            'seller_id': rng.choice(user_ids),
+            'created_at': start + timedelta(minutes=n),
+        })
+        if len(rows) >= batch_size:
+            db.session.execute(insert(Item), rows)
+            rows = []
+    if rows:
+        db.session.execute(insert(Item), rows)
+    db.session.commit()
+    # Core inserts skip the ORM hooks that keep these up to date
+    facets.reconcile()
+    recommend.rebuild()
+    db.session.commit()
+    item_ids = [id for (id,) in db.session.query(Item.id)]
+
+    # Most chat happens between a small set of active users
+    active = user_ids[:max(2, len(user_ids) // 5)]
+    rows = []
+    for n in range(messages):
+        sender = rng.choice(active)
+        recipient = rng.choice([id for id in active if id != sender])
+        rows.append({
+            'uid': '%032x' % rng.getrandbits(128),
+            'sender_id': sender,
+            'recipient_id': recipient,
+            'item_id': rng.choice(item_ids) if item_ids and rng.random() < 0.3 else None,
+            'subject': 'Chat message',
+            'content': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 20))),
+            'timestamp': start + timedelta(seconds=30 * n),
+        })
+        if len(rows) >= batch_size:
+            write_batch(rows)
+            rows = []
+    if rows:
+        write_batch(rows)
+    db.session.commit()
+    return user_ids, item_ids
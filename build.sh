@@ -9,5 +9,5 @@ pip install -r requirements.txt
 mkdir -p app/static/uploads/items
 mkdir -p app/static/uploads/avatars
 
-# Create database tables
-python -c "from app import create_app, db; app = create_app(); app.app_context().push(); db.create_all(); print('Database initialized')"
\ No newline at end of file
+# Create or upgrade the database schema
+flask --app run.py db-upgrade
\ No newline at end of file
@@ -1,12 +1,15 @@
 
-from app import create_app, db, socketio
+from app import create_app, socketio, migrations
 import os
 
 app = create_app()
 
 if __name__ == '__main__':
+    # The schema is changed by 'flask db-upgrade', never on start
     with app.app_context():
-        db.create_all()
+        pending = migrations.pending()
+    if pending:
+        print(f'{len(pending)} schema migration(s) pending; run: flask --app run.py db-upgrade')
     
     port = int(os.environ.get('PORT', 5000))
     
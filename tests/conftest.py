@@ -0,0 +1,105 @@
+import pytest
+from app import create_app, db, migrations, conversations
+from app.config import Config
+from app.models import User, Item, Message
+
+
+class TestConfig(Config):
+    TESTING = True
+    WTF_CSRF_ENABLED = False
+    BCRYPT_LOG_ROUNDS = 4
+    IMAGE_WORKERS = 0
+    PURGE_IN_BACKGROUND = False
+    RECOMMEND_IN_BACKGROUND = False
+    MESSAGE_ARCHIVE_INTERVAL = 0
+    CHAT_WRITE_BEHIND = False
+    SOCKETIO_MESSAGE_QUEUE = None
+    PRESENCE_URL = None
+    CACHE_URL = None
+    DATABASE_REPLICA_URLS = []
+    QUERY_BUDGET_MODE = 'raise'
+    METRICS_TOKEN = 'test-token'
+
+
+@pytest.fixture
+def app(tmp_path):
+    config = type('Config', (TestConfig,), {
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'test.db'),
+        'CHAT_WRITE_SPOOL': str(tmp_path / 'chat_spool.ndjson'),
+        'CHAT_WRITE_DEAD_LETTER': str(tmp_path / 'chat_dead_letter.ndjson'),
+    })
+    app = create_app(config)
+    with app.app_context():
+        migrations.upgrade()
+    return app
+
+
+@pytest.fixture
+def app_context(app):
+    """For tests that use the database directly; requests get their own context"""
+    with app.app_context():
+        yield
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def upload_root(app, tmp_path, monkeypatch):
+    """Moves ``static/uploads`` under tmp_path; returns the new uploads directory"""
+    app.jinja_loader  # templates stay where they are
+    monkeypatch.setattr(app, 'root_path', str(tmp_path))
+    return tmp_path / 'static' / 'uploads'
+
+
+@pytest.fixture
+def users(app):
+    """Ids of alice and bob"""
+    with app.app_context():
+        alice = User(username='alice', email='alice@example.com')
+        bob = User(username='bob', email='bob@example.com')
+        for user in (alice, bob):
+            user.set_password('password')
+        db.session.add_all([alice, bob])
+        db.session.commit()
+        return alice.id, bob.id
+
+
+@pytest.fixture
+def items(app, users):
+    """Ids of 32 listings, oldest first, alternating between alice and bob"""
+    with app.app_context():
+        items = [
+            Item(name=f'{rarity.title()} Sword {i}', description=f'A {rarity} sword', category=category,
+                 rarity=rarity, seller_id=users[i % 2])
+            for i, (category, rarity) in enumerate(
+                [('weapon', 'rare'), ('weapon', 'common'), ('armor', 'rare'), ('potion', 'epic')] * 8
+            )
+        ]
+        db.session.add_all(items)
+        db.session.commit()
+        return [item.id for item in items]
+
+
+@pytest.fixture
+def messages(app, users, items):
+    """Ids of six messages between alice and bob about the first listing, oldest first"""
+    alice, bob = users
+    with app.app_context():
+        messages = []
+        for i in range(6):
+            sender, recipient = (alice, bob) if i % 2 else (bob, alice)
+            message = Message(sender_id=sender, recipient_id=recipient, item_id=items[0],
+                              subject='Trade', content=f'Offer {i}')
+            conversations.add_message(message)
+            messages.append(message)
+        db.session.commit()
+        return [message.id for message in messages]
+
+
+def login(client, user_id):
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
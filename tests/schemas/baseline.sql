@@ -0,0 +1,41 @@
+CREATE TABLE user (
+	id INTEGER NOT NULL, 
+	username VARCHAR(80) NOT NULL, 
+	email VARCHAR(120) NOT NULL, 
+	password_hash VARCHAR(200) NOT NULL, 
+	avatar VARCHAR(200), 
+	created_at DATETIME, 
+	PRIMARY KEY (id), 
+	UNIQUE (username), 
+	UNIQUE (email)
+);
+
+CREATE TABLE item (
+	id INTEGER NOT NULL, 
+	name VARCHAR(100) NOT NULL, 
+	description TEXT NOT NULL, 
+	image VARCHAR(200), 
+	category VARCHAR(50) NOT NULL, 
+	rarity VARCHAR(20) NOT NULL, 
+	seller_id INTEGER NOT NULL, 
+	created_at DATETIME, 
+	PRIMARY KEY (id), 
+	FOREIGN KEY(seller_id) REFERENCES user (id)
+);
+
+CREATE TABLE message (
+	id INTEGER NOT NULL, 
+	sender_id INTEGER NOT NULL, 
+	recipient_id INTEGER NOT NULL, 
+	item_id INTEGER, 
+	subject VARCHAR(200) NOT NULL, 
+	content TEXT NOT NULL, 
+	timestamp DATETIME, 
+	read BOOLEAN, 
+	PRIMARY KEY (id), 
+	FOREIGN KEY(sender_id) REFERENCES user (id), 
+	FOREIGN KEY(recipient_id) REFERENCES user (id), 
+	FOREIGN KEY(item_id) REFERENCES item (id)
+);
+
+CREATE INDEX ix_message_timestamp ON message (timestamp);
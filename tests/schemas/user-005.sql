@@ -0,0 +1,97 @@
+CREATE TABLE user (
+	id INTEGER NOT NULL, 
+	username VARCHAR(80) NOT NULL, 
+	email VARCHAR(120) NOT NULL, 
+	password_hash VARCHAR(200) NOT NULL, 
+	avatar VARCHAR(200), 
+	created_at DATETIME, 
+	unread_count INTEGER DEFAULT '0' NOT NULL, 
+	PRIMARY KEY (id), 
+	UNIQUE (username), 
+	UNIQUE (email)
+);
+
+CREATE TABLE item (
+	id INTEGER NOT NULL, 
+	name VARCHAR(100) NOT NULL, 
+	description TEXT NOT NULL, 
+	image VARCHAR(200), 
+	category VARCHAR(50) NOT NULL, 
+	rarity VARCHAR(20) NOT NULL, 
+	seller_id INTEGER NOT NULL, 
+	created_at DATETIME, 
+	PRIMARY KEY (id), 
+	FOREIGN KEY(seller_id) REFERENCES user (id)
+);
+
+CREATE TABLE conversation (
+	id INTEGER NOT NULL, 
+	user_low_id INTEGER NOT NULL, 
+	user_high_id INTEGER NOT NULL, 
+	item_id INTEGER, 
+	last_message_id INTEGER, 
+	last_activity DATETIME, 
+	created_at DATETIME, 
+	PRIMARY KEY (id), 
+	CONSTRAINT uq_conversation_pair UNIQUE (user_low_id, user_high_id), 
+	FOREIGN KEY(user_low_id) REFERENCES user (id), 
+	FOREIGN KEY(user_high_id) REFERENCES user (id), 
+	FOREIGN KEY(item_id) REFERENCES item (id) ON DELETE SET NULL, 
+	CONSTRAINT fk_conversation_last_message FOREIGN KEY(last_message_id) REFERENCES message (id) ON DELETE SET NULL
+);
+
+CREATE TABLE message (
+	id INTEGER NOT NULL, 
+	sender_id INTEGER NOT NULL, 
+	recipient_id INTEGER NOT NULL, 
+	item_id INTEGER, 
+	subject VARCHAR(200) NOT NULL, 
+	content TEXT NOT NULL, 
+	timestamp DATETIME, 
+	read BOOLEAN, 
+	conversation_id INTEGER, 
+	PRIMARY KEY (id), 
+	FOREIGN KEY(sender_id) REFERENCES user (id), 
+	FOREIGN KEY(recipient_id) REFERENCES user (id), 
+	FOREIGN KEY(item_id) REFERENCES item (id), 
+	FOREIGN KEY(conversation_id) REFERENCES conversation (id)
+);
+
+CREATE INDEX ix_message_timestamp ON message (timestamp);
+
+CREATE INDEX ix_message_conversation_timestamp ON message (conversation_id, timestamp);
+
+CREATE TABLE conversation_member (
+	conversation_id INTEGER NOT NULL, 
+	user_id INTEGER NOT NULL, 
+	unread_count INTEGER DEFAULT '0' NOT NULL, 
+	last_activity DATETIME, 
+	PRIMARY KEY (conversation_id, user_id), 
+	FOREIGN KEY(conversation_id) REFERENCES conversation (id), 
+	FOREIGN KEY(user_id) REFERENCES user (id)
+);
+
+CREATE INDEX ix_conversation_member_inbox ON conversation_member (user_id, last_activity, conversation_id);
+
+CREATE VIRTUAL TABLE item_fts USING fts5(
+        name, description,
+        content='item', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    );
+
+CREATE VIRTUAL TABLE item_fts_vocab USING fts5vocab(item_fts, 'row');
+
+CREATE TRIGGER item_fts_ai AFTER INSERT ON item BEGIN
+        INSERT INTO item_fts(rowid, name, description) VALUES (new.id, new.name, new.description);
+    END;
+
+CREATE TRIGGER item_fts_ad AFTER DELETE ON item BEGIN
+        INSERT INTO item_fts(item_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+    END;
+
+CREATE TRIGGER item_fts_au AFTER UPDATE OF name, description ON item BEGIN
+        INSERT INTO item_fts(item_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+        INSERT INTO item_fts(rowid, name, description) VALUES (new.id, new.name, new.description);
+    END;
@@ -0,0 +1,13 @@
+from app import db
+from app.models import Item
+
+
+def test_user_item_count_follows_new_listings(app, client, users, items):
+    alice, _ = users
+    count = client.get('/api/v1/users/alice').json['data']['item_count']
+    assert count == len(items) // 2
+    with app.app_context():
+        db.session.add(Item(name='Shield', description='A shield', category='armor', rarity='common',
+                            seller_id=alice))
+        db.session.commit()
+    assert client.get('/api/v1/users/alice').json['data']['item_count'] == count + 1
@@ -0,0 +1,17 @@
+import csv
+import io
+
+from tests.conftest import login
+
+
+def test_export_needs_a_login(client, users, items):
+    response = client.get('/item/export')
+    assert response.status_code == 302
+    assert '/auth/login' in response.headers['Location']
+
+
+def test_export_streams_listings(client, users, items):
+    login(client, users[0])
+    rows = list(csv.DictReader(io.StringIO(client.get('/item/export?seller=bob').text)))
+    assert sorted(int(row['id']) for row in rows) == sorted(items[1::2])
+    assert {row['seller'] for row in rows} == {'bob'}
@@ -0,0 +1,30 @@
+import pickle
+from datetime import datetime
+
+from app.cache import SqliteCache
+
+
+class Exploit:
+    def __reduce__(self):
+        return (exec, ("raise SystemExit('pickle was loaded')",))
+
+
+def test_shared_backend_round_trips_cached_values(tmp_path):
+    cache = SqliteCache('sqlite:///' + str(tmp_path / 'cache.db'))
+    values = {
+        'fragment': '<div class="card">Sword</div>',
+        'api': (b'{"data": []}', 'a1b2'),
+        'facets': {('weapon', 'rare'): 3, ('armor', 'common'): 1},
+        'identity': {'id': 1, 'username': 'alice', 'created_at': datetime(2024, 5, 1, 12, 30),
+                     'deleted_at': None, 'unread_count': 0},
+    }
+    for key, value in values.items():
+        cache.set(key, value, 60)
+    assert {key: cache.get(key) for key in values} == values
+
+
+def test_shared_backend_never_unpickles(tmp_path):
+    cache = SqliteCache('sqlite:///' + str(tmp_path / 'cache.db'))
+    cache.conn.execute('INSERT INTO fragment_cache (key, value, expires) VALUES (?, ?, ?)',
+                       ('grid', pickle.dumps(Exploit()), 2e9))
+    assert cache.get('grid') is None
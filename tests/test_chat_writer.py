@@ -0,0 +1,129 @@
+import json
+import os
+import uuid
+from datetime import datetime
+
+import pytest
+from sqlalchemy.exc import OperationalError
+from app import chat_writer, db, socketio
+from app.chat_writer import ChatWriter
+from app.models import Message, User
+from tests.conftest import login
+
+
+def _row(sender, recipient, content='Hello'):
+    return {'uid': uuid.uuid4().hex, 'sender_id': sender, 'recipient_id': recipient, 'item_id': None,
+            'subject': 'Chat message', 'content': content, 'timestamp': datetime.utcnow()}
+
+
+def _lines(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+@pytest.fixture
+def writer(app):
+    writer = ChatWriter()
+    writer.init_app(app)
+    return writer
+
+
+def test_bad_row_is_dead_lettered_and_the_rest_stored(app, users, writer):
+    alice, bob = users
+    rows = [_row(alice, bob, 'one'), _row(alice, bob, None), _row(bob, alice, 'three')]
+    assert writer._write(rows)
+    with app.app_context():
+        assert sorted(m.content for m in Message.query) == ['one', 'three']
+        assert db.session.get(User, bob).unread_count == 1
+    dead = _lines(app.config['CHAT_WRITE_DEAD_LETTER'])
+    assert [row['uid'] for row in dead] == [rows[1]['uid']]
+    assert 'IntegrityError' in dead[0]['error']
+    assert not os.path.exists(app.config['CHAT_WRITE_SPOOL'])
+
+
+def test_unavailable_database_spools_then_replays(app, users, writer, monkeypatch):
+    alice, bob = users
+    rows = [_row(alice, bob, f'message {i}') for i in range(3)]
+
+    def locked(rows):
+        raise OperationalError('INSERT', {}, Exception('database is locked'))
+    monkeypatch.setattr(chat_writer, 'write_batch', locked)
+    assert not writer._write(rows)
+    assert [row['uid'] for row in _lines(app.config['CHAT_WRITE_SPOOL'])] == [row['uid'] for row in rows]
+
+    monkeypatch.undo()
+    assert writer.replay_spool() == 3
+    assert writer.replay_spool() == 0
+    with app.app_context():
+        assert Message.query.count() == 3
+    assert not os.path.exists(app.config['CHAT_WRITE_SPOOL'])
+    assert not os.path.exists(app.config['CHAT_WRITE_SPOOL'] + '.replay')
+
+
+def test_interrupted_replay_is_finished_without_duplicates(app, users, writer):
+    alice, bob = users
+    rows = [_row(alice, bob, f'message {i}') for i in range(2)]
+    writer._write(rows[:1])
+    writer._append(app.config['CHAT_WRITE_SPOOL'] + '.replay', rows)
+    assert writer.replay_spool() == 2
+    with app.app_context():
+        assert Message.query.count() == 2
+
+
+def test_mark_read_accepts_a_uid_watermark(app, client, users, writer):
+    alice, bob = users
+    rows = [_row(bob, alice, 'first'), _row(bob, alice, 'second'), _row(bob, alice, 'third')]
+    writer._write(rows)
+    login(client, alice)
+    socket = socketio.test_client(app, flask_test_client=client)
+
+    ack = socket.emit('mark_read', {'other_user_id': bob, 'up_to_uid': rows[1]['uid']}, callback=True)
+    assert ack == {'updated': 2}
+    ack = socket.emit('mark_read', {'other_user_id': bob, 'up_to_uid': uuid.uuid4().hex}, callback=True)
+    assert ack == {'updated': 0, 'pending': True}
+    with app.app_context():
+        assert db.session.get(User, alice).unread_count == 1
+
+
+def test_undecodable_spool_lines_are_dead_lettered(app, users, writer):
+    alice, bob = users
+    rows = [_row(alice, bob, f'message {i}') for i in range(2)]
+    writer._append(app.config['CHAT_WRITE_SPOOL'], rows)
+    with open(app.config['CHAT_WRITE_SPOOL'], 'a') as f:
+        f.write('{"uid": "cut sho')
+    assert writer.replay_spool() == 2
+    with app.app_context():
+        assert Message.query.count() == 2
+    assert [row['line'] for row in _lines(app.config['CHAT_WRITE_DEAD_LETTER'])] == ['{"uid": "cut sho']
+
+
+def test_spool_taken_by_another_worker_is_not_an_error(app, users, writer, monkeypatch):
+    alice, bob = users
+    writer._append(app.config['CHAT_WRITE_SPOOL'], [_row(alice, bob)])
+
+    def taken(src, dst):
+        os.remove(src)
+        raise FileNotFoundError(src)
+    monkeypatch.setattr(os, 'replace', taken)
+    assert writer.replay_spool() == 0
+
+
+def test_writer_loop_survives_a_failed_pass(app, users, writer, monkeypatch):
+    alice, bob = users
+    calls = []
+
+    def replay():
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError('spool on fire')
+        writer.running = False
+    monkeypatch.setattr(writer, 'replay_spool', replay)
+    monkeypatch.setattr(socketio, 'sleep', lambda seconds: None)
+    writer.queue.put_nowait(_row(alice, bob))
+    writer.running = True
+    writer._run()
+    assert len(calls) == 2
+    with app.app_context():
+        assert Message.query.count() == 1
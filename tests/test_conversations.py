@@ -0,0 +1,37 @@
+from app import conversations, db
+from app.models import ConversationMember, Message, User
+from tests.conftest import login
+
+
+def _unread(user_id):
+    member = ConversationMember.query.filter_by(user_id=user_id).one()
+    return db.session.get(User, user_id).unread_count, member.unread_count
+
+
+def test_racing_reads_decrement_once(app, users, messages):
+    alice, _ = users
+    with app.app_context():
+        before = _unread(alice)
+    # Each app context is a request with its own session; the outer one loaded the message first
+    with app.app_context():
+        stale = db.session.get(Message, messages[0])
+        with app.app_context():
+            assert conversations.mark_message_read(db.session.get(Message, messages[0]))
+            db.session.commit()
+        assert not stale.read
+        assert not conversations.mark_message_read(stale)
+        db.session.commit()
+        db.session.expire_all()
+        assert _unread(alice) == (before[0] - 1, before[1] - 1)
+
+
+def test_viewing_a_message_marks_it_read_once(app, client, users, messages):
+    alice, _ = users
+    login(client, alice)
+    with app.app_context():
+        before = _unread(alice)
+    for _ in range(2):
+        assert client.get(f'/messages/{messages[0]}').status_code == 200
+    with app.app_context():
+        assert _unread(alice) == (before[0] - 1, before[1] - 1)
+        assert db.session.get(Message, messages[0]).read
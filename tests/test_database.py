@@ -0,0 +1,92 @@
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from app import create_app, db, database, migrations
+from app.models import Item, User
+from tests.conftest import TestConfig, login
+
+
+@pytest.fixture
+def app(tmp_path):
+    """A SQLite primary with one replica, synced after alice's first listing"""
+    config = type('Config', (TestConfig,), {
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'primary.db'),
+        'DATABASE_REPLICA_URLS': ['sqlite:///' + str(tmp_path / 'replica.db')],
+        'CHAT_WRITE_SPOOL': str(tmp_path / 'chat_spool.ndjson'),
+        'CHAT_WRITE_DEAD_LETTER': str(tmp_path / 'chat_dead_letter.ndjson'),
+    })
+    app = create_app(config)
+    with app.app_context():
+        migrations.upgrade()
+        alice = User(username='alice', email='alice@example.com')
+        alice.set_password('password')
+        db.session.add(alice)
+        db.session.add(Item(name='Frost Sword', description='Cold to the touch', category='weapon',
+                            rarity='rare', seller=alice))
+        db.session.commit()
+        assert database.sync_sqlite_replicas(db) == 1
+    return app
+
+
+def add_item(app):
+    """Id of a listing written to the primary only"""
+    with app.app_context():
+        item = Item(name='Fire Sword', description='Warm to the touch', category='weapon', rarity='rare',
+                    seller_id=1)
+        db.session.add(item)
+        db.session.commit()
+        return item.id
+
+
+def test_marked_views_read_from_the_replica(app, client):
+    item_id = add_item(app)
+    assert client.get('/item/1').status_code == 200
+    assert client.get(f'/item/{item_id}').status_code == 404
+    # Views without @replica_reads use the primary
+    assert client.get(f'/api/v1/items/{item_id}').status_code == 200
+
+    with app.app_context():
+        database.sync_sqlite_replicas(db)
+    assert client.get(f'/item/{item_id}').status_code == 200
+
+
+def test_writer_reads_own_write_from_the_primary(app, client):
+    login(client, 1)
+    response = client.post('/item/create', data={
+        'name': 'Fire Sword', 'description': 'Warm to the touch', 'category': 'weapon', 'rarity': 'rare',
+    })
+    assert response.status_code == 302
+    assert client.get(response.headers['Location']).status_code == 200
+    assert app.test_client().get(response.headers['Location']).status_code == 404
+
+    app.config['REPLICA_STICKY_SECONDS'] = 0
+    client.post('/item/create', data={
+        'name': 'Ice Sword', 'description': 'Cold to the touch', 'category': 'weapon', 'rarity': 'rare',
+    })
+    assert client.get(response.headers['Location']).status_code == 404
+
+
+def test_replica_connections_are_read_only(app):
+    with app.app_context():
+        with db.engines[database.replica_key(0)].connect() as connection:
+            assert connection.execute(text('SELECT count(*) FROM item')).scalar() == 1
+            with pytest.raises(OperationalError, match='readonly'):
+                connection.execute(text("UPDATE item SET name = 'Stolen'"))
+
+
+@pytest.mark.parametrize('url, profile, expected', [
+    ('sqlite:///a.db', None, 'sqlite'),
+    ('sqlite:///a.db', 'sqlite-durable', 'sqlite-durable'),
+    ('postgresql://db/agora', None, 'postgresql'),
+    ('postgresql://db/agora', 'postgresql-pgbouncer', 'postgresql-pgbouncer'),
+])
+def test_profile_for(url, profile, expected):
+    assert database.profile_for(url, profile) is database.PROFILES[expected]
+
+
+@pytest.mark.parametrize('url, profile', [('sqlite:///a.db', 'postgresql'), ('postgresql://db/agora', 'sqlite'),
+                                          ('sqlite:///a.db', 'mysql')])
+def test_profile_for_rejects_mismatches(url, profile):
+    with pytest.raises(ValueError):
+        database.profile_for(url, profile)
@@ -0,0 +1,21 @@
+from app import explain
+
+
+def test_sqlite_plan_problems():
+    lines = [
+        'SCAN item',
+        'SCAN item AS item_1 USING INDEX ix_item_created',
+        'SCAN facet_count',
+        'SEARCH item USING INDEX ix_item_category_created (category=?)',
+        'SCAN item_fts VIRTUAL TABLE INDEX 0:M2',
+        'USE TEMP B-TREE FOR ORDER BY',
+        'USE TEMP B-TREE FOR RIGHT PART OF ORDER BY',
+    ]
+    assert list(explain._sqlite_problems(lines)) == [
+        'full scan of item', 'walk of ix_item_created', 'sort', 'sort']
+
+
+def test_every_page_is_served_by_indexes(app_context, users, items, messages):
+    results = explain.check()
+    assert {result.label for result in results} == {label for label, _, _ in explain.PAGES}
+    assert [(result.label, result.problems) for result in results if not result.ok] == []
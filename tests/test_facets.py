@@ -0,0 +1,57 @@
+from app import db, facets, purge
+from app.models import FacetCount, Item, User
+from tests.conftest import login
+
+
+def stored():
+    return {(row.category, row.rarity): row.count for row in FacetCount.query if row.count}
+
+
+def assert_counts_match(app):
+    with app.app_context():
+        assert stored() == facets._grouped(Item.query)
+
+
+def test_counts_follow_create_edit_and_delete(app, client, users, items):
+    alice, bob = users
+    assert_counts_match(app)
+    login(client, alice)
+
+    response = client.post('/item/create', data={
+        'name': 'Moon Amulet', 'description': 'Glows at night', 'category': 'jewel', 'rarity': 'legendary',
+    })
+    assert response.status_code == 302
+    assert_counts_match(app)
+    with app.app_context():
+        assert stored()[('jewel', 'legendary')] == 1
+
+    response = client.post(f'/item/{items[0]}/edit', data={
+        'name': 'Blunt Sword', 'description': 'No longer rare', 'category': 'weapon', 'rarity': 'common',
+    })
+    assert response.status_code == 302
+    assert_counts_match(app)
+    with app.app_context():
+        assert stored()[('weapon', 'rare')] == 7 and stored()[('weapon', 'common')] == 9
+
+    assert client.post(f'/item/{items[2]}/delete').status_code == 302
+    assert_counts_match(app)
+    with app.app_context():
+        assert stored()[('armor', 'rare')] == 7
+
+    with app.app_context():
+        purge.delete_user(db.session.get(User, bob))
+        db.session.commit()
+    assert_counts_match(app)
+
+
+def test_hard_delete_and_reconcile(app, app_context, items):
+    db.session.delete(db.session.get(Item, items[3]))
+    db.session.commit()
+    assert stored() == facets._grouped(Item.query)
+
+    # Bulk SQL that bypasses the ORM drifts until reconcile
+    db.session.execute(db.delete(Item).where(Item.id == items[0]))
+    db.session.commit()
+    assert stored() != facets._grouped(Item.query)
+    assert facets.reconcile() == 1
+    assert stored() == facets._grouped(Item.query)
@@ -0,0 +1,115 @@
+import pytest
+from sqlalchemy import event
+from werkzeug.security import generate_password_hash
+
+from app import db, passwords
+from app.identity import identity
+from app.models import User
+from tests.conftest import login
+
+
+@pytest.fixture
+def statements(app):
+    """SQL statements run against the database, as a list that grows"""
+    seen = []
+    with app.app_context():
+        engine = db.engine
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        seen.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', record)
+    yield seen
+    event.remove(engine, 'before_cursor_execute', record)
+
+
+def user_selects(statements):
+    """Statements that load a single user row by id"""
+    return [statement for statement in statements if 'FROM user \nWHERE user.id = ?' in statement]
+
+
+def test_cached_user_loads_without_a_query(app, users, statements):
+    alice, _ = users
+    with app.app_context():
+        assert identity.load(alice).username == 'alice'
+    assert len(user_selects(statements)) == 1
+
+    with app.app_context():
+        user = identity.load(alice)
+        assert user.username == 'alice' and user.email == 'alice@example.com'
+        assert user in db.session
+    assert len(user_selects(statements)) == 1
+
+    # The password hash is never cached and loads on first access
+    with app.app_context():
+        assert identity.load(alice).check_password('password')
+    assert len(user_selects(statements)) == 2
+
+
+def test_commit_to_the_user_row_drops_the_snapshot(app, users):
+    alice, _ = users
+    with app.app_context():
+        identity.load(alice)
+    with app.app_context():
+        db.session.get(User, alice).email = 'alice@trader.example.com'
+        db.session.commit()
+    with app.app_context():
+        assert identity.load(alice).email == 'alice@trader.example.com'
+
+
+def test_logged_in_requests_share_the_snapshot(app, client, users, statements):
+    login(client, users[0])
+    client.get('/messages/inbox')
+    assert len(user_selects(statements)) == 1
+    client.get('/messages/inbox')
+    assert len(user_selects(statements)) == 1
+
+    client.get('/auth/logout')
+    with app.app_context():
+        assert identity.backend.get(identity.key(users[0])) is None
+
+
+def test_tombstoned_user_is_not_loaded(app, users):
+    _, bob = users
+    with app.app_context():
+        identity.load(bob)
+        db.session.get(User, bob).deleted_at = db.func.now()
+        db.session.commit()
+    with app.app_context():
+        assert identity.load(bob) is None
+
+
+@pytest.mark.parametrize('legacy_hash', [
+    lambda: generate_password_hash('password', method='pbkdf2:sha256:1000'),
+    lambda: passwords.bcrypt.generate_password_hash('password', rounds=5).decode('utf-8'),
+])
+def test_legacy_hash_is_rehashed_on_login(app, client, users, legacy_hash):
+    alice, _ = users
+    with app.app_context():
+        db.session.get(User, alice).password_hash = legacy_hash()
+        db.session.commit()
+
+    response = client.post('/auth/login', data={'username': 'alice', 'password': 'password'})
+    assert response.status_code == 302
+
+    with app.app_context():
+        user = db.session.get(User, alice)
+        assert user.password_hash.startswith('$2b$04$')
+        assert not user.password_needs_rehash()
+        assert user.check_password('password')
+
+
+def test_current_hash_is_kept_and_wrong_password_is_refused(app, client, users):
+    alice, _ = users
+    with app.app_context():
+        before = db.session.get(User, alice).password_hash
+
+    client.post('/auth/login', data={'username': 'alice', 'password': 'wrong'})
+    with client.session_transaction() as session:
+        assert '_user_id' not in session
+    client.post('/auth/login', data={'username': 'alice', 'password': 'password'})
+    with client.session_transaction() as session:
+        assert session['_user_id'] == str(alice)
+
+    with app.app_context():
+        assert db.session.get(User, alice).password_hash == before
@@ -0,0 +1,74 @@
+import io
+
+from PIL import Image
+from werkzeug.datastructures import FileStorage
+
+from app import db, images
+from app.models import Item, User
+from tests.conftest import login
+
+
+def picture(color=(200, 30, 30), size=(1600, 900), mode='RGB'):
+    data = io.BytesIO()
+    Image.new(mode, size, color).save(data, 'PNG')
+    return data.getvalue()
+
+
+def create_item(client, data, filename='sword.png'):
+    return client.post('/item/create', data={
+        'name': 'Frost Sword', 'description': 'Cold to the touch', 'category': 'weapon', 'rarity': 'rare',
+        'image': (io.BytesIO(data), filename),
+    }, content_type='multipart/form-data')
+
+
+def test_upload_is_rendered_and_swapped_after_commit(app, client, users, upload_root):
+    login(client, users[0])
+    assert create_item(client, picture()).status_code == 302
+
+    with app.app_context():
+        item = Item.query.filter_by(name='Frost Sword').one()
+        assert item.image.startswith(images.PROCESSED_PREFIX) and item.image.endswith('.jpg')
+        digest = item.image[len(images.PROCESSED_PREFIX):-len('.jpg')]
+    assert (upload_root / 'items' / 'raw' / f'{digest}.png').exists()
+    for name, (width, height) in images.RENDITIONS['items'].items():
+        for ext in ('webp', 'jpg'):
+            with Image.open(upload_root / 'items' / 'r' / f'{digest}_{name}.{ext}') as rendition:
+                assert rendition.width <= width and rendition.height <= height
+                # Aspect ratio is kept
+                assert abs(rendition.width / rendition.height - 16 / 9) < 0.02
+    assert not list(upload_root.rglob('*.tmp'))
+
+
+def test_transparent_upload_falls_back_to_png(app, client, users, upload_root):
+    login(client, users[0])
+    create_item(client, picture(color=(0, 0, 0, 0), mode='RGBA'))
+
+    with app.app_context():
+        item = Item.query.filter_by(name='Frost Sword').one()
+        assert item.image.endswith('.png')
+        digest = item.image[len(images.PROCESSED_PREFIX):-len('.png')]
+    assert (upload_root / 'items' / 'r' / f'{digest}_card.png').exists()
+    assert not (upload_root / 'items' / 'r' / f'{digest}_card.jpg').exists()
+
+
+def test_identical_uploads_share_renditions(app, client, users, upload_root):
+    login(client, users[0])
+    data = picture()
+    create_item(client, data)
+    rendered = sorted((upload_root / 'items' / 'r').iterdir())
+    create_item(client, data, filename='copy.png')
+
+    with app.app_context():
+        first, second = [item.image for item in Item.query.filter_by(name='Frost Sword').order_by(Item.id)]
+    assert first == second
+    assert sorted((upload_root / 'items' / 'r').iterdir()) == rendered
+
+
+def test_rolled_back_upload_is_not_processed(app, app_context, users, upload_root):
+    user = db.session.get(User, users[0])
+    user.avatar = images.save_upload(FileStorage(io.BytesIO(picture()), 'me.png'), 'avatars')
+    assert user.avatar.startswith(images.RAW_PREFIX)
+    db.session.rollback()
+    db.session.commit()
+    assert (upload_root / 'avatars' / 'raw').exists()
+    assert not (upload_root / 'avatars' / 'r').exists()
@@ -0,0 +1,33 @@
+from app import metrics, socketio
+from tests.conftest import login
+
+
+def test_metrics_requires_the_token(client):
+    assert client.get('/metrics').status_code == 404
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 404
+    assert client.get('/metrics', headers={'Authorization': 'Bearer test-token'}).status_code == 200
+
+
+def test_metrics_without_a_token_is_closed_even_to_loopback(app, client):
+    app.config['METRICS_TOKEN'] = None
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '127.0.0.1'}).status_code == 404
+    assert client.get('/metrics', headers={'Authorization': 'Bearer '}).status_code == 404
+
+
+def test_profiler_needs_the_token(app, client, users):
+    app.config['PROFILER_ENABLED'] = True
+    assert client.get('/?_profile=1').mimetype == 'text/html'
+    response = client.get('/?_profile=1', headers={'Authorization': 'Bearer test-token'})
+    assert response.mimetype == 'text/plain'
+
+
+def test_room_gauges_do_not_name_rooms(app, client, users):
+    alice, bob = users
+    login(client, alice)
+    socket = socketio.test_client(app, flask_test_client=client)
+    socket.emit('join_chat', {'room': f'chat_{min(alice, bob)}_{max(alice, bob)}'})
+    text = metrics.render()
+    assert 'socketio_rooms{type="chat"} 1' in text
+    assert 'socketio_room_members{type="user"} 1' in text
+    assert f'_{alice}_' not in text and f'user_{alice}' not in text
+    socket.disconnect()
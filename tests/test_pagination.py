@@ -0,0 +1,28 @@
+from app import pagination
+from app.models import Item
+
+
+def test_cached_count_is_reused_until_invalidated(app_context, items):
+    weapons = Item.query.filter_by(category='weapon').count()
+    assert pagination.cached_count(('test', 'weapon'), Item.query.filter_by(category='weapon')) == weapons
+    assert pagination.cached_count(('test', 'weapon'), Item.query) == weapons
+    pagination.invalidate_count(('test', 'weapon'))
+    assert pagination.cached_count(('test', 'weapon'), Item.query) == len(items)
+
+
+def test_count_cache_is_bounded(app_context, items, monkeypatch):
+    monkeypatch.setattr(pagination, '_count_cache', pagination.LRUCache(max_entries=3))
+    for i in range(10):
+        pagination.cached_count(('search', i), Item.query)
+    assert len(pagination._count_cache.entries) == 3
+
+
+def test_keyset_pages_cover_every_item_once(app_context, items):
+    seen, cursor = [], None
+    while True:
+        page = pagination.keyset_paginate(Item.query, (Item.created_at, Item.id), 5, cursor)
+        seen += [item.id for item in page.items]
+        if not page.has_next:
+            break
+        cursor = page.next_cursor
+    assert sorted(seen) == sorted(items)
@@ -0,0 +1,84 @@
+import pytest
+from app import socketio
+from app.presence import presence
+from tests.conftest import login
+
+
+@pytest.fixture(autouse=True)
+def pending(monkeypatch):
+    monkeypatch.setattr(presence, 'pending', {})
+    return presence.pending
+
+
+def _socket(app, user_id):
+    client = app.test_client()
+    login(client, user_id)
+    return socketio.test_client(app, flask_test_client=client)
+
+
+def _events(socket):
+    return [event['args'][0] for event in socket.get_received() if event['name'] == 'presence']
+
+
+def test_subscribers_hear_status_changes(app, users):
+    alice, bob = users
+    watcher = _socket(app, alice)
+    assert watcher.emit('presence_subscribe', {'user_ids': [bob]}, callback=True) == {'online': []}
+
+    seller = _socket(app, bob)
+    presence.flush()
+    assert _events(watcher) == [{'user_id': bob, 'online': True}]
+    # Malformed ids reject the whole request
+    assert watcher.emit('presence_subscribe', {'user_ids': [bob, 'x']}, callback=True) == {'online': []}
+    assert watcher.emit('presence_subscribe', {'user_ids': [bob]}, callback=True) == {'online': [bob]}
+
+    seller.disconnect()
+    presence.flush()
+    assert _events(watcher) == [{'user_id': bob, 'online': False}]
+
+
+def test_status_is_not_broadcast(app, users):
+    alice, bob = users
+    bystander = _socket(app, alice)
+    _socket(app, bob)
+    presence.flush()
+    assert _events(bystander) == []
+
+
+def test_reconnect_within_the_window_is_not_announced(app, users):
+    alice, bob = users
+    watcher = _socket(app, alice)
+    watcher.emit('presence_subscribe', {'user_ids': [bob]})
+    seller = _socket(app, bob)
+    presence.flush()
+    watcher.get_received()
+
+    seller.disconnect()
+    seller.connect()
+    assert presence.pending == {bob: True}
+    presence.flush()
+    assert _events(watcher) == []
+
+    # A second tab changes nothing either
+    second_tab = _socket(app, bob)
+    second_tab.disconnect()
+    presence.flush()
+    assert _events(watcher) == []
+
+
+def test_unsubscribe_stops_updates(app, users):
+    alice, bob = users
+    watcher = _socket(app, alice)
+    watcher.emit('presence_subscribe', {'user_ids': [bob]})
+    watcher.emit('presence_unsubscribe', {'user_ids': [bob]})
+    _socket(app, bob)
+    presence.flush()
+    assert _events(watcher) == []
+
+
+def test_subscriptions_are_capped(app, users):
+    alice, bob = users
+    app.config['PRESENCE_MAX_SUBSCRIPTIONS'] = 1
+    watcher = _socket(app, alice)
+    _socket(app, bob)
+    assert len(watcher.emit('presence_subscribe', {'user_ids': [alice, bob]}, callback=True)['online']) == 1
@@ -0,0 +1,27 @@
+from sqlalchemy import text, update
+
+from app import archive, db, purge, recommend
+from app.models import (ArchivedMessage, Conversation, ConversationMember, Item, ItemRecommendation, Message,
+                        User)
+
+
+def test_purge_leaves_no_dangling_references(app, app_context, users, items, messages):
+    alice, bob = users
+    db.session.execute(update(Message).values(read=True))
+    app.config['MESSAGE_HOT_PER_CONVERSATION'] = 2
+    assert archive.archive(pause=0)
+    recommend.rebuild()
+    db.session.commit()
+    assert ItemRecommendation.query.filter(ItemRecommendation.recommended_id.in_(items[1::2])).count()
+
+    purge.delete_user(db.session.get(User, bob))
+    db.session.commit()
+    removed = purge.purge(pause=0)
+
+    # Foreign keys are not enforced, so every reference must have been removed by hand
+    assert db.session.execute(text('PRAGMA foreign_key_check')).all() == []
+    assert removed['users'] == 1 and removed['items'] == len(items) // 2
+    for model in (Message, ArchivedMessage, Conversation, ConversationMember):
+        assert db.session.query(model).count() == 0
+    assert {item.seller_id for item in Item.query} == {alice}
+    assert {row.recommended_id for row in ItemRecommendation.query} <= set(items[::2])
@@ -0,0 +1,78 @@
+"""Every ``@query_budget`` view, requested with ``QUERY_BUDGET_MODE = 'raise'``"""
+import pytest
+from app import db
+from app.cache import cache
+from app.models import Item
+from app.pagination import encode_cursor
+from tests.conftest import login
+
+# endpoint -> URLs to request, with a logged-in user when the flag is set
+PAGES = {
+    'main.index': [('/', False)],
+    'main.marketplace': [
+        ('/marketplace', False),
+        ('/marketplace?category=weapon', False),
+        ('/marketplace?rarity=rare', False),
+        ('/marketplace?category=weapon&rarity=rare', False),
+        ('/marketplace?search=sword', False),
+        ('/marketplace?cursor={cursor}', False),
+    ],
+    'main.item_detail': [('/item/{item_id}', False)],
+    'main.profile': [('/profile/alice', False), ('/profile/alice?cursor={cursor}', False)],
+    'main.inbox': [('/messages/inbox', True)],
+    'main.sent': [('/messages/sent', True)],
+    'main.view_message': [('/messages/{message_id}', True)],
+    'main.chat': [('/messages/chat/{bob_id}', True), ('/messages/chat/{bob_id}/{item_id}', True)],
+    'main.chat_history': [('/messages/chat/{bob_id}/history?cursor={history_cursor}', True)],
+    'main.presence_status': [('/presence?ids={bob_id}', True)],
+    'api.items': [
+        ('/api/v1/items', False),
+        ('/api/v1/items?category=weapon&rarity=rare', False),
+        ('/api/v1/items?seller=bob', False),
+        ('/api/v1/items?search=sword', False),
+        ('/api/v1/items?limit=2&cursor={cursor}', False),
+    ],
+    'api.item': [('/api/v1/items/{item_id}', False)],
+    'api.user': [('/api/v1/users/alice', False)],
+    'api.user_items': [('/api/v1/users/alice/items', False)],
+    'api.threads': [('/api/v1/threads', True)],
+    'api.thread_messages': [('/api/v1/threads/{bob_id}/messages', True)],
+    'uploads': [('/uploads/items/314975115303618a.jpg', False)],
+}
+
+
+@pytest.fixture
+def values(app, client, users, items, messages):
+    alice, bob = users
+    app.config['CHAT_PAGE_SIZE'] = 2
+    with app.app_context():
+        middle = db.session.get(Item, items[len(items) // 2])
+        cursor = encode_cursor('next', (middle.created_at, middle.id))
+    login(client, alice)
+    return {
+        'item_id': items[0],
+        'bob_id': bob,
+        'message_id': messages[0],
+        'cursor': cursor,
+        'history_cursor': client.get(f'/messages/chat/{bob}/history').json['cursor'],
+    }
+
+
+def test_every_budgeted_view_is_covered(app):
+    budgeted = {endpoint for endpoint, view in app.view_functions.items() if hasattr(view, 'query_budget')}
+    assert budgeted == set(PAGES)
+
+
+@pytest.mark.parametrize('endpoint', sorted(PAGES))
+def test_view_stays_within_budget(app, client, users, values, endpoint):
+    for url, needs_login in PAGES[endpoint]:
+        if not needs_login:
+            with client.session_transaction() as session:
+                session.clear()
+        else:
+            login(client, users[0])
+        # Measure the uncached path
+        cache.bump()
+        response = client.get(url.format(**values))
+        assert response.status_code == 200, url
+        assert int(response.headers['X-SQL-Queries']) <= app.view_functions[endpoint].query_budget
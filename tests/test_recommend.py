@@ -0,0 +1,77 @@
+import pytest
+from app import db, purge, recommend
+from app.models import Item, ItemRecommendation, ItemVector, RecommendationTerm
+
+LISTINGS = [
+    # name, description, category, rarity, seller (0 = alice, 1 = bob)
+    ('Flaming Sword', 'A blade wreathed in fire', 'weapon', 'rare', 0),
+    ('Frost Sword', 'A blade of winter ice', 'weapon', 'rare', 0),
+    ('Healing Potion', 'Restores health', 'potion', 'common', 0),
+    ('Flaming Axe', 'An axe wreathed in fire', 'weapon', 'epic', 1),
+    ('Mana Potion', 'Restores mana', 'potion', 'common', 1),
+    ('Iron Shield', 'Sturdy and plain', 'armor', 'common', 1),
+]
+
+
+@pytest.fixture
+def listings(app_context, users):
+    """``{name: Item}`` with freshly built recommendation lists"""
+    items = {name: Item(name=name, description=description, category=category, rarity=rarity,
+                        seller_id=users[seller])
+             for name, description, category, rarity, seller in LISTINGS}
+    db.session.add_all(items.values())
+    db.session.commit()
+    assert recommend.rebuild() == len(LISTINGS)
+    return items
+
+
+def _names(item):
+    return {kind: [other.name for other in others] for kind, others in recommend.for_item(item.id).items()}
+
+
+def test_rebuild_fills_similar_and_seller_lists(listings):
+    lists = _names(listings['Flaming Sword'])
+    assert lists['similar'][:2] == ['Frost Sword', 'Flaming Axe']
+    assert 'Flaming Sword' not in lists['similar']
+    # The potion shares no text, category or rarity, so it is no recommendation
+    assert lists['seller'] == ['Frost Sword']
+    assert _names(listings['Mana Potion'])['similar'][0] == 'Healing Potion'
+    assert db.session.query(ItemVector).count() == len(LISTINGS)
+    assert db.session.get(RecommendationTerm, 'fire').documents == 2
+
+
+def test_update_refreshes_an_edited_listing(listings):
+    potion = listings['Healing Potion']
+    potion.name, potion.description, potion.category, potion.rarity = \
+        'Frost Axe', 'An axe of winter ice', 'weapon', 'epic'
+    db.session.commit()
+    recommend.update({potion.id})
+
+    assert _names(potion)['similar'][:2] == ['Flaming Axe', 'Frost Sword']
+    assert _names(listings['Flaming Axe'])['similar'][0] == 'Frost Axe'
+    assert 'Frost Axe' not in _names(listings['Mana Potion'])['similar']
+    assert db.session.get(RecommendationTerm, 'axe').documents == 2
+
+
+def test_purged_listing_leaves_every_list(listings):
+    frost = listings['Frost Sword']
+    frost_id = frost.id
+    purge.delete_item(frost)
+    db.session.commit()
+    assert purge.purge(pause=0)['items'] == 1
+
+    assert db.session.query(ItemRecommendation).filter(
+        (ItemRecommendation.item_id == frost_id) | (ItemRecommendation.recommended_id == frost_id)
+    ).count() == 0
+    assert 'Frost Sword' not in _names(listings['Flaming Sword'])['similar']
+    assert db.session.get(ItemVector, frost_id) is None
+    assert db.session.get(RecommendationTerm, 'winter').documents == 0
+
+
+def test_update_forgets_a_tombstoned_listing(listings):
+    shield = listings['Iron Shield']
+    purge.delete_item(shield)
+    db.session.commit()
+    recommend.update({shield.id})
+    assert db.session.query(ItemRecommendation).filter_by(recommended_id=shield.id).count() == 0
+    assert db.session.get(ItemVector, shield.id) is None
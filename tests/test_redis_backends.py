@@ -0,0 +1,93 @@
+import sys
+
+import pytest
+
+from app import bus
+from app.cache import RedisCache, create_backend
+from app.presence import RedisPresence, create_store
+
+
+class FakeRedis:
+    """In-memory stand-in for the few Redis commands the backends use"""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def incr(self, key):
+        self.data[key] = int(self.data.get(key) or 0) + 1
+        return self.data[key]
+
+    def expire(self, key, seconds):
+        pass
+
+    def zadd(self, key, mapping):
+        self.data.setdefault(key, {}).update(mapping)
+
+    def zrem(self, key, member):
+        self.data.get(key, {}).pop(member, None)
+
+    def zremrangebyscore(self, key, low, high):
+        members = self.data.get(key, {})
+        for member, score in list(members.items()):
+            if float(low) <= score <= float(high):
+                del members[member]
+
+    def zcount(self, key, low, high):
+        return sum(float(low) <= score <= float(high) for score in self.data.get(key, {}).values())
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.calls.append((name, args, kwargs))
+
+    def execute(self):
+        return [getattr(self.redis, name)(*args, **kwargs) for name, args, kwargs in self.calls]
+
+
+def test_redis_cache_round_trip():
+    cache = RedisCache('redis://localhost', client=FakeRedis())
+    cache.set('grid', {'ids': [1, 2]}, 60)
+    assert cache.get('grid') == {'ids': [1, 2]}
+    cache.delete('grid')
+    assert cache.get('grid') is None
+    assert cache.version('items') == 0
+    assert cache.bump('items') == 1
+    assert cache.version('items') == 1
+
+
+def test_redis_presence_tracks_other_workers(monkeypatch):
+    client = FakeRedis()
+    here = RedisPresence('redis://localhost', client=client)
+    there = RedisPresence('redis://localhost', client=client)
+    monkeypatch.setattr(here, 'beating', True)
+    here.add('sid-1', 7)
+    here.heartbeat()
+    assert there.online([7, 8]) == {7}
+    here.remove('sid-1')
+    assert there.online([7, 8]) == set()
+
+
+def test_missing_redis_package_names_the_setting(monkeypatch):
+    monkeypatch.setitem(sys.modules, 'redis', None)
+    with pytest.raises(RuntimeError, match='CACHE_URL.*requirements-redis.txt'):
+        create_backend('redis://localhost')
+    with pytest.raises(RuntimeError, match='PRESENCE_URL'):
+        create_store('redis://localhost')
+    with pytest.raises(RuntimeError, match='SOCKETIO_MESSAGE_QUEUE'):
+        bus.create_manager('redis://localhost')
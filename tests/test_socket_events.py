@@ -0,0 +1,111 @@
+from datetime import datetime
+
+import pytest
+from app import db, socketio, unread
+from app.models import Message, User
+from app.typing_indicators import tracker as typing_tracker
+from tests.conftest import login
+
+
+def _socket(app, client, user_id):
+    login(client, user_id)
+    return socketio.test_client(app, flask_test_client=client)
+
+
+def _events(socket, name):
+    return [event['args'][0] for event in socket.get_received() if event['name'] == name]
+
+
+def test_join_chat_accepts_own_chat_room(app, client, users):
+    alice, bob = users
+    socket = _socket(app, client, alice)
+    room = f'chat_{min(alice, bob)}_{max(alice, bob)}'
+    socket.emit('join_chat', {'room': room})
+    assert _events(socket, 'joined_chat') == [{'room': room, 'user': 'alice'}]
+
+
+def test_join_chat_rejects_other_rooms(app, client, users):
+    alice, bob = users
+    socket = _socket(app, client, alice)
+    for room in (unread.user_room(bob), f'presence_{bob}', f'chat_{bob}_{bob + 1}', f'chat_{bob}_{alice}', None):
+        assert socket.emit('join_chat', {'room': room}, callback=True) == {'error': 'Not your chat room'}
+    socket.get_received()
+
+    socketio.emit('unread_count', {'count': 3}, to=unread.user_room(bob))
+    assert _events(socket, 'unread_count') == []
+
+
+def test_typing_only_reaches_own_chat_room(app, client, users):
+    alice, bob = users
+    socket = _socket(app, client, alice)
+    room = f'chat_{min(alice, bob)}_{max(alice, bob)}'
+    socket.emit('join_chat', {'room': room})
+    for other in (None, '', unread.user_room(bob), f'chat_{bob}_{bob + 1}'):
+        socket.emit('typing', {'room': other})
+    assert typing_tracker.pending == {}
+    typing_tracker.pending[None] = {bob: ('bob', True)}
+    socket.emit('typing', {'room': room})
+    typing_tracker.flush()
+    assert _events(socket, 'typing_update') == [{'changes': [{'user_id': alice, 'user': 'alice', 'typing': True}]}]
+    typing_tracker.stop_all(alice)
+    typing_tracker.pending.clear()
+
+
+def test_send_message_validates_recipient_and_item(app, client, users, items):
+    alice, bob = users
+    socket = _socket(app, client, alice)
+    for data in ({'recipient_id': 'bob'}, {'recipient_id': None}, {'recipient_id': bob, 'item_id': 'x'},
+                 {'recipient_id': bob + 100}, {'recipient_id': alice}, {'recipient_id': bob, 'item_id': 10**6}):
+        assert 'error' in socket.emit('send_message', dict(data, content='hi'), callback=True)
+    with app.app_context():
+        assert Message.query.count() == 0
+        db.session.get(User, bob).deleted_at = datetime.utcnow()
+        db.session.commit()
+    assert socket.emit('send_message', {'recipient_id': bob, 'content': 'hi'}, callback=True) == {
+        'error': 'Unknown recipient'}
+
+
+def test_send_message_goes_to_the_pair_room(app, client, users, items):
+    alice, bob = users
+    socket = _socket(app, client, alice)
+    socket.emit('send_message', {'recipient_id': bob, 'item_id': items[0], 'content': 'hi',
+                                 'room': unread.user_room(bob)})
+    socket.get_received()
+    socket.emit('join_chat', {'room': f'chat_{min(alice, bob)}_{max(alice, bob)}'})
+    socket.emit('send_message', {'recipient_id': str(bob), 'item_id': str(items[0]), 'content': 'again'})
+    assert [m['content'] for m in _events(socket, 'receive_message')] == ['again']
+    with app.app_context():
+        assert [m.item_id for m in Message.query.all()] == [items[0], items[0]]
+
+
+@pytest.mark.parametrize('write_behind', [False, True])
+def test_send_message_rejects_empty_content(app, client, users, write_behind):
+    alice, bob = users
+    app.config['CHAT_WRITE_BEHIND'] = write_behind
+    socket = _socket(app, client, alice)
+    socket.emit('join_chat', {'room': f'chat_{min(alice, bob)}_{max(alice, bob)}'})
+    for content in (None, '', '   ', 5, ['hi']):
+        data = {'recipient_id': bob} if content is None else {'recipient_id': bob, 'content': content}
+        assert socket.emit('send_message', data, callback=True) == {'error': 'Empty message'}
+    assert _events(socket, 'receive_message') == []
+    with app.app_context():
+        assert Message.query.count() == 0
+
+
+def test_mark_read_and_history_reject_bad_input(app, client, users, messages):
+    alice, bob = users
+    socket = _socket(app, client, alice)
+    for data in (None, {}, {'other_user_id': 'x'}, {'other_user_id': bob, 'up_to': 'last'}):
+        assert 'error' in socket.emit('mark_read', data, callback=True)
+    for data in (None, {}, {'other_user_id': 'x'}, {'other_user_id': [bob]}):
+        assert socket.emit('history', data, callback=True) == {'error': 'Invalid user id'}
+    for cursor in ('tampered', {'a': 1}, 5):
+        assert socket.emit('history', {'other_user_id': bob, 'cursor': cursor}, callback=True) == {
+            'error': 'Invalid cursor'}
+
+    app.config['CHAT_PAGE_SIZE'] = 2
+    page = socket.emit('history', {'other_user_id': bob}, callback=True)
+    assert page['cursor']
+    older = socket.emit('history', {'other_user_id': bob, 'cursor': page['cursor']}, callback=True)
+    assert older['messages'] and 'error' not in older
+    assert socket.emit('mark_read', {'other_user_id': str(bob)}, callback=True) == {'updated': 3}
@@ -0,0 +1,98 @@
+import pytest
+from app import socketio, typing_indicators
+from app.typing_indicators import tracker
+from tests.conftest import login
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture(autouse=True)
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(typing_indicators, 'time', clock)
+    monkeypatch.setattr(tracker, 'active', {})
+    monkeypatch.setattr(tracker, 'pending', {})
+    return clock
+
+
+@pytest.fixture
+def chat(app, users):
+    """Sockets of alice and bob in their chat room, and the room"""
+    alice, bob = users
+    room = f'chat_{min(alice, bob)}_{max(alice, bob)}'
+    sockets = []
+    for user_id in users:
+        client = app.test_client()
+        login(client, user_id)
+        socket = socketio.test_client(app, flask_test_client=client)
+        socket.emit('join_chat', {'room': room})
+        socket.get_received()
+        sockets.append(socket)
+    return sockets[0], sockets[1], room
+
+
+def _updates(socket):
+    return [change for event in socket.get_received() if event['name'] == 'typing_update'
+            for change in event['args'][0]['changes']]
+
+
+def test_burst_is_one_start_and_one_stop(users, chat):
+    alice, _ = users
+    typist, reader, room = chat
+    for _ in range(5):
+        typist.emit('typing', {'room': room})
+    tracker.flush()
+    assert _updates(reader) == [{'user_id': alice, 'user': 'alice', 'typing': True}]
+
+    typist.emit('typing', {'room': room})
+    tracker.flush()
+    assert _updates(reader) == []
+
+    typist.emit('stop_typing', {'room': room})
+    tracker.flush()
+    assert _updates(reader) == [{'user_id': alice, 'user': 'alice', 'typing': False}]
+
+
+def test_silent_typist_expires(app, users, chat, clock):
+    alice, _ = users
+    typist, reader, room = chat
+    typist.emit('typing', {'room': room})
+    tracker.flush()
+    reader.get_received()
+
+    clock.now += app.config['TYPING_TIMEOUT'] / 2
+    typist.emit('typing', {'room': room})
+    clock.now += app.config['TYPING_TIMEOUT'] - 0.1
+    tracker.flush()
+    assert _updates(reader) == []
+
+    clock.now += 0.1
+    tracker.flush()
+    assert _updates(reader) == [{'user_id': alice, 'user': 'alice', 'typing': False}]
+    assert tracker.active == {}
+
+
+def test_start_and_stop_within_a_tick_are_not_sent(chat):
+    typist, reader, room = chat
+    typist.emit('typing', {'room': room})
+    typist.emit('stop_typing', {'room': room})
+    tracker.flush()
+    assert _updates(reader) == []
+
+
+def test_disconnect_ends_the_burst(users, chat):
+    alice, _ = users
+    typist, reader, room = chat
+    typist.emit('typing', {'room': room})
+    tracker.flush()
+    reader.get_received()
+
+    typist.disconnect()
+    tracker.flush()
+    assert _updates(reader) == [{'user_id': alice, 'user': 'alice', 'typing': False}]
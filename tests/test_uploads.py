@@ -0,0 +1,76 @@
+import gzip
+
+import pytest
+
+DIGEST = '0123456789abcdef0123456789abcdef'
+
+
+@pytest.fixture
+def stored(upload_root):
+    """A content-addressed rendition, a gzip copy of it and a default picture"""
+    renditions = upload_root / 'items' / 'r'
+    renditions.mkdir(parents=True)
+    body = b'<svg>' + b'x' * 2000 + b'</svg>'
+    (renditions / f'{DIGEST}_card.svg').write_bytes(body)
+    (renditions / f'{DIGEST}_card.svg.gz').write_bytes(gzip.compress(body))
+    (upload_root / 'items' / 'default_item.png').write_bytes(b'png')
+    return body
+
+
+def test_content_addressed_upload_is_immutable(client, stored):
+    response = client.get(f'/uploads/items/r/{DIGEST}_card.svg')
+    assert response.status_code == 200
+    assert response.data == stored
+    assert response.cache_control.immutable and response.cache_control.max_age == 365 * 24 * 3600
+    assert response.headers['Accept-Ranges'] == 'bytes'
+
+    etag = response.headers['ETag']
+    response = client.get(f'/uploads/items/r/{DIGEST}_card.svg', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+
+
+def test_precompressed_variant_is_sent_when_accepted(client, stored):
+    response = client.get(f'/uploads/items/r/{DIGEST}_card.svg', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert gzip.decompress(response.data) == stored
+
+    # The encoded body has its own validator
+    plain = client.get(f'/uploads/items/r/{DIGEST}_card.svg')
+    assert plain.headers['ETag'] != response.headers['ETag']
+    assert 'Content-Encoding' not in plain.headers
+    response = client.get(f'/uploads/items/r/{DIGEST}_card.svg',
+                          headers={'Accept-Encoding': 'gzip', 'If-None-Match': response.headers['ETag']})
+    assert response.status_code == 304
+
+
+def test_other_files_get_the_fallback_max_age(app, client, stored):
+    response = client.get('/uploads/items/default_item.png')
+    assert response.status_code == 200
+    assert not response.cache_control.immutable
+    assert response.cache_control.max_age == app.config['UPLOADS_FALLBACK_MAX_AGE']
+    response = client.get('/uploads/items/default_item.png', headers={'If-None-Match': response.headers['ETag']})
+    assert response.status_code == 304
+
+
+def test_range_request(client, stored):
+    response = client.get(f'/uploads/items/r/{DIGEST}_card.svg', headers={'Range': 'bytes=0-4'})
+    assert response.status_code == 206
+    assert response.data == b'<svg>'
+
+
+@pytest.mark.parametrize('path', ['/uploads/secrets/a.png', '/uploads/items/../../config.py',
+                                  f'/uploads/items/r/{DIGEST}_card.svg.1-ab.tmp', '/uploads/items/missing.png'])
+def test_unknown_paths_are_not_found(client, stored, path):
+    assert client.get(path).status_code == 404
+
+
+def test_x_accel_redirect_leaves_the_body_to_nginx(app, client, stored):
+    app.config['UPLOADS_SERVE_MODE'] = 'x-accel-redirect'
+    response = client.get(f'/uploads/items/r/{DIGEST}_card.svg', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['X-Accel-Redirect'] == f'/_uploads/items/r/{DIGEST}_card.svg'
+    assert response.data == b''
+    assert 'Content-Encoding' not in response.headers
+    response = client.get(f'/uploads/items/r/{DIGEST}_card.svg', headers={'If-None-Match': response.headers['ETag']})
+    assert response.status_code == 304